@@ -55,6 +55,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'requirements.middleware.ServerTimingMiddleware',
 ]
 
 ROOT_URLCONF = 'django_doorstop.urls'
@@ -145,3 +146,53 @@ EASYMDE_OPTIONS = {
 # Change me....
 DOORSTOP_ITEMS_PAGINATE = 20
 DOORSTOP_REPO = '/tmp/repo'
+# Patches larger than this (in bytes) are truncated in the version control view
+DOORSTOP_DIFF_MAX_SIZE = 256 * 1024
+# Seconds between two background scans of the working tree looking for changes made outside the app
+DOORSTOP_WATCH_INTERVAL = 2.0
+# Update the cached git status only for the files saved through the app
+DOORSTOP_STATUS_TRACK_WRITES = True
+# Git repositories kept open by each thread and seconds before an idle one is closed
+DOORSTOP_REPOSITORY_POOL_SIZE = 4
+DOORSTOP_REPOSITORY_POOL_IDLE = 600
+# Directory for the persisted indexes (defaults to .git/django_doorstop inside the repository)
+DOORSTOP_CACHE_DIR = None
+# Give every user a git worktree of DOORSTOP_REPO, created on first login
+DOORSTOP_USER_WORKTREES = True
+DOORSTOP_WORKTREES_ROOT = '/tmp/repo-worktrees'
+# Parsed trees kept in memory (one per working directory) and seconds before an idle one is dropped
+DOORSTOP_TREE_CACHE_SIZE = 8
+DOORSTOP_TREE_CACHE_IDLE = 3600
+# Threads used to write the items staged by a document batch (0 writes them sequentially)
+DOORSTOP_WRITE_WORKERS = 0
+# Read and write item files with libyaml when PyYAML was built with it
+DOORSTOP_YAML_LIBYAML = True
+# Persist the parsed files of each working directory so that new workers only parse the changed ones
+DOORSTOP_TREE_SNAPSHOT = True
+# Look up child items in a link index memory-mapped by all the workers (the parsed trees stay per worker)
+DOORSTOP_LINK_INDEX = True
+# Report the time spent in each phase of a request in the Server-Timing header and in the log
+DOORSTOP_SERVER_TIMING = True
+# Count the hot paths and observe their latency, in the Prometheus format at metrics/ of the app
+DOORSTOP_METRICS = True
+# Directory shared by the workers for their metrics (defaults to the metrics folder of DOORSTOP_CACHE_DIR)
+DOORSTOP_METRICS_DIR = None
+# Seconds before the changed metrics of a worker are written for the others
+DOORSTOP_METRICS_FLUSH = 1.0
+# Client addresses allowed to read the metrics (None allows everybody)
+DOORSTOP_METRICS_ALLOWED = ['127.0.0.1', '::1']
+# Bearer token of the metrics scraper (staff users can read the metrics without it)
+DOORSTOP_METRICS_TOKEN = None
+# Largest number of items read or updated by a single request to the JSON API
+DOORSTOP_API_MAX_ITEMS = 1000
+# Tokens of the clients of the JSON API, sent as `Authorization: Bearer <token>`, and their user name
+DOORSTOP_API_TOKENS = {}
+# Threads running the blocking work of the async views under ASGI, by kind of work
+DOORSTOP_EXECUTOR_WORKERS = {'git': 4, 'export': 2, 'files': 8, 'events': 16}
+# Seconds a server-sent events request waits for changes before the browser reconnects
+DOORSTOP_EVENTS_WAIT = 15.0
+# Waiting event answers of a process under ASGI, the others answer at once (WSGI never waits)
+DOORSTOP_EVENTS_MAX_CONNECTIONS = 100
+# Cache (from CACHES) and seconds to keep the rendered rows of the requirements table
+DOORSTOP_ROW_CACHE = 'default'
+DOORSTOP_ROW_CACHE_TIMEOUT = 600
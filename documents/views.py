@@ -1,3 +1,5 @@
+import tempfile
+
 from django.core.files.uploadedfile import UploadedFile
 from django.middleware.csrf import get_token
 from django.utils.decorators import method_decorator
@@ -5,9 +7,11 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.base import View
 from jsonview.views import JsonView
 
+from requirements.executors import AsyncViewMixin
+
 
 @method_decorator(csrf_exempt, name='dispatch')
-class IndexView(JsonView):
+class IndexView(AsyncViewMixin, JsonView):
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
         context['token'] = get_token(request)
@@ -15,8 +19,11 @@ class IndexView(JsonView):
 
     def post(self, request, *args, **kwargs):
         file = request.FILES['file']  # type: UploadedFile
-        with open(f'/tmp/{file.name}', 'wb') as out:
-            out.write(file.read())
+        # The client file name is not trusted and nothing keeps the upload: it goes to
+        # an anonymous temporary file removed when closed
+        with tempfile.TemporaryFile(prefix='upload-') as out:
+            for chunk in file.chunks():
+                out.write(chunk)
         context = self.get_context_data(**kwargs)
         context['token'] = get_token(request)
         return context
@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from django.contrib.auth.signals import user_logged_in
+
 from requirements import djdoorstop
 
 
@@ -7,5 +9,7 @@ class DoorstopConfig(AppConfig):
 
     def ready(self):
         from doorstop import core
+        from requirements.utils import on_user_logged_in
         core.document.DOCUMENT_CLASS = djdoorstop.DjDocument
         core.item.ITEM_CLASS = djdoorstop.DjItem
+        user_logged_in.connect(on_user_logged_in)
@@ -0,0 +1,71 @@
+from typing import Any, Dict, Optional
+
+import yaml
+from django.conf import settings
+from doorstop import DoorstopError
+from doorstop.core import types  # noqa: F401  registers doorstop's representers on yaml.Dumper
+
+from requirements.metrics import YAML_PARSED
+from requirements.timing import phase
+
+try:
+    from yaml import CSafeLoader, CSafeDumper
+    LIBYAML = True
+except ImportError:
+    CSafeLoader, CSafeDumper = yaml.SafeLoader, yaml.SafeDumper
+    LIBYAML = False
+
+
+def _dumper_class(base):
+    #  type: (type) -> type
+    # Copy the representers doorstop registers on yaml.Dumper (literal block text, ...)
+    # so that files are dumped to the same bytes doorstop itself would write
+    class CodecDumper(base):
+        def represent_scalar(self, tag, value, style=None):
+            # libyaml's emitter only accepts plain str values, not str subclasses like _Literal
+            return super().represent_scalar(tag, str(value), style)
+
+    for data_type, representer in yaml.Dumper.yaml_representers.items():
+        if data_type not in base.yaml_representers:
+            CodecDumper.add_representer(data_type, representer)
+    return CodecDumper
+
+
+PureDumper = _dumper_class(yaml.SafeDumper)
+FastDumper = _dumper_class(CSafeDumper) if LIBYAML else PureDumper
+
+
+def use_libyaml():
+    #  type: () -> bool
+    """libyaml is used when PyYAML was built with it, unless DOORSTOP_YAML_LIBYAML is disabled."""
+    return LIBYAML and getattr(settings, 'DOORSTOP_YAML_LIBYAML', True)
+
+
+def loader_class():
+    return CSafeLoader if use_libyaml() else yaml.SafeLoader
+
+
+def dumper_class():
+    return FastDumper if use_libyaml() else PureDumper
+
+
+def load_yaml(text, path='<string>', loader=None):
+    #  type: (Any, str, Optional[type]) -> Dict
+    """Parse a dictionary from YAML text or stream, raising DoorstopError like doorstop does."""
+    try:
+        with phase('yaml'):
+            data = yaml.load(text, Loader=loader or loader_class()) or {}
+        YAML_PARSED.inc()
+    except yaml.error.YAMLError as exc:
+        raise DoorstopError("invalid contents: {}:\n{}".format(path, exc)) from None
+    if not isinstance(data, dict):
+        raise DoorstopError("invalid contents: {}".format(path))
+    return data
+
+
+def dump_yaml(data, **kwargs):
+    #  type: (Any, Any) -> str
+    kwargs.setdefault('default_flow_style', False)
+    kwargs.setdefault('allow_unicode', True)
+    with phase('yaml-dump'):
+        return yaml.dump(data, Dumper=kwargs.pop('dumper', None) or dumper_class(), **kwargs)
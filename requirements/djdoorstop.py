@@ -1,16 +1,185 @@
 import os
 import hashlib
-from typing import Any, Dict, Optional
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AnyStr, Dict, List, Optional, Tuple
 
 from doorstop import DoorstopError, Item
 from doorstop.core.base import auto_load, auto_save
 from doorstop.core.document import Document
 from doorstop.core.types import to_bool
 from doorstop import common, settings
+from django.conf import settings as django_settings
+
+from requirements import codec
+from requirements.snapshot import snapshot_for
+from requirements.watcher import notify_write
 
 log = common.logger(__name__)
 
 
+def write_atomic(text, path):
+    #  type: (AnyStr, str) -> None
+    """Write a file through a temporary file and a rename, readers never see a partial file."""
+    dirname, basename = os.path.split(path)
+    fd, tmpname = tempfile.mkstemp(prefix='.{}.'.format(basename), suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(text, bytes) else 'w') as f:
+            f.write(text)
+        if os.path.exists(path):
+            shutil.copymode(path, tmpname)
+        else:
+            os.chmod(tmpname, 0o644)
+        os.replace(tmpname, path)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+
+class WriteBatch(object):
+    """Stage item saves in memory and write every dirty item once when the batch exits.
+
+    While a batch is active in the current thread `DjItem.save` only records the item.
+    Batches can be nested, the outermost one flushes. If the block raises, staged items are reloaded
+    from disk instead of being written; if a write fails, the items not written yet are reloaded.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, workers=0):
+        #  type: (int) -> None
+        self._workers = workers
+        self._items = OrderedDict()  # type: Dict[str, DjItem]
+        self._outer = None  # type: Optional[WriteBatch]
+
+    @staticmethod
+    def current():
+        #  type: () -> Optional[WriteBatch]
+        return getattr(WriteBatch._local, 'batch', None)
+
+    def __enter__(self):
+        self._outer = WriteBatch.current()
+        WriteBatch._local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        WriteBatch._local.batch = self._outer
+        if exc_type is not None:
+            self.rollback()
+        elif self._outer is not None:
+            for item in self._items.values():
+                self._outer.stage(item)
+        else:
+            self.flush()
+        return False
+
+    @property
+    def items(self):
+        return list(self._items.values())
+
+    def stage(self, item):
+        #  type: (DjItem) -> None
+        self._items[item.path] = item
+
+    def flush(self):
+        """Write the staged items, reloading from disk the ones left unwritten if a write fails.
+
+        With workers only the files are written in parallel: the new generations and the
+        suspect links of the written items are then updated in this thread.
+        """
+        items = [i for i in self._items.values() if i._exists]  # pylint: disable=protected-access
+        log.info("flushing {} staged items...".format(len(items)))
+        written = []
+        error = None  # type: Optional[BaseException]
+        if self._workers and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                futures = [(item, executor.submit(item._save)) for item in items]  # pylint: disable=protected-access
+            for item, future in futures:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    del self._items[item.path]
+                    if future.result():
+                        written.append(item)
+        else:
+            for item in items:
+                try:
+                    if item._save():  # pylint: disable=protected-access
+                        written.append(item)
+                except Exception as ex:  # pylint: disable=broad-except
+                    error = ex
+                    break
+                del self._items[item.path]
+        for item in written:
+            item._changed()  # pylint: disable=protected-access
+        if error is not None:
+            self.rollback()
+            raise error
+        self._items.clear()
+
+    def rollback(self):
+        for item in self._items.values():
+            if item._exists:  # pylint: disable=protected-access
+                item.load(reload=True)
+        self._items.clear()
+
+
+class SuspectLinks(object):
+    """Reverse links of a tree, used to keep the cleared state of the items up to date.
+
+    Built on the first item change of a tree from the links of all its items, then only
+    the entries of the changed item are updated. When an item changes its children are
+    checked right away against its new stamp, so reading `cleared` is a lookup instead
+    of hashing all the parents on every read.
+    """
+
+    def __init__(self, tree):
+        self._lock = threading.RLock()
+        self._children = {}  # type: Dict[str, Dict[str, DjItem]]
+        self._parents = {}  # type: Dict[str, Tuple[str, ...]]
+        for document in tree:
+            for item in document:
+                self._link(item)
+
+    @staticmethod
+    def of(tree):
+        #  type: (Any) -> SuspectLinks
+        links = getattr(tree, '_suspect_links', None)
+        if links is None:
+            links = tree._suspect_links = SuspectLinks(tree)  # pylint: disable=protected-access
+        return links
+
+    def _link(self, item):
+        #  type: (DjItem) -> None
+        uid = str(item.uid)
+        for parent in self._parents.pop(uid, ()):
+            self._children.get(parent, {}).pop(uid, None)
+        if not item._exists:  # pylint: disable=protected-access
+            return
+        parents = tuple(str(link) for link in item.links)
+        for parent in parents:
+            self._children.setdefault(parent, {})[uid] = item
+        self._parents[uid] = parents
+
+    def children(self, item):
+        #  type: (DjItem) -> List[DjItem]
+        with self._lock:
+            return list(self._children.get(str(item.uid), {}).values())
+
+    def changed(self, item):
+        #  type: (DjItem) -> None
+        """Record the new links of a changed (or deleted) item and recheck its children."""
+        with self._lock:
+            self._link(item)
+            children = list(self._children.get(str(item.uid), {}).values())
+        for child in children:
+            child.check_cleared()
+
+
 class DjReference(object):
     def __init__(self, _path, _type, _item):
         #  type: (str, str, DjItem) -> None
@@ -84,6 +253,24 @@ class DjItem(Item):
         super().__init__(document, path, root, **kwargs)
         self._data['deleted'] = DjItem.DEFAULT_DELETED
         self._data['pending'] = DjItem.DEFAULT_PENDING
+        self._generation = 0
+        self._written = False
+        self._stamps = {}  # type: Dict[bool, Tuple[int, Any]]
+        self._cleared = None  # type: Optional[bool]
+
+    def load(self, reload=False):
+        if self._loaded and not reload:
+            return
+        loaded = self._loaded
+        snapshot = snapshot_for(self.path)
+        data = snapshot.lookup(self.path) if snapshot else None
+        if data is None:
+            data = self._load(self._read(self.path), self.path)
+            if snapshot:
+                snapshot.store(self.path, data)
+        self._set_attributes(data)
+        self._loaded = True
+        self._changed(propagate=loaded)
 
     def _set_attributes(self, attributes):
         removed_keys = []
@@ -138,6 +325,99 @@ class DjItem(Item):
         """Set the item's active status."""
         self._data['pending'] = to_bool(value)
 
+    def save(self):
+        batch = WriteBatch.current()
+        if batch is not None:
+            # The generation is bumped when the batch writes the item, the stamps and the
+            # cleared state of the item and of its children change now
+            self._stamps = {}
+            self._cleared = None
+            batch.stage(self)
+            if self.tree is not None:
+                SuspectLinks.of(self.tree).changed(self)
+            return
+        if self._save():
+            self._changed()
+
+    def _save(self):
+        #  type: () -> bool
+        """Save the item without starting a new generation, True if the file was written."""
+        self._written = False
+        super().save()
+        return self._written
+
+    def delete(self, path=None):
+        super().delete(path)
+        self._changed()
+
+    @property
+    def generation(self):
+        #  type: () -> int
+        """Content generation, increased every time the item is loaded, written or deleted."""
+        return self._generation
+
+    def _changed(self, propagate=True):
+        #  type: (bool) -> None
+        """Start a new content generation: forget the stamps and recheck the items linking here."""
+        self._generation += 1
+        self._stamps = {}
+        self._cleared = None
+        if propagate and self.tree is not None:
+            SuspectLinks.of(self.tree).changed(self)
+
+    def deferred(self):
+        #  type: () -> WriteBatch
+        """Collapse the attribute changes made inside the block into a single write of the item."""
+        return WriteBatch()
+
+    def stamp(self, links=False):
+        cached = self._stamps.get(links)
+        if cached is not None and cached[0] == self._generation:
+            return cached[1]
+        stamp = super().stamp(links=links)
+        self._stamps[links] = (self._generation, stamp)
+        return stamp
+
+    @property
+    def cleared(self):
+        if self._cleared is None:
+            self._cleared = Item.cleared.fget(self)
+        return self._cleared
+
+    def check_cleared(self):
+        #  type: () -> bool
+        """Compare the link stamps with the current stamps of the parents, a parent changed."""
+        self._cleared = None
+        if self._exists:
+            return self.cleared
+        return False
+
+    @staticmethod
+    def _load(text, path, **kwargs):
+        return codec.load_yaml(text, path, **kwargs)
+
+    @staticmethod
+    def _dump(data):
+        return codec.dump_yaml(data)
+
+    def _write(self, text, path):
+        #  type: (str, str) -> bool
+        if not self._exists:
+            raise DoorstopError("cannot save to deleted: {}".format(self))
+        # Validation reformats (saves) every item it checks: unchanged files are not
+        # rewritten, so their stat, the caches keyed on it, the watcher and the item
+        # generation stay put
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                if f.read() == text:
+                    return False
+        except (FileNotFoundError, UnicodeDecodeError):
+            pass
+        write_atomic(text, path)
+        notify_write(path)
+        self._written = True
+        return True
+
     @property
     def references_list(self):
         references = []
@@ -203,6 +483,36 @@ class DjDocument(Document):
     def save(self):
         super().save()
 
+    def _load_with_include(self, yamlfile):
+        snapshot = snapshot_for(yamlfile)
+        data = snapshot.lookup(yamlfile) if snapshot else None
+        if data is None:
+            data = super()._load_with_include(yamlfile)
+            # Included files are not tracked by the snapshot
+            if snapshot and '!include' not in self._read(yamlfile):
+                snapshot.store(yamlfile, data)
+        return data
+
+    @staticmethod
+    def _load(text, path, **kwargs):
+        return codec.load_yaml(text, path, **kwargs)
+
+    @staticmethod
+    def _dump(data):
+        return codec.dump_yaml(data)
+
+    @staticmethod
+    def batch(workers=None):
+        #  type: (Optional[int]) -> WriteBatch
+        return WriteBatch(getattr(django_settings, 'DOORSTOP_WRITE_WORKERS', 0) if workers is None else workers)
+
+    def _write(self, text, path):
+        if not self._exists:
+            raise DoorstopError("cannot save to deleted: {}".format(self))
+        write_atomic(text, path)
+        # Document settings are only parsed when the tree is built
+        notify_write(path, reload=True)
+
     @property
     def foreign_fields2(self):
         #  type: () -> Dict[DjForeignField]
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from requirements.watcher import watcher_for
+
+_log = logging.getLogger(__name__)
+
+CONFIG = '.doorstop.yml'
+
+
+class ChangeFeed(object):
+    """Change events of a working directory, derived from the generations of its watcher.
+
+    Events are stamped with the wall clock time of the watcher scan that revealed them
+    and clients resume from the stamp (watermark) of the last answer, also when they
+    reconnect to another worker: an event may be received twice, never missed. The
+    document files are taken from the last scan of the watcher when its generation
+    changes.
+    """
+
+    MAX_EVENTS = 1024
+
+    def __init__(self, root):
+        #  type: (str) -> None
+        self._root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        self._generation = None  # type: Optional[int]
+        self._files = {}  # type: Dict[str, Tuple[int, int]]
+        self._prefixes = {}  # type: Dict[str, Tuple[Tuple[int, int], str]]
+        self._head = None  # type: Optional[str]
+        self._repository = None
+        self._since = 0
+        self._watermark = 0
+        self._events = []  # type: List[Tuple[int, Dict]]
+
+    def _prefix(self, dirpath, stat):
+        #  type: (str, Tuple[int, int]) -> str
+        cached = self._prefixes.get(dirpath)
+        if cached is not None and (cached[0] == stat or stat is None):
+            return cached[1]
+        from requirements.codec import load_yaml
+        prefix = os.path.basename(dirpath)
+        try:
+            with open(os.path.join(dirpath, CONFIG), 'r', encoding='utf-8') as f:
+                prefix = str(load_yaml(f.read()).get('settings', {}).get('prefix', prefix))
+        except Exception as ex:  # pylint: disable=broad-except
+            _log.warning('unable to read the prefix of %s: %s', dirpath, ex)
+        self._prefixes[dirpath] = (stat, prefix)
+        return prefix
+
+    @staticmethod
+    def _files(signature):
+        #  type: (Dict[str, Tuple[int, int]]) -> Dict[str, Tuple[int, int]]
+        # The watcher already stated the whole working tree: keep the files of the documents
+        documents = {os.path.dirname(path) for path in signature if os.path.basename(path) == CONFIG}
+        return {path: stat for path, stat in signature.items() if path.endswith('.yml') and os.path.dirname(path) in documents}
+
+    def _read_head(self):
+        #  type: () -> Optional[str]
+        import pygit2
+        try:
+            if self._repository is None:
+                self._repository = pygit2.Repository(self._root)
+            return str(self._repository.head.target)
+        except (pygit2.GitError, KeyError, ValueError):
+            return None
+
+    def _diff(self, files):
+        #  type: (Dict[str, Tuple[int, int]]) -> List[Dict]
+        events = []
+        for path in sorted(set(self._files) | set(files)):
+            old, new = self._files.get(path), files.get(path)
+            if old == new:
+                continue
+            dirpath, filename = os.path.split(path)
+            config = os.path.join(dirpath, CONFIG)
+            prefix = self._prefix(dirpath, files.get(config) or self._files.get(config))
+            if filename == CONFIG:
+                events.append({'type': 'document', 'document': prefix, 'change': 'modified' if new else 'deleted'})
+            else:
+                change = 'added' if old is None else 'deleted' if new is None else 'modified'
+                events.append({'type': 'item', 'document': prefix, 'uid': filename[:-len('.yml')], 'change': change})
+        return events
+
+    def _update(self):
+        watcher = watcher_for(self._root)
+        generation = watcher.poll()
+        head = self._read_head()
+        with self._lock:
+            if self._generation is None:
+                generation, self._since, signature = watcher.signature()
+                self._files = ChangeFeed._files(signature)
+                self._watermark = self._since
+            elif generation != self._generation or head != self._head:
+                # Writes of this process and commits do not rescan the watcher: its
+                # events need a newer watermark than the one already handed out
+                if watcher.scanned_ns <= self._watermark:
+                    watcher.poll(force=True)
+                generation, watermark, signature = watcher.signature()
+                events = []
+                if generation != self._generation:
+                    files = ChangeFeed._files(signature)
+                    events = self._diff(files)
+                    self._files = files
+                if head != self._head:
+                    events.append({'type': 'head', 'commit': head})
+                self._events.extend((watermark, event) for event in events)
+                if len(self._events) > ChangeFeed.MAX_EVENTS:
+                    dropped = len(self._events) - ChangeFeed.MAX_EVENTS
+                    self._since = self._events[dropped - 1][0]
+                    del self._events[:dropped]
+                self._watermark = watermark
+            else:
+                self._watermark = max(self._watermark, watcher.scanned_ns)
+            self._generation = generation
+            self._head = head
+
+    def since(self, watermark):
+        #  type: (int) -> (Optional[List[Dict]], int)
+        """Events after `watermark` and the new watermark; None when the events are no longer known."""
+        self._update()
+        with self._lock:
+            if watermark < self._since:
+                return None, self._watermark
+            return [event for detected, event in self._events if detected > watermark], self._watermark
+
+
+_feeds = {}  # type: Dict[str, ChangeFeed]
+_feeds_lock = threading.Lock()
+
+
+def change_feed(root):
+    #  type: (str) -> ChangeFeed
+    root = os.path.abspath(root)
+    with _feeds_lock:
+        feed = _feeds.get(root)
+        if feed is None:
+            feed = _feeds[root] = ChangeFeed(root)
+        return feed
@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from django.conf import settings
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:  # asgiref < 3.6, used with Django 3.1
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine  # pylint: disable=protected-access
+        return func
+
+DEFAULT_WORKERS = {'git': 4, 'export': 2, 'files': 8, 'events': 16}
+
+_executors = {}  # type: Dict[str, ThreadPoolExecutor]
+_lock = threading.Lock()
+
+
+def executor(name):
+    #  type: (str) -> ThreadPoolExecutor
+    """Thread pool for a kind of blocking work, sized by DOORSTOP_EXECUTOR_WORKERS."""
+    with _lock:
+        pool = _executors.get(name)
+        if pool is None:
+            workers = dict(DEFAULT_WORKERS, **getattr(settings, 'DOORSTOP_EXECUTOR_WORKERS', {}))
+            pool = _executors[name] = ThreadPoolExecutor(max_workers=workers.get(name, 4), thread_name_prefix='doorstop-' + name)
+        return pool
+
+
+async def run_in(name, func, *args, **kwargs):
+    #  type: (str, Callable, Any, Any) -> Any
+    """Run a blocking call in the named pool, keeping the context (request timings) of the caller."""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor(name), call)
+
+
+class AsyncViewMixin(object):
+    """Serve a class-based view from the event loop when deployed with ASGI.
+
+    The whole synchronous dispatch (login check, tree lookup, handler) runs in the
+    `executor` pool, so slow pygit2, openpyxl and file operations never block the loop
+    and at most as many requests as the pool has threads do them at the same time.
+    Must come before the other view classes in the bases.
+    """
+
+    executor = 'files'
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return markcoroutinefunction(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        return await run_in(self.executor, super().dispatch, request, *args, **kwargs)
@@ -9,9 +9,13 @@ from openpyxl.drawing.fill import SolidColorFillProperties
 from doorstop import Tree, Item
 from doorstop.core.document import Document
 
+from requirements.metrics import EXPORT_SECONDS, IMPORT_SECONDS
+from requirements.timing import timed
 
-def import_from_xslx(doc):
-    #  type: (Document) -> None
+
+@timed('import', IMPORT_SECONDS)
+def import_from_xslx(doc, xlsxfile='/tmp/import.xlsx'):
+    #  type: (Document, str) -> None
     fields = ['uid', 'header', 'text', 'level', 'parent', 'subsystem']
     field_indexes = [-1, -1, -1, -1, -1, -1]
 
@@ -27,7 +31,6 @@ def import_from_xslx(doc):
             return None
         return stripped
 
-    xlsxfile = '/tmp/import.xlsx'
     wb = load_workbook(xlsxfile)
     ws = wb.active
 
@@ -224,6 +227,7 @@ def export_to_xlsx(doc):
     return xlsxfile
 
 
+@timed('export', EXPORT_SECONDS)
 def export_full_xslx(tree):
     #  type: (Tree) -> str
     wb = Workbook()
@@ -1,8 +1,12 @@
+import copy
 import datetime
+import hashlib
+import json
 import os
+import threading
+from collections import OrderedDict
 from typing import Optional, List, Dict
 
-import yaml
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Row, Column, Hidden
 
@@ -15,9 +19,10 @@ from django_ace import AceWidget
 
 from doorstop import Document
 from doorstop.core import Item
-from doorstop.common import load_yaml
 from easymde.widgets import EasyMDEEditor
 
+from requirements.codec import load_yaml, dump_yaml
+
 
 class VirtualItem(object):
     def __init__(self, item=None, fields=None):
@@ -69,10 +74,11 @@ class ItemCommentForm(forms.Form):
 
     def save(self, item):
         # type: (Item) -> None
-        comments = item.get('comments', [])
-        comments.insert(0, {'date': self.cleaned_data['date'], 'author': self.cleaned_data['author'], 'text': self.cleaned_data['text']})
-        item.set('comments', comments)
-        item.save()
+        with item.deferred():
+            comments = item.get('comments', [])
+            comments.insert(0, {'date': self.cleaned_data['date'], 'author': self.cleaned_data['author'], 'text': self.cleaned_data['text']})
+            item.set('comments', comments)
+            item.save()
 
 
 class DocumentSourceForm(forms.Form):
@@ -157,7 +163,7 @@ class DocumentUpdateForm(forms.Form):
             with open(doc.config, 'r') as stream:
                 yaml_data = load_yaml(stream, doc.config)
                 if 'attributes' in yaml_data:
-                    initial_data['yaml'] = yaml.dump(yaml_data['attributes'])
+                    initial_data['yaml'] = dump_yaml(yaml_data['attributes'])
 
         if post is not None:
             initial_data['sep'] = post['sep']
@@ -183,10 +189,11 @@ class DocumentUpdateForm(forms.Form):
         self._doc.save()
         with open(self._doc.config, 'r') as stream:
             yaml_data = load_yaml(stream, self._doc.config)
-            yaml_data_new = yaml.safe_load(self.cleaned_data['yaml'])
+            yaml_data_new = load_yaml(self.cleaned_data['yaml'])
             yaml_data['attributes'] = yaml_data_new
             text = self._doc._dump(yaml_data)
             self._doc._write(text, self._doc.config)
+        ForeignFieldSet.invalidate(self._doc)
 
 
 class ItemRawEditForm(forms.Form):
@@ -201,6 +208,101 @@ class ItemRawEditForm(forms.Form):
 
     def save(self):
         self._item._write(self.cleaned_data['yaml'], self._item.path)
+        self._item.load(reload=True)
+
+
+class ForeignFieldSet(object):
+    """Form fields and layout columns of the foreign fields of a document.
+
+    Sorting the choices and creating the fields is done once per configuration: the
+    sets are cached by a digest of the foreign fields of the document. Like the base
+    fields of a form class, the cached fields are copied into every form, but the
+    choices (immutable tuples) are shared instead of being deep copied.
+    """
+
+    MAX_ENTRIES = 64
+
+    _cache = OrderedDict()  # type: Dict[str, ForeignFieldSet]
+    _lock = threading.Lock()
+
+    def __init__(self, config):
+        #  type: (Dict) -> None
+        self.fields = OrderedDict()  # type: Dict[str, forms.Field]
+        self.types = []  # type: List[tuple]
+        self._seps = {}  # type: Dict[str, str]
+        for name, field in config.items():
+            _type = field['type']
+            if _type == 'multi' or _type == 'single':
+                choices = tuple(sorted(field.get('choices', {}).items()))
+                field_class = forms.MultipleChoiceField if _type == 'multi' else forms.ChoiceField
+                self.fields[name] = field_class(choices=choices, required=False)
+            elif _type == 'flat' or _type == 'string':
+                self.fields[name] = forms.CharField(required=False)
+                self._seps[name] = field.get('sep', ';')
+            else:
+                continue
+            self.types.append((_type, name))
+        self.layout = tuple(Column(name, css_class='form-group col-md-6 mb-0') for _type, name in self.types)
+
+    def copy_fields(self):
+        #  type: () -> Dict[str, forms.Field]
+        # Field.__deepcopy__ without the deep copy of the choices of ChoiceField
+        fields = OrderedDict()
+        for name, field in self.fields.items():
+            result = copy.copy(field)
+            result.widget = copy.copy(field.widget)
+            result.widget.attrs = field.widget.attrs.copy()
+            result.validators = field.validators[:]
+            result.error_messages = field.error_messages.copy()
+            fields[name] = result
+        return fields
+
+    def initial(self, item):
+        #  type: (Optional[Item]) -> Dict
+        initial = {}
+        for _type, name in self.types:
+            if _type == 'flat':
+                initial[name] = self._seps[name].join(item.get(name) or []) if item else None
+            elif _type == 'string':
+                initial[name] = item.get(name) if item else ''
+            else:
+                initial[name] = item.get(name) if item else None
+        return initial
+
+    @staticmethod
+    def digest(doc):
+        #  type: (Document) -> str
+        digest = getattr(doc, '_foreign_fields_digest', None)
+        if digest is None:
+            config = json.dumps(doc.forgein_fields or {}, sort_keys=True, default=str)
+            digest = doc._foreign_fields_digest = hashlib.sha1(config.encode('utf-8')).hexdigest()
+        return digest
+
+    @staticmethod
+    def for_document(doc):
+        #  type: (Document) -> ForeignFieldSet
+        digest = ForeignFieldSet.digest(doc)
+        with ForeignFieldSet._lock:
+            foreign = ForeignFieldSet._cache.get(digest)
+            if foreign is not None:
+                ForeignFieldSet._cache.move_to_end(digest)
+                return foreign
+        foreign = ForeignFieldSet(doc.forgein_fields or {})
+        with ForeignFieldSet._lock:
+            ForeignFieldSet._cache[digest] = foreign
+            while len(ForeignFieldSet._cache) > ForeignFieldSet.MAX_ENTRIES:
+                ForeignFieldSet._cache.popitem(last=False)
+        return foreign
+
+    @staticmethod
+    def invalidate(doc):
+        #  type: (Document) -> None
+        """Forget the fields of a document whose configuration changed."""
+        digest = getattr(doc, '_foreign_fields_digest', None)
+        if digest is not None:
+            del doc._foreign_fields_digest
+            with ForeignFieldSet._lock:
+                ForeignFieldSet._cache.pop(digest, None)
 
 
 class ItemUpdateForm(forms.Form):
@@ -213,65 +315,14 @@ class ItemUpdateForm(forms.Form):
     pending = forms.BooleanField(required=False)
     attach = forms.FileField(required=False, label='Attach file', help_text='Load attachment file')
 
-    def init_foreign_string(self, name, field):
-        initial = self._item.get(name) if self._item else ''
-        self.fields[name] = forms.CharField(initial=initial, required=False)
-        self._foreign_fields.append((field['type'], name))
-
-    def init_foreign_flat_array(self, name, field):
-        sep = field['sep'] if 'sep' in field else ';'
-        initial = sep.join(self._item.get(name)) if self._item else None
-        self.fields[name] = forms.CharField(initial=initial, required=False)
-        self._foreign_fields.append((field['type'], name))
-
-    def init_foreign_multi_choice(self, name, field):
-        vv = []
-        if 'choices' in field:
-            for k in field['choices']:
-                vv.append((k, field['choices'][k],))
-        initial = self._item.get(name) if self._item else None
-        self.fields[name] = forms.MultipleChoiceField(choices=tuple(sorted(vv)), initial=initial, required=False)
-        self._foreign_fields.append((field['type'], name))
-
-    def init_foreign_single_choice(self, name, field):
-        vv = []
-        if 'choices' in field:
-            for k in field['choices']:
-                vv.append((k, field['choices'][k],))
-        initial = self._item.get(name) if self._item else None
-        self.fields[name] = forms.ChoiceField(choices=tuple(sorted(vv)), initial=initial, required=False)
-        self._foreign_fields.append((field['type'], name))
-
-    def init_foreign_fields(self):
-        ff = self._doc.forgein_fields
-        if not ff:
-            return tuple([])
-
-        for ff_name in ff:
-            ff_item = ff[ff_name]
-            print(ff_name, ff_item['type'])
-            if ff_item['type'] == 'multi':
-                self.init_foreign_multi_choice(ff_name, ff_item)
-            elif ff_item['type'] == 'single':
-                self.init_foreign_single_choice(ff_name, ff_item)
-            elif ff_item['type'] == 'flat':
-                self.init_foreign_flat_array(ff_name, ff_item)
-            elif ff_item['type'] == 'string':
-                self.init_foreign_string(ff_name, ff_item)
-        vv = []
-        if len(self._foreign_fields) > 0:
-            for ff_type, ff_name in self._foreign_fields:
-                vv.append(Column(ff_name, css_class='form-group col-md-6 mb-0'))
-
-        return tuple(vv)
-
     def __init__(self, data=None, item=None, doc=None, from_item=None):
         # type: (Optional[QueryDict], Optional[Item], Optional[Document], Optional[Item]) -> None
         self._item = item  # type: Optional[Item]
         self._doc = doc  # type: Optional[Document]
         if self._doc is None and self._item is not None:
             self._doc = self._item.document
-        self._foreign_fields = []  # type: List[tuple]
+        foreign = ForeignFieldSet.for_document(self._doc)
+        self._foreign_fields = foreign.types  # type: List[tuple]
 
         initial_data = None
         if item is not None and data is None:
@@ -279,7 +330,10 @@ class ItemUpdateForm(forms.Form):
                             'pending': item.pending}
 
         super().__init__(data=data, initial=initial_data)
-        layout = self.init_foreign_fields()
+        # Forms change their fields (widget attributes), never share them
+        self.fields.update(foreign.copy_fields())
+        if data is None:
+            self.initial.update(foreign.initial(self._item))
 
         self.helper = FormHelper(self)
         if item is not None:
@@ -295,7 +349,7 @@ class ItemUpdateForm(forms.Form):
             ),
             'text',
             'attach',
-            Row(*layout, css_class='form-row'),
+            Row(*copy.deepcopy(foreign.layout), css_class='form-row'),
             Submit('submit', 'Submit')
         )
 
@@ -304,20 +358,21 @@ class ItemUpdateForm(forms.Form):
         if not self._item:
             self._item = self._doc.add_item()
             self.helper.form_action = reverse('item-update', args=(self._doc.prefix, self._item.uid))
-        if self.cleaned_data['level']:
-            self._item.level = self.cleaned_data['level']
-        self._item.header = self.cleaned_data['header']
-        self._item.text = self.cleaned_data['text']
-        self._item.normative = self.cleaned_data['normative']
-        self._item.pending = self.cleaned_data['pending']
-
-        for _type, name in self._foreign_fields:
-            if _type == 'multi' or _type == 'string' or _type == 'single':
-                self._item.set(name, self.cleaned_data[name])
-            elif _type == 'flat':
-                self._item.set(name, self.cleaned_data[name].split(','))
-
-        self._item.save()
+        with self._item.deferred():
+            if self.cleaned_data['level']:
+                self._item.level = self.cleaned_data['level']
+            self._item.header = self.cleaned_data['header']
+            self._item.text = self.cleaned_data['text']
+            self._item.normative = self.cleaned_data['normative']
+            self._item.pending = self.cleaned_data['pending']
+
+            for _type, name in self._foreign_fields:
+                if _type == 'multi' or _type == 'string' or _type == 'single':
+                    self._item.set(name, self.cleaned_data[name])
+                elif _type == 'flat':
+                    self._item.set(name, self.cleaned_data[name].split(','))
+
+            self._item.save()
         return self._item
 
 
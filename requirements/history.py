@@ -0,0 +1,167 @@
+import datetime
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+import pygit2
+from pygit2 import Repository, Commit, GIT_SORT_TOPOLOGICAL, GIT_SORT_TIME
+
+_log = logging.getLogger(__name__)
+
+
+class HistoryRecord(object):
+    def __init__(self, commit_id, author, email, time, summary):
+        #  type: (str, str, str, int, str) -> None
+        self.commit_id = commit_id
+        self.author = author
+        self.email = email
+        self.time = time
+        self.summary = summary
+
+    @property
+    def short_id(self):
+        return self.commit_id[:8]
+
+    @property
+    def date(self):
+        #  type: () -> datetime.datetime
+        return datetime.datetime.fromtimestamp(self.time, tz=datetime.timezone.utc)
+
+
+class HistoryIndex(object):
+    """Persisted map from item file paths to the commits that touched them.
+
+    The index remembers the last indexed HEAD; updating it only walks the commits
+    added after that one. Paths are relative to the working directory and only
+    YAML files are indexed.
+    """
+
+    VERSION = 1
+    EXTENSIONS = ('.yml', '.yaml')
+
+    def __init__(self, root, filename):
+        #  type: (str, str) -> None
+        self._root = root
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._head = None  # type: Optional[str]
+        self._commits = {}  # type: Dict[str, list]
+        self._paths = {}  # type: Dict[str, List[str]]
+        self._mtime = None
+        self._read()
+
+    @property
+    def root(self):
+        return self._root
+
+    def _read(self):
+        try:
+            mtime = os.stat(self._filename).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self._filename, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != HistoryIndex.VERSION:
+            return
+        self._head = data['head']
+        self._commits = data['commits']
+        self._paths = data['paths']
+        self._mtime = mtime
+
+    def _write(self):
+        data = {'version': HistoryIndex.VERSION, 'head': self._head, 'commits': self._commits, 'paths': self._paths}
+        tmpname = f'{self._filename}.{os.getpid()}.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmpname, self._filename)
+        self._mtime = os.stat(self._filename).st_mtime_ns
+
+    @staticmethod
+    def _changed_paths(commit):
+        #  type: (Commit) -> List[str]
+        if commit.parents:
+            diff = commit.parents[0].tree.diff_to_tree(commit.tree)
+        else:
+            diff = commit.tree.diff_to_tree(swap=True)
+        paths = set()
+        for delta in diff.deltas:
+            for path in (delta.old_file.path, delta.new_file.path):
+                if path and path.endswith(HistoryIndex.EXTENSIONS):
+                    paths.add(path)
+        return sorted(paths)
+
+    def update(self, repo):
+        #  type: (Repository) -> bool
+        """Index the commits reachable from HEAD that were not indexed yet."""
+        with self._lock:
+            self._read()
+            try:
+                head = repo.head.target
+            except pygit2.GitError:
+                return False  # empty repository
+            if self._head == str(head):
+                return False
+            walker = repo.walk(head, GIT_SORT_TOPOLOGICAL | GIT_SORT_TIME)
+            if self._head is not None:
+                old_head = pygit2.Oid(hex=self._head)
+                if old_head in repo and repo.descendant_of(head, old_head):
+                    walker.hide(old_head)
+                else:
+                    _log.info('history of %s was rewritten, rebuilding the index', self.root)
+                    self._commits = {}
+                    self._paths = {}
+            new_paths = {}  # type: Dict[str, List[str]]
+            count = 0
+            for commit in walker:
+                commit_id = str(commit.id)
+                if commit_id in self._commits:
+                    continue
+                self._commits[commit_id] = [commit.author.name, commit.author.email, commit.commit_time,
+                                            commit.message.partition('\n')[0]]
+                for path in HistoryIndex._changed_paths(commit):
+                    new_paths.setdefault(path, []).append(commit_id)
+                count += 1
+            for path, commits in new_paths.items():
+                self._paths[path] = commits + self._paths.get(path, [])
+            self._head = str(head)
+            _log.debug('indexed %d new commits of %s', count, self.root)
+            self._write()
+            return True
+
+    def _record(self, commit_id):
+        #  type: (str) -> HistoryRecord
+        return HistoryRecord(commit_id, *self._commits[commit_id])
+
+    def relpath(self, path):
+        #  type: (str) -> str
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.root)
+        return path.replace(os.sep, '/')
+
+    def history(self, path):
+        #  type: (str) -> List[HistoryRecord]
+        """Commits that touched `path`, newest first."""
+        return [self._record(c) for c in self._paths.get(self.relpath(path), [])]
+
+    def last_change(self, path):
+        #  type: (str) -> Optional[HistoryRecord]
+        commits = self._paths.get(self.relpath(path))
+        return self._record(commits[0]) if commits else None
+
+
+_indexes = {}  # type: Dict[str, HistoryIndex]
+_indexes_lock = threading.Lock()
+
+
+def history_index(repo, filename):
+    #  type: (Repository, str) -> HistoryIndex
+    with _indexes_lock:
+        index = _indexes.get(filename)
+        if index is None or index.root != repo.workdir:
+            index = _indexes[filename] = HistoryIndex(repo.workdir, filename)
+    index.update(repo)
+    return index
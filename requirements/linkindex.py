@@ -0,0 +1,291 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from doorstop import Tree, Item
+
+from requirements.watcher import watcher_for
+
+_log = logging.getLogger(__name__)
+
+
+class LinkRecord(object):
+    ACTIVE = 0x01
+    DERIVED = 0x02
+    NORMATIVE = 0x04
+    DELETED = 0x08
+    PENDING = 0x10
+
+    def __init__(self, uid, prefix, path, level, header, flags):
+        #  type: (str, str, str, str, str, int) -> None
+        self.uid = uid
+        self.prefix = prefix
+        self.path = path
+        self.level = level
+        self.header = header
+        self.flags = flags
+
+    @property
+    def active(self):
+        return bool(self.flags & LinkRecord.ACTIVE)
+
+    @property
+    def deleted(self):
+        return bool(self.flags & LinkRecord.DELETED)
+
+    @staticmethod
+    def item_flags(item):
+        #  type: (Item) -> int
+        flags = 0
+        for attr, flag in (('active', LinkRecord.ACTIVE), ('derived', LinkRecord.DERIVED), ('normative', LinkRecord.NORMATIVE),
+                           ('deleted', LinkRecord.DELETED), ('pending', LinkRecord.PENDING)):
+            if getattr(item, attr, False):
+                flags |= flag
+        return flags
+
+
+class LinkIndex(object):
+    """Read-only view of the item metadata and link adjacency of a tree, memory mapped from a file.
+
+    The file holds a header, one fixed-width record per item sorted by UID, the arrays
+    of parent and child record numbers and a packed UTF-8 string table. All the worker
+    processes map the same file, so its pages are shared instead of being copied in
+    every process.
+
+    Only the child item lookups of the item pages are served from it. Every worker still
+    keeps its own parsed tree for the tables and the edits, so the index does not bring
+    the per-worker memory down; it saves the scan of the child documents.
+    """
+
+    MAGIC = b'DJLI'
+    VERSION = 1
+    # magic, version, generation, signature, items, links, children
+    HEADER = struct.Struct('<4sIQ20sIII')
+    # uid, prefix, path, level, header (offset and length in the string table), links, children (start and count), flags
+    RECORD = struct.Struct('<IIIIIIIIIIIIIIB3x')
+    INDEX = struct.Struct('<I')
+
+    def __init__(self, filename):
+        #  type: (str) -> None
+        self._filename = filename
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.generation, self.signature, self._count, links, children = LinkIndex.HEADER.unpack_from(self._mm, 0)
+        if magic != LinkIndex.MAGIC or version != LinkIndex.VERSION:
+            self._mm.close()
+            raise ValueError('invalid link index {}'.format(filename))
+        self._records = LinkIndex.HEADER.size
+        self._links = self._records + self._count * LinkIndex.RECORD.size
+        self._children = self._links + links * LinkIndex.INDEX.size
+        self._strings = self._children + children * LinkIndex.INDEX.size
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mm.close()
+
+    def _string(self, offset, length):
+        #  type: (int, int) -> str
+        start = self._strings + offset
+        return self._mm[start:start + length].decode('utf-8')
+
+    def _record(self, index):
+        #  type: (int) -> Tuple
+        return LinkIndex.RECORD.unpack_from(self._mm, self._records + index * LinkIndex.RECORD.size)
+
+    def _uid(self, index):
+        #  type: (int) -> str
+        record = self._record(index)
+        return self._string(record[0], record[1])
+
+    def _find(self, uid):
+        #  type: (str) -> int
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._uid(middle) < uid:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < self._count and self._uid(low) == uid else -1
+
+    def _array(self, base, start, count):
+        #  type: (int, int, int) -> List[LinkRecord]
+        return [self._item(LinkIndex.INDEX.unpack_from(self._mm, base + (start + i) * LinkIndex.INDEX.size)[0]) for i in range(count)]
+
+    def _item(self, index):
+        #  type: (int) -> LinkRecord
+        r = self._record(index)
+        return LinkRecord(self._string(r[0], r[1]), self._string(r[2], r[3]), self._string(r[4], r[5]), self._string(r[6], r[7]),
+                          self._string(r[8], r[9]), r[14])
+
+    def item(self, uid):
+        #  type: (str) -> Optional[LinkRecord]
+        index = self._find(str(uid))
+        return self._item(index) if index >= 0 else None
+
+    def parents(self, uid):
+        #  type: (str) -> List[LinkRecord]
+        """Items linked by an item, the ones missing from the tree are left out."""
+        index = self._find(str(uid))
+        if index < 0:
+            return []
+        record = self._record(index)
+        return self._array(self._links, record[10], record[11])
+
+    def children(self, uid):
+        #  type: (str) -> List[LinkRecord]
+        """Items of the child documents linking to an item, in tree order."""
+        index = self._find(str(uid))
+        if index < 0:
+            return []
+        record = self._record(index)
+        return self._array(self._children, record[12], record[13])
+
+    @staticmethod
+    def signature(tree, stats):
+        #  type: (Tree, Dict[str, Tuple[int, int]]) -> bytes
+        """Digest of the path, size and modification time of the files of a tree.
+
+        `stats` maps the paths to their (mtime, size) as last scanned by the repository
+        watcher, so no file is stated again.
+        """
+        digest = hashlib.sha1()
+        paths = []
+        for document in tree:
+            paths.append(document.config)
+            paths.extend(item.path for item in document)
+        for path in sorted(paths):
+            stat = stats.get(os.path.abspath(path))
+            if stat is None:
+                continue
+            digest.update('{}\0{}\0{}\n'.format(path, stat[1], stat[0]).encode('utf-8'))
+        return digest.digest()
+
+    @staticmethod
+    def write(tree, filename, signature):
+        #  type: (Tree, str, bytes) -> None
+        from requirements.djdoorstop import write_atomic
+        items = sorted((item for document in tree for item in document), key=lambda i: str(i.uid))
+        numbers = {str(item.uid): n for n, item in enumerate(items)}
+        children = {}  # type: Dict[str, List[int]]
+        for document in tree:
+            if not document.parent:
+                continue
+            for item in document:
+                for uid in item.links:
+                    children.setdefault(str(uid), []).append(numbers[str(item.uid)])
+
+        strings = bytearray()
+        offsets = {}  # type: Dict[str, Tuple[int, int]]
+
+        def string(value):
+            value = str(value or '')
+            if value not in offsets:
+                encoded = value.encode('utf-8')
+                offsets[value] = (len(strings), len(encoded))
+                strings.extend(encoded)
+            return offsets[value]
+
+        records = bytearray()
+        links = []  # type: List[int]
+        childs = []  # type: List[int]
+        for item in items:
+            uid = str(item.uid)
+            parents = [numbers[str(u)] for u in item.links if str(u) in numbers]
+            # Only the child documents of the item's document are searched, like doorstop does
+            kids = [n for n in children.get(uid, []) if items[n].document.parent == item.document.prefix]
+            fields = string(uid) + string(item.document.prefix) + string(os.path.relpath(item.path, tree.root)) + \
+                string(item.level) + string(item.header) + (len(links), len(parents), len(childs), len(kids), LinkRecord.item_flags(item))
+            records.extend(LinkIndex.RECORD.pack(*fields))
+            links.extend(parents)
+            childs.extend(kids)
+
+        header = LinkIndex.HEADER.pack(LinkIndex.MAGIC, LinkIndex.VERSION, time.time_ns(), signature, len(items), len(links), len(childs))
+        data = header + bytes(records) + struct.pack('<{}I'.format(len(links)), *links) + \
+            struct.pack('<{}I'.format(len(childs)), *childs) + bytes(strings)
+        write_atomic(data, filename)
+
+
+class LinkIndexCache(object):
+    """Link indexes mapped by the worker, one per working directory.
+
+    An index is checked again only when the repository watcher generation changes, against
+    the file stats of the watcher's last scan. When the file on disk does not match the
+    tree it is rebuilt by the first worker taking the lock and replaced atomically; the
+    other workers map the new file.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # type: Dict[str, Tuple[int, LinkIndex]]
+
+    @staticmethod
+    def filename(root):
+        #  type: (str) -> str
+        from requirements.utils import cache_root
+        name = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+        return os.path.join(cache_root(), 'linkindex', name + '.idx')
+
+    @staticmethod
+    def _open(filename, signature):
+        #  type: (str, bytes) -> Optional[LinkIndex]
+        try:
+            index = LinkIndex(filename)
+        except (OSError, ValueError, struct.error):
+            return None
+        if index.signature != signature:
+            index.close()
+            return None
+        return index
+
+    def _load(self, root, tree):
+        #  type: (str, Tree) -> LinkIndex
+        filename = LinkIndexCache.filename(root)
+        _generation, _scanned_ns, stats = watcher_for(root).signature()
+        signature = LinkIndex.signature(tree, stats)
+        index = LinkIndexCache._open(filename, signature)
+        if index is not None:
+            return index
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another worker may have written it while we were waiting
+                index = LinkIndexCache._open(filename, signature)
+                if index is None:
+                    _log.info('writing link index of %s', root)
+                    LinkIndex.write(tree, filename, signature)
+                    index = LinkIndex(filename)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return index
+
+    def get(self, root, tree):
+        #  type: (str, Tree) -> LinkIndex
+        root = os.path.abspath(root)
+        generation = watcher_for(root).poll()
+        with self._lock:
+            entry = self._entries.get(root)
+            if entry is not None and entry[0] == generation:
+                return entry[1]
+            index = self._load(root, tree)
+            # The old mapping stays valid for the readers still holding it
+            self._entries[root] = (generation, index)
+            return index
+
+
+def use_link_index():
+    #  type: () -> bool
+    return getattr(settings, 'DOORSTOP_LINK_INDEX', True)
+
+
+link_index_cache = LinkIndexCache()
@@ -0,0 +1,82 @@
+import subprocess
+import sys
+from typing import List, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class ImportRecord(object):
+    def __init__(self, name, self_us, cumulative_us, depth):
+        #  type: (str, int, int, int) -> None
+        self.name = name
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+        self.depth = depth
+
+
+def parse_importtime(text):
+    #  type: (str) -> List[ImportRecord]
+    """Records of the `-X importtime` output, in the order they were printed (children first)."""
+    records = []
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        records.append(ImportRecord(name.strip(), int(parts[0]), int(parts[1]), depth))
+    return records
+
+
+def subtree(records, module):
+    #  type: (List[ImportRecord], str) -> Tuple[ImportRecord, List[ImportRecord]]
+    """The record of `module` and the records of the modules it imported first."""
+    for i, record in enumerate(records):
+        if record.name == module:
+            children = []
+            for child in reversed(records[:i]):
+                if child.depth <= record.depth:
+                    break
+                children.append(child)
+            return record, children
+    raise CommandError('{} was not imported (already loaded by django.setup()?)'.format(module))
+
+
+class Command(BaseCommand):
+    help = 'Report the import time of a module measured with python -X importtime in a new interpreter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('module', nargs='?', default='requirements.urls')
+        parser.add_argument('--top', type=int, default=15, help='number of imports listed')
+        parser.add_argument('--rounds', type=int, default=5, help='interpreters started, the fastest one is reported')
+        parser.add_argument('--max-ms', type=float, help='fail when the cumulative import time exceeds this value')
+
+    def _measure(self, module):
+        #  type: (str) -> Tuple[ImportRecord, List[ImportRecord]]
+        code = 'import django; django.setup(); import {}'.format(module)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise CommandError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed')
+        return subtree(parse_importtime(result.stderr), module)
+
+    def handle(self, *args, **options):
+        module = options['module']
+        best = None
+        for _ in range(max(1, options['rounds'])):
+            measure = self._measure(module)
+            if best is None or measure[0].cumulative_us < best[0].cumulative_us:
+                best = measure
+        record, children = best
+        self.stdout.write('{}: {:.1f} ms ({} modules loaded)'.format(module, record.cumulative_us / 1000, len(children) + 1))
+        self.stdout.write('{:>10} {:>10}  {}'.format('self ms', 'total ms', 'module'))
+        for child in sorted(children, key=lambda c: c.cumulative_us, reverse=True)[:options['top']]:
+            self.stdout.write('{:>10.1f} {:>10.1f}  {}{}'.format(child.self_us / 1000, child.cumulative_us / 1000,
+                                                              '  ' * (child.depth - record.depth - 1), child.name))
+        heaviest = sorted(children, key=lambda c: c.self_us, reverse=True)[:options['top']]
+        self.stdout.write('heaviest modules: ' + ', '.join('{} {:.1f} ms'.format(c.name, c.self_us / 1000) for c in heaviest))
+        if options['max_ms'] is not None and record.cumulative_us / 1000 > options['max_ms']:
+            raise CommandError('importing {} took {:.1f} ms, more than {:.1f} ms'.format(
+                module, record.cumulative_us / 1000, options['max_ms']))
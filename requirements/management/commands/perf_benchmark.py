@@ -0,0 +1,139 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from doorstop.core.builder import build
+from openpyxl import Workbook
+
+from requirements.management.commands.synthetic_repository import add_generator_arguments, generator_options
+from requirements.synthetic import generate_repository
+from requirements.treecache import tree_cache
+from requirements.views import IndexView, ItemDetailView, DocumentIssesView, GrpahDataView
+
+
+class Command(BaseCommand):
+    help = 'Time tree building, the main views and the spreadsheet export/import on synthetic trees of several sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='100,1000', help='comma separated items per document')
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--output', help='write the results as JSON to this file')
+        parser.add_argument('--only', help='comma separated benchmarks to run')
+        parser.add_argument('--keep', action='store_true', help='keep the generated trees')
+        add_generator_arguments(parser)
+
+    def _time(self, func, rounds, setup=None):
+        #  type: (Callable, int, Callable) -> Dict
+        timings = []
+        for _ in range(rounds):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return {'rounds': rounds, 'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.mean(timings)}
+
+    @staticmethod
+    def _request(view, name, user, **kwargs):
+        request = RequestFactory().get(reverse(name, kwargs=kwargs))
+        request.user = user
+
+        def run():
+            response = view.as_view()(request, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            if response.status_code != 200:
+                raise CommandError('{} answered {}'.format(name, response.status_code))
+        return run
+
+    @staticmethod
+    def _import_file(doc, filename):
+        wb = Workbook()
+        ws = wb.active
+        ws.append(['uid', 'header', 'text', 'level', 'parent', 'subsystem'])
+        for item in doc.items:
+            ws.append([str(item.uid), item.header, item.text, str(item.level), None, item.get('subsystem')])
+        wb.save(filename)
+
+    def _benchmarks(self, root, user):
+        #  type: (str, User) -> Dict[str, Dict]
+        from requirements.export import export_full_xslx, import_from_xslx
+
+        tree = tree_cache.get(root)
+        docs = list(tree)
+        doc, child = docs[0], docs[-1]
+        item = list(child)[len(child) // 2]
+        xlsxfile = os.path.join(root, '.git', 'import.xlsx')
+        self._import_file(child, xlsxfile)
+
+        def build_tree():
+            for document in build(root=root):
+                for _item in document:
+                    _item.load()
+
+        return {
+            'tree_build': {'func': build_tree},
+            'document_iter': {'func': lambda: list(child._iter(reload=True))},
+            'index_view': {'func': self._request(IndexView, 'index-doc', user, doc=child.prefix)},
+            'item_detail_view': {'func': self._request(ItemDetailView, 'item-details', user, doc=child.prefix, item=str(item.uid))},
+            'issues_view': {'func': self._request(DocumentIssesView, 'issues', user)},
+            'graph_data_view': {'func': self._request(GrpahDataView, 'graph-data', user, doc=doc.prefix)},
+            'export_full_xslx': {'func': lambda: export_full_xslx(tree)},
+            'import_from_xslx': {'func': lambda: import_from_xslx(child, xlsxfile)},
+        }
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(s) for s in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError('invalid scales {}'.format(options['scales']))
+        only = set(options['only'].split(',')) if options['only'] else None
+        user = User(username='benchmark', is_active=True, is_superuser=True)
+        results = []  # type: List[Dict]
+        for scale in scales:
+            workdir = tempfile.mkdtemp(prefix='doorstop-benchmark-')
+            root = os.path.join(workdir, 'repo')
+            try:
+                start = time.perf_counter()
+                generate_repository(root, items=scale, **generator_options(options))
+                self.stdout.write('scale {}: tree generated in {:.1f} s'.format(scale, time.perf_counter() - start))
+                with override_settings(DOORSTOP_REPO=root, DOORSTOP_USER_WORKTREES=False,
+                                       DOORSTOP_CACHE_DIR=os.path.join(workdir, 'cache')):
+                    tree_cache.invalidate()
+                    for name, benchmark in self._benchmarks(root, user).items():
+                        if only is not None and name not in only:
+                            continue
+                        result = self._time(benchmark['func'], options['rounds'])
+                        result.update({'benchmark': name, 'items_per_document': scale, 'documents': options['documents'],
+                                       'items': scale * options['documents']})
+                        results.append(result)
+                        self.stdout.write('  {:<20} {:>10.1f} ms'.format(name, result['median'] * 1000))
+                    tree_cache.invalidate()
+            finally:
+                if options['keep']:
+                    self.stdout.write('  tree kept in {}'.format(root))
+                else:
+                    shutil.rmtree(workdir, ignore_errors=True)
+
+        report = {
+            'environment': {'python': sys.version.split()[0], 'django': django.get_version(), 'platform': platform.platform(),
+                            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'generator': dict(generator_options(options)),
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
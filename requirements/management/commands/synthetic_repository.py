@@ -0,0 +1,36 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from requirements.synthetic import generate_repository
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--documents', type=int, default=3, help='documents in the chain')
+    parser.add_argument('--links', type=float, default=1.0, help='average links to the parent document per item')
+    parser.add_argument('--foreign-fields', type=int, default=2, help='foreign fields per document')
+    parser.add_argument('--comments', type=float, default=0.2, help='fraction of items with comments')
+    parser.add_argument('--attachments', type=float, default=0.05, help='fraction of items with an attached file')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def generator_options(options):
+    return {'documents': options['documents'], 'link_density': options['links'], 'foreign_fields': options['foreign_fields'],
+            'comments': options['comments'], 'attachments': options['attachments'], 'seed': options['seed']}
+
+
+class Command(BaseCommand):
+    help = 'Write a reproducible synthetic doorstop tree in a new git repository'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--items', type=int, default=100, help='items per document')
+        parser.add_argument('--no-commit', action='store_true', help='do not create a git repository')
+        add_generator_arguments(parser)
+
+    def handle(self, *args, **options):
+        path = os.path.abspath(options['path'])
+        if os.path.exists(path) and os.listdir(path):
+            raise CommandError('{} is not empty'.format(path))
+        generate_repository(path, items=options['items'], commit=not options['no_commit'], **generator_options(options))
+        self.stdout.write('{} items written to {}'.format(options['items'] * options['documents'], path))
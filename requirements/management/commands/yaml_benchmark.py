@@ -0,0 +1,90 @@
+import glob
+import os
+import random
+import time
+from typing import Callable, Dict, List
+
+import yaml
+from django.core.management.base import BaseCommand, CommandError
+from doorstop.core.types import Text
+
+from requirements import codec
+
+
+def synthetic_item(index, rnd):
+    #  type: (int, random.Random) -> Dict
+    """Item data as DjItem dumps it, with literal text blocks, links and comments."""
+    words = ['shall', 'system', 'requirement', 'value', 'signal', 'timeout', 'user', 'interface', 'état', 'données']
+    text = '\n'.join(' '.join(rnd.choice(words) for _ in range(rnd.randint(6, 16))) for _ in range(rnd.randint(1, 6)))
+    data = {
+        'active': True,
+        'derived': False,
+        'header': ' '.join(rnd.choice(words) for _ in range(3)),
+        'level': '{}.{}'.format(index // 20 + 1, index % 20 + 1),
+        'links': [{'SYS{:03d}'.format(rnd.randint(1, 500)): rnd.choice([None, 'abc123def4567890abc123def4567890'])}
+                  for _ in range(rnd.randint(0, 4))],
+        'normative': True,
+        'ref': '',
+        'reviewed': 'abc123def4567890abc123def4567890',
+        'text': Text(text).yaml,
+        'subsystem': rnd.choice(['core', 'ui', 'io']),
+    }
+    if rnd.random() < 0.3:
+        data['comments'] = [{'id': n, 'author': 'user{}'.format(n), 'date': '2021-01-01T10:00:00', 'text': Text(text).yaml}
+                            for n in range(rnd.randint(1, 3))]
+    return data
+
+
+class Command(BaseCommand):
+    help = 'Compare the throughput of the pure-Python and libyaml codecs on item files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=2000, help='number of synthetic items')
+        parser.add_argument('--repo', help='benchmark the item files found in this directory instead')
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def _timeit(self, label, func, rounds, count):
+        #  type: (str, Callable, int, int) -> float
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.stdout.write('{:<24} {:>10.1f} ms {:>10.0f} items/s'.format(label, best * 1000, count / best if best else 0))
+        return best
+
+    def handle(self, *args, **options):
+        if options['repo']:
+            texts = []  # type: List[str]
+            for path in glob.glob(os.path.join(options['repo'], '**', '*.yml'), recursive=True):
+                if os.path.basename(path) == '.doorstop.yml' or '{0}trash{0}'.format(os.sep) in path:
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    texts.append(f.read())
+            if not texts:
+                raise CommandError('no item files found in {}'.format(options['repo']))
+            items = [codec.load_yaml(text, loader=yaml.SafeLoader) for text in texts]
+        else:
+            rnd = random.Random(options['seed'])
+            items = [synthetic_item(i, rnd) for i in range(options['items'])]
+            texts = [codec.dump_yaml(item, dumper=codec.PureDumper) for item in items]
+
+        # Files must be written to the same bytes whatever the dumper
+        reference = [yaml.dump(item, default_flow_style=False, allow_unicode=True, Dumper=yaml.Dumper) for item in items]
+        for name, dumper in (('pure', codec.PureDumper), ('libyaml', codec.FastDumper)):
+            mismatches = sum(1 for item, ref in zip(items, reference) if codec.dump_yaml(item, dumper=dumper) != ref)
+            if mismatches:
+                raise CommandError('{} dumper differs from doorstop on {} of {} items'.format(name, mismatches, len(items)))
+
+        count = len(items)
+        rounds = options['rounds']
+        self.stdout.write('{} items, libyaml {}'.format(count, 'available' if codec.LIBYAML else 'not available'))
+        load_pure = self._timeit('load pure', lambda: [codec.load_yaml(t, loader=yaml.SafeLoader) for t in texts], rounds, count)
+        dump_pure = self._timeit('dump pure', lambda: [codec.dump_yaml(i, dumper=codec.PureDumper) for i in items], rounds, count)
+        if not codec.LIBYAML:
+            return
+        load_fast = self._timeit('load libyaml', lambda: [codec.load_yaml(t, loader=codec.CSafeLoader) for t in texts], rounds, count)
+        dump_fast = self._timeit('dump libyaml', lambda: [codec.dump_yaml(i, dumper=codec.FastDumper) for i in items], rounds, count)
+        self.stdout.write('speedup load x{:.1f}, dump x{:.1f}'.format(load_pure / load_fast, dump_pure / dump_fast))
@@ -0,0 +1,322 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric(object):
+    TYPE = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        #  type: (str, str, Tuple[str, ...]) -> None
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def labels(self, *values):
+        #  type: (str) -> MetricChild
+        if len(values) != len(self.labelnames):
+            raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+        return MetricChild(self, tuple(str(v) for v in values))
+
+
+class MetricChild(object):
+    def __init__(self, metric, labelvalues):
+        #  type: (Metric, Tuple[str, ...]) -> None
+        self._metric = metric
+        self._labelvalues = labelvalues
+
+    def inc(self, value=1.0):
+        registry.inc(self._metric.name, self._labelvalues, value)
+
+    def observe(self, value):
+        registry.observe(self._metric.name, self._labelvalues, value)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, value=1.0):
+        #  type: (float) -> None
+        registry.inc(self.name, (), value)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        #  type: (str, str, Tuple[str, ...], Tuple[float, ...]) -> None
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value):
+        #  type: (float) -> None
+        registry.observe(self.name, (), value)
+
+
+class MetricsRegistry(object):
+    """Metrics of this process, periodically written to a file shared with the other workers.
+
+    Every process writes its values to `metrics-<pid>-<start>.json` in DOORSTOP_METRICS_DIR, at
+    most DOORSTOP_METRICS_FLUSH seconds after they change. The endpoint sums the files
+    of all the processes; the files of the processes that exited are merged into an
+    archive file so that the counters never go back.
+    """
+
+    ARCHIVE = 'metrics-archive.json'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # type: Dict[str, Metric]
+        self._pid = os.getpid()
+        self._started = int(time.time() * 1000)
+        self._counters = {}  # type: Dict[Tuple[str, Tuple[str, ...]], float]
+        self._histograms = {}  # type: Dict[Tuple[str, Tuple[str, ...]], List]
+        self._timer = None  # type: Optional[threading.Timer]
+
+    def register(self, metric):
+        #  type: (Metric) -> None
+        self._metrics[metric.name] = metric
+
+    @staticmethod
+    def enabled():
+        #  type: () -> bool
+        return getattr(settings, 'DOORSTOP_METRICS', True)
+
+    @staticmethod
+    def directory():
+        #  type: () -> str
+        path = getattr(settings, 'DOORSTOP_METRICS_DIR', None)
+        if not path:
+            from requirements.utils import cache_root
+            path = os.path.join(cache_root(), 'metrics')
+        return path
+
+    def _check_pid(self):
+        # Values inherited from the parent process are already in its file
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._started = int(time.time() * 1000)
+            self._counters = {}
+            self._histograms = {}
+            self._timer = None
+
+    def inc(self, name, labelvalues, value=1.0):
+        #  type: (str, Tuple[str, ...], float) -> None
+        if not MetricsRegistry.enabled():
+            return
+        with self._lock:
+            self._check_pid()
+            key = (name, labelvalues)
+            self._counters[key] = self._counters.get(key, 0.0) + value
+            self._schedule()
+
+    def observe(self, name, labelvalues, value):
+        #  type: (str, Tuple[str, ...], float) -> None
+        if not MetricsRegistry.enabled():
+            return
+        metric = self._metrics[name]  # type: Histogram
+        with self._lock:
+            self._check_pid()
+            key = (name, labelvalues)
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(metric.buckets), 0.0, 0]
+            for i, bound in enumerate(metric.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+            self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = threading.Timer(getattr(settings, 'DOORSTOP_METRICS_FLUSH', 1.0), self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _snapshot(self):
+        #  type: () -> Dict
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+            'histograms': [[name, list(labels), list(entry[0]), entry[1], entry[2]] for (name, labels), entry in self._histograms.items()],
+        }
+
+    def _filename(self):
+        #  type: () -> str
+        return 'metrics-{}-{}.json'.format(self._pid, self._started)
+
+    def flush(self):
+        #  type: () -> None
+        from requirements.djdoorstop import write_atomic
+        with self._lock:
+            self._timer = None
+            if not self._counters and not self._histograms:
+                return
+            data = self._snapshot()
+            filename = self._filename()
+        try:
+            directory = MetricsRegistry.directory()
+            os.makedirs(directory, exist_ok=True)
+            write_atomic(json.dumps(data), os.path.join(directory, filename))
+        except OSError as ex:
+            _log.warning('unable to write metrics: %s', ex)
+
+    @staticmethod
+    def _merge(total, data):
+        #  type: (Dict, Dict) -> None
+        for name, labels, value in data.get('counters', []):
+            key = (name, tuple(labels))
+            total['counters'][key] = total['counters'].get(key, 0.0) + value
+        for name, labels, buckets, _sum, count in data.get('histograms', []):
+            key = (name, tuple(labels))
+            entry = total['histograms'].get(key)
+            if entry is None:
+                total['histograms'][key] = [list(buckets), _sum, count]
+            elif len(entry[0]) == len(buckets):
+                entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+                entry[1] += _sum
+                entry[2] += count
+
+    @staticmethod
+    def _alive(pid):
+        #  type: (int) -> bool
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _archive(self, directory, dead):
+        #  type: (str, List[str]) -> None
+        """Merge the files of the processes that exited into the archive."""
+        from requirements.djdoorstop import write_atomic
+        with open(os.path.join(directory, 'metrics.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                total = {'counters': {}, 'histograms': {}}
+                for filename in [MetricsRegistry.ARCHIVE] + dead:
+                    try:
+                        with open(os.path.join(directory, filename), 'r') as f:
+                            MetricsRegistry._merge(total, json.load(f))
+                    except (FileNotFoundError, ValueError):
+                        pass
+                MetricsRegistry._as_lists(total)
+                write_atomic(json.dumps(total), os.path.join(directory, MetricsRegistry.ARCHIVE))
+                for filename in dead:
+                    try:
+                        os.unlink(os.path.join(directory, filename))
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _as_lists(total):
+        #  type: (Dict) -> None
+        total['counters'] = [[name, list(labels), value] for (name, labels), value in total['counters'].items()]
+        total['histograms'] = [[name, list(labels), e[0], e[1], e[2]] for (name, labels), e in total['histograms'].items()]
+
+    def collect(self):
+        #  type: () -> Dict
+        """Values summed over all the processes, this one included."""
+        with self._lock:
+            self._check_pid()
+            own = self._snapshot()
+            own_filename = self._filename()
+        total = {'counters': {}, 'histograms': {}}
+        MetricsRegistry._merge(total, own)
+        directory = MetricsRegistry.directory()
+        dead = []
+        if os.path.isdir(directory):
+            # The archive is rewritten under an exclusive lock
+            lock = open(os.path.join(directory, 'metrics.lock'), 'w')
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            for filename in sorted(os.listdir(directory)):
+                if not filename.startswith('metrics-') or not filename.endswith('.json'):
+                    continue
+                if filename == own_filename:
+                    continue
+                if filename != MetricsRegistry.ARCHIVE:
+                    try:
+                        other = int(filename[len('metrics-'):].split('-')[0])
+                    except ValueError:
+                        continue
+                    if not MetricsRegistry._alive(other):
+                        dead.append(filename)
+                try:
+                    with open(os.path.join(directory, filename), 'r') as f:
+                        MetricsRegistry._merge(total, json.load(f))
+                except (FileNotFoundError, ValueError):
+                    pass
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        if dead:
+            try:
+                self._archive(directory, dead)
+            except OSError as ex:
+                _log.warning('unable to archive metrics: %s', ex)
+        return total
+
+    @staticmethod
+    def _labels(names, values, extra=()):
+        #  type: (Iterable[str], Iterable[str], Iterable[Tuple[str, str]]) -> str
+        pairs = list(zip(names, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')) for k, v in pairs]
+        return '{' + ','.join(escaped) + '}'
+
+    def exposition(self):
+        #  type: () -> str
+        """Metrics in the Prometheus text format."""
+        total = self.collect()
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.TYPE))
+            if isinstance(metric, Histogram):
+                for (_name, labels), (buckets, _sum, count) in sorted(total['histograms'].items()):
+                    if _name != name:
+                        continue
+                    cumulative = 0
+                    for bound, value in zip(metric.buckets, buckets):
+                        cumulative += value
+                        lines.append('{}_bucket{} {}'.format(name, self._labels(metric.labelnames, labels, [('le', repr(bound))]), cumulative))
+                    lines.append('{}_bucket{} {}'.format(name, self._labels(metric.labelnames, labels, [('le', '+Inf')]), count))
+                    lines.append('{}_sum{} {}'.format(name, self._labels(metric.labelnames, labels), repr(_sum)))
+                    lines.append('{}_count{} {}'.format(name, self._labels(metric.labelnames, labels), count))
+            else:
+                for (_name, labels), value in sorted(total['counters'].items()):
+                    if _name == name:
+                        lines.append('{}{} {}'.format(name, self._labels(metric.labelnames, labels), repr(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+atexit.register(registry.flush)
+
+TREE_BUILDS = Counter('doorstop_tree_builds_total', 'Trees built from the working directory', ('reason',))
+TREE_CACHE_HITS = Counter('doorstop_tree_cache_hits_total', 'Requests served by a cached tree')
+ITEM_CACHE = Counter('doorstop_item_cache_total', 'Item and document files looked up in the tree snapshot', ('result',))
+YAML_PARSED = Counter('doorstop_yaml_files_parsed_total', 'YAML files parsed')
+VALIDATIONS = Histogram('doorstop_validation_seconds', 'Duration of item and tree validations')
+EXPORT_SECONDS = Histogram('doorstop_export_seconds', 'Duration of spreadsheet exports')
+IMPORT_SECONDS = Histogram('doorstop_import_seconds', 'Duration of spreadsheet imports')
+GIT_SECONDS = Histogram('doorstop_git_operation_seconds', 'Duration of git operations', ('operation',))
+VIEW_SECONDS = Histogram('doorstop_view_seconds', 'Latency of the views', ('view', 'method'))
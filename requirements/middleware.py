@@ -0,0 +1,79 @@
+import asyncio
+import json
+import logging
+import time
+
+from django.conf import settings
+
+from requirements.executors import markcoroutinefunction
+from requirements.metrics import VIEW_SECONDS
+from requirements.timing import current_timings, start_timings, stop_timings
+
+_log = logging.getLogger(__name__)
+
+
+class ServerTimingMiddleware(object):
+    """Time the phases of each request, report them in the Server-Timing header and in a log line.
+
+    Template rendering (tables, Markdown filters) is reported as the render phase. The
+    latency of every view is observed by the metrics also when the header is disabled.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'DOORSTOP_SERVER_TIMING', True)
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _observe(request, seconds):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unresolved'
+        VIEW_SECONDS.labels(view, request.method).observe(seconds)
+
+    def _report(self, request, response, timings):
+        self._observe(request, timings.total)
+        response['Server-Timing'] = timings.header()
+        if _log.isEnabledFor(logging.INFO):
+            record = {'method': request.method, 'path': request.path, 'status': response.status_code}
+            record.update(timings.as_dict())
+            _log.info(json.dumps(record, separators=(',', ':')))
+        return response
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            start = time.perf_counter()
+            response = self.get_response(request)
+            self._observe(request, time.perf_counter() - start)
+            return response
+        token = start_timings()
+        try:
+            response = self.get_response(request)
+        finally:
+            timings = stop_timings(token)
+        return self._report(request, response, timings)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            start = time.perf_counter()
+            response = await self.get_response(request)
+            self._observe(request, time.perf_counter() - start)
+            return response
+        token = start_timings()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timings = stop_timings(token)
+        return self._report(request, response, timings)
+
+    def process_template_response(self, request, response):
+        timings = current_timings()
+        if timings is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(lambda r: timings.add('render', time.perf_counter() - start))
+        return response
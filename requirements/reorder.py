@@ -0,0 +1,122 @@
+import logging
+import re
+from typing import Dict, List
+
+from doorstop import DoorstopError
+from doorstop.core import Document
+from doorstop.core.types import Level
+
+from requirements.codec import load_yaml
+from requirements.djdoorstop import DjDocument
+
+_log = logging.getLogger(__name__)
+
+_ITEM_LINE = re.compile(r'(\s+)(- [\w\d-]+\s*): # (.+)$')
+
+
+class LevelChange(object):
+    MOVE = 'move'
+
+    def __init__(self, action, uid, old, new):
+        #  type: (str, str, Level, Level) -> None
+        self.action = action
+        self.uid = uid
+        self.old = old
+        self.new = new
+
+
+class ReorderPlan(object):
+    """Changes needed to give a document the outline of an edited index.
+
+    Unlike doorstop's reordering from the index the outline must list exactly the items
+    of the document: a plan never adds nor deletes items, an index with unknown or
+    missing UIDs is rejected. Only the items whose level really changes are written,
+    all in one document batch.
+    """
+
+    def __init__(self, document, index):
+        #  type: (Document, str) -> None
+        self._document = document
+        self._levels = {}  # type: Dict[str, Level]
+        self._unknown = []  # type: List[str]
+        self.changes = []  # type: List[LevelChange]
+        data = ReorderPlan.read_index(index)
+        self._outline(data.get('outline', []) or [], Level(data.get('initial', 1.0)))
+        self._check()
+        self._diff()
+
+    @staticmethod
+    def index_of(document):
+        #  type: (Document) -> str
+        """Index text of the current outline, as doorstop writes it in index.yml.
+
+        Without doorstop's header, which tells that unknown UIDs become new items.
+        """
+        lines = Document._lines_index(document.items)  # pylint: disable=protected-access
+        return '\n'.join(line for line in lines if not line.startswith('#')).lstrip('\n') + '\n'
+
+    @staticmethod
+    def read_index(text):
+        #  type: (str) -> Dict
+        """Parse an index, turning the comments into the text of new items (as doorstop does)."""
+        lines = []
+        for line in text.replace('\r\n', '\n').split('\n'):
+            m = _ITEM_LINE.search(line)
+            if m:
+                lines.append('{}{}:'.format(m.group(1), m.group(2)))
+                lines.append('    {}- text: "{}"'.format(m.group(1), m.group(3).replace('"', '\\"')))
+            else:
+                lines.append(line)
+        return load_yaml('\n'.join(lines), 'index')
+
+    @staticmethod
+    def _is_text(section):
+        #  type: (object) -> bool
+        return isinstance(section, dict) and 'text' in section
+
+    def _outline(self, section, level):
+        #  type: (object, Level) -> None
+        if isinstance(section, dict):
+            uid = str(list(section.keys())[0])
+            subsection = section[uid]
+            # Items with sub-items are headings
+            level = Level(level, heading=isinstance(subsection, list) and any(not ReorderPlan._is_text(s) for s in subsection))
+            try:
+                item = self._document.find_item(uid)
+            except DoorstopError:
+                item = None
+            if item is None:
+                self._unknown.append(uid)
+            elif str(item.uid) in self._levels:
+                raise DoorstopError('{} appears twice in the index'.format(item.uid))
+            else:
+                self._levels[str(item.uid)] = level
+            if subsection and isinstance(subsection, list):
+                self._outline(subsection, level >> 1)
+        elif isinstance(section, list):
+            # The text of an item (its comment in the index) is not a sub-item
+            subsections = [s for s in section if not ReorderPlan._is_text(s)]
+            for index, subsection in enumerate(subsections):
+                self._outline(subsection, level + index)
+
+    def _check(self):
+        missing = [str(item.uid) for item in self._document.items if str(item.uid) not in self._levels]
+        if self._unknown:
+            raise DoorstopError('unknown items in the index: {}'.format(', '.join(self._unknown)))
+        if missing:
+            raise DoorstopError('items missing from the index: {}'.format(', '.join(missing)))
+
+    def _diff(self):
+        for item in self._document.items:
+            level = self._levels[str(item.uid)]
+            if str(level) != str(item.level) or level.heading != item.level.heading:
+                self.changes.append(LevelChange(LevelChange.MOVE, str(item.uid), item.level, level))
+
+    def apply(self):
+        #  type: () -> int
+        """Write the changes, return the number of items touched."""
+        with DjDocument.batch():
+            for change in self.changes:
+                self._document.find_item(change.uid).level = change.new
+        _log.info('%d items of %s moved', len(self.changes), self._document.prefix)
+        return len(self.changes)
@@ -1,13 +1,23 @@
+import functools
 import logging
 import os
-from typing import Optional, List
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, List, Dict, Iterable, Tuple
 
 import pygit2
+from django.conf import settings
 from django.contrib.auth.models import User
-from pygit2 import Repository, GIT_STATUS_IGNORED, GIT_STATUS_WT_MODIFIED, GIT_STATUS_INDEX_MODIFIED, GIT_STATUS_WT_NEW
-from pygit2._pygit2 import TreeBuilder
+from pygit2 import Repository, GIT_STATUS_IGNORED, GIT_STATUS_WT_MODIFIED, GIT_STATUS_INDEX_MODIFIED, GIT_STATUS_WT_NEW, \
+    GIT_STATUS_CURRENT, GIT_DELTA_ADDED, GIT_DELTA_DELETED, GIT_DELTA_MODIFIED, GIT_DELTA_RENAMED, GIT_DELTA_UNTRACKED
+from pygit2._pygit2 import TreeBuilder, Patch
 
-from requirements.utils import repository_path
+from requirements.history import HistoryIndex, history_index
+from requirements.metrics import GIT_SECONDS
+from requirements.timing import timed
+from requirements.utils import repository_path, cache_path, worktree_name
+from requirements.watcher import watcher_for
 
 _log = logging.getLogger(__name__)
 
@@ -34,6 +44,233 @@ class GitFileStatusRecord(object):
             return self.status
 
 
+class GitDiffRecord(GitFileStatusRecord):
+    DELTA_TEXT = {GIT_DELTA_ADDED: 'Added', GIT_DELTA_DELETED: 'Deleted', GIT_DELTA_MODIFIED: 'Modified',
+                  GIT_DELTA_RENAMED: 'Renamed', GIT_DELTA_UNTRACKED: 'Untracked'}
+
+    def __init__(self, name, status, binary=False, patch=None):
+        #  type: (str, int, bool, Optional[Callable[[], Patch]]) -> None
+        super().__init__(name, status)
+        self.binary = binary
+        self._patch = patch
+        self._line_stats = None  # type: Optional[Tuple[int, int, int]]
+
+    @property
+    def line_stats(self):
+        #  type: () -> Optional[Tuple[int, int, int]]
+        """Context, added and deleted lines, None for binary files.
+
+        The patch of the file is generated the first time, so only the listed files pay for it.
+        """
+        if self._line_stats is None and not self.binary and self._patch is not None:
+            self._line_stats = self._patch().line_stats
+        return self._line_stats
+
+    @property
+    def additions(self):
+        #  type: () -> Optional[int]
+        return self.line_stats[1] if self.line_stats else None
+
+    @property
+    def deletions(self):
+        #  type: () -> Optional[int]
+        return self.line_stats[2] if self.line_stats else None
+
+    def status_text(self):
+        return GitDiffRecord.DELTA_TEXT.get(self.status, self.status)
+
+
+def index_stamp(repo):
+    #  type: (Repository) -> Optional[Tuple[int, int]]
+    try:
+        stat = os.stat(os.path.join(repo.path, 'index'))
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RepositoryHandle(object):
+    def __init__(self, path):
+        #  type: (str) -> None
+        self.pid = os.getpid()
+        self.used = time.monotonic()
+        try:
+            self.repo = pygit2.Repository(path)  # type: Repository
+        except pygit2.GitError:
+            self.repo = pygit2.init_repository(path)
+        self._index_stamp = None
+
+    def refresh_index(self):
+        # Re-read the index only when the file on disk has been changed by someone else
+        stamp = index_stamp(self.repo)
+        if stamp != self._index_stamp:
+            self.repo.index.read()
+            self._index_stamp = stamp
+
+
+class RepositoryPool(object):
+    """One open pygit2 repository per path and per thread, reused across requests.
+
+    Every thread keeps at most DOORSTOP_REPOSITORY_POOL_SIZE repositories: the least
+    recently used ones, and the ones idle for DOORSTOP_REPOSITORY_POOL_IDLE seconds,
+    are dropped (and their files closed) when another repository is opened.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @staticmethod
+    def size():
+        return getattr(settings, 'DOORSTOP_REPOSITORY_POOL_SIZE', 4)
+
+    @staticmethod
+    def idle():
+        return getattr(settings, 'DOORSTOP_REPOSITORY_POOL_IDLE', 600)
+
+    def _handles(self):
+        #  type: () -> Dict[str, RepositoryHandle]
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            handles = self._local.handles = OrderedDict()
+        return handles
+
+    @staticmethod
+    def _evict(handles):
+        #  type: (Dict[str, RepositoryHandle]) -> None
+        now = time.monotonic()
+        for path in [p for p, h in handles.items() if now - h.used > RepositoryPool.idle()]:
+            _log.debug('closing idle repository %s', path)
+            del handles[path]
+        while len(handles) > RepositoryPool.size():
+            path, _handle = handles.popitem(last=False)
+            _log.debug('closing repository %s', path)
+
+    def get(self, path):
+        #  type: (str) -> Repository
+        handles = self._handles()
+        handle = handles.get(path)
+        if handle is None or handle.pid != os.getpid():
+            # libgit2 handles must not be shared with a forked worker
+            _log.debug('opening repository %s', path)
+            handle = handles[path] = RepositoryHandle(path)
+            RepositoryPool._evict(handles)
+        handle.used = time.monotonic()
+        handles.move_to_end(path)
+        handle.refresh_index()
+        return handle.repo
+
+    def clear(self, path=None):
+        #  type: (Optional[str]) -> None
+        handles = self._handles()
+        if path is None:
+            handles.clear()
+        else:
+            handles.pop(path, None)
+
+
+repository_pool = RepositoryPool()
+
+
+class StatusCacheEntry(object):
+    def __init__(self, index_stamp, generation, status):
+        #  type: (Optional[Tuple[int, int]], int, Dict[str, int]) -> None
+        self.index_stamp = index_stamp
+        self.generation = generation
+        self.status = status
+
+
+class StatusCache(object):
+    """Results of `git status` keyed on the index file stamp and on the working tree generation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # type: Dict[str, StatusCacheEntry]
+
+    @staticmethod
+    def track_writes():
+        return getattr(settings, 'DOORSTOP_STATUS_TRACK_WRITES', True)
+
+    @staticmethod
+    def _update_files(repo, status, paths):
+        #  type: (Repository, Dict[str, int], Iterable[str]) -> None
+        for path in paths:
+            relpath = os.path.relpath(path, repo.workdir).replace(os.sep, '/')
+            try:
+                flags = repo.status_file(relpath)
+            except KeyError:
+                flags = GIT_STATUS_CURRENT
+            if flags == GIT_STATUS_CURRENT:
+                status.pop(relpath, None)
+            else:
+                status[relpath] = flags
+
+    def status(self, repo):
+        #  type: (Repository) -> Dict[str, int]
+        watcher = watcher_for(repo.workdir)
+        generation = watcher.poll()
+        stamp = index_stamp(repo)
+        with self._lock:
+            entry = self._entries.get(repo.workdir)
+        if entry is not None and entry.index_stamp == stamp:
+            if entry.generation == generation:
+                return entry.status
+            changed = watcher.changes_since(entry.generation) if StatusCache.track_writes() else None
+            if changed is not None:
+                # Only files saved through the application changed: stat just those
+                status = dict(entry.status)
+                StatusCache._update_files(repo, status, changed)
+                self._store(repo.workdir, StatusCacheEntry(stamp, generation, status))
+                return status
+        _log.debug('full status scan of %s', repo.workdir)
+        status = repo.status()
+        # libgit2 may refresh the stat cache of the index while scanning
+        self._store(repo.workdir, StatusCacheEntry(index_stamp(repo), generation, status))
+        return status
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+
+    def invalidate(self, repo=None):
+        #  type: (Optional[Repository]) -> None
+        with self._lock:
+            if repo is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(repo.workdir, None)
+
+
+status_cache = StatusCache()
+
+_worktree_lock = threading.Lock()
+
+
+def add_user_worktree(user, path):
+    #  type: (User, str) -> bool
+    """Create a working directory for `user` sharing the object database of DOORSTOP_REPO.
+
+    Returns False when there is no commit to branch it from yet.
+    """
+    with _worktree_lock:
+        if os.path.isdir(path):
+            return True
+        repo = repository_pool.get(settings.DOORSTOP_REPO)
+        name = worktree_name(user)
+        branch = repo.branches.local.get(f'users/{name}')
+        if branch is None:
+            if repo.head_is_unborn:
+                _log.warning('no commit in %s yet, %s works in it directly', repo.workdir, user.get_username())
+                return False
+            branch = repo.branches.local.create(f'users/{name}', repo.head.peel(pygit2.Commit))
+        if name in repo.list_worktrees():
+            # The directory was removed but git still knows about it
+            repo.lookup_worktree(name).prune(True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _log.info('creating worktree %s for %s', path, user.get_username())
+        repo.add_worktree(name, path, branch)
+        return True
+
+
 class MyPyGit2(object):
 
     class MyRemoteCallbacks(pygit2.RemoteCallbacks):
@@ -49,7 +286,7 @@ class MyPyGit2(object):
     def __init__(self, user):
         #  type: (User) -> None
         self._user = user  # type: User
-        self._repo = pygit2.init_repository(repository_path(user))  # type: Repository
+        self._repo = repository_pool.get(repository_path(user))  # type: Repository
 
     @staticmethod
     def version():
@@ -65,27 +302,89 @@ class MyPyGit2(object):
         # type: () -> bool
         return True
 
-    def diff_patch(self, ref='HEAD', filter_file=None):
-        #  type: (str, Optional[str]) -> str
-        patch_text = ''
-        for patch in self._repo.diff(ref):
-            if filter_file is None:
-                patch_text += patch.text
-            else:
-                line = patch.text.partition('\n')[0]
-                if filter_file in line:
-                    patch_text += patch.text
-        return patch_text
+    @staticmethod
+    def diff_max_size():
+        return getattr(settings, 'DOORSTOP_DIFF_MAX_SIZE', 256 * 1024)
+
+    @staticmethod
+    def _patch_lines(patch):
+        #  type: (Patch) -> str
+        delta = patch.delta
+        yield f'diff --git a/{delta.old_file.path} b/{delta.new_file.path}\n'
+        if delta.is_binary:
+            yield f'Binary files a/{delta.old_file.path} and b/{delta.new_file.path} differ\n'
+            return
+        yield f'--- a/{delta.old_file.path}\n'
+        yield f'+++ b/{delta.new_file.path}\n'
+        for hunk in patch.hunks:
+            yield hunk.header if hunk.header.endswith('\n') else hunk.header + '\n'
+            for line in hunk.lines:
+                yield line.origin + line.content if line.origin in '+- ' else line.content
+
+    @staticmethod
+    def _join_capped(lines, max_size):
+        #  type: (Iterable[str], int) -> Tuple[str, bool]
+        chunks = []
+        size = 0
+        for line in lines:
+            size += len(line)
+            if size > max_size:
+                chunks.append('\n... patch truncated ...\n')
+                return ''.join(chunks), True
+            chunks.append(line)
+        return ''.join(chunks), False
+
+    @timed('git', GIT_SECONDS.labels('diff_files'))
+    def diff_files(self, ref='HEAD'):
+        #  type: (str) -> List[GitDiffRecord]
+        # Only the deltas are read, the patches are generated when the line stats of a
+        # record are shown and by diff_file_patch
+        diff = self._repo.diff(ref)
+        return [GitDiffRecord(delta.new_file.path, delta.status, delta.is_binary, functools.partial(diff.__getitem__, i))
+                for i, delta in enumerate(diff.deltas)]
 
+    @timed('git', GIT_SECONDS.labels('diff_file_patch'))
+    def diff_file_patch(self, path, ref='HEAD', max_size=None):
+        #  type: (str, str, Optional[int]) -> Tuple[str, bool]
+        max_size = max_size or MyPyGit2.diff_max_size()
+        diff = self._repo.diff(ref)
+        for i, delta in enumerate(diff.deltas):
+            if delta.new_file.path == path or delta.old_file.path == path:
+                # Only the patch of the matching delta is generated
+                return MyPyGit2._join_capped(MyPyGit2._patch_lines(diff[i]), max_size)
+        return '', False
+
+    @timed('git', GIT_SECONDS.labels('diff_patch'))
+    def diff_patch(self, ref='HEAD', filter_file=None, max_size=None):
+        #  type: (str, Optional[str], Optional[int]) -> str
+        def lines():
+            for patch in self._repo.diff(ref):
+                if filter_file is None or filter_file in patch.delta.new_file.path:
+                    yield from MyPyGit2._patch_lines(patch)
+        return MyPyGit2._join_capped(lines(), max_size or MyPyGit2.diff_max_size())[0]
+
+    @timed('git', GIT_SECONDS.labels('history'))
+    def history(self):
+        #  type: () -> HistoryIndex
+        return history_index(self._repo, cache_path(self._user, 'history.json'))
+
+    @timed('git', GIT_SECONDS.labels('modified_files'))
     def modified_files(self):
         #  type: () -> List[GitFileStatusRecord]
         modified = []
-        repostatus = self._repo.status()
+        repostatus = status_cache.status(self._repo)
         for obj in repostatus:
             if repostatus[obj] != GIT_STATUS_IGNORED:
                 modified.append(GitFileStatusRecord(obj, repostatus[obj]))
         return modified
 
+    def local_branch(self, default='master'):
+        #  type: (str) -> str
+        if self._repo.head_is_detached:
+            return default
+        return self._repo.head.shorthand
+
+    @timed('git', GIT_SECONDS.labels('commit_and_push'))
     def commit_and_push(self, remote_name='origin', branch='master'):
         # type: (str , str) -> None
         index = self._repo.index
@@ -97,8 +396,10 @@ class MyPyGit2(object):
         _oid = self._repo.create_commit(reference, author, commiter, message, tree, [self._repo.head.get_object().hex])
         for remote in self._repo.remotes:
             if remote.name == remote_name:
-                remote.push(f'refs/heads/{branch}', callbacks=MyPyGit2.MyRemoteCallbacks(credentials=MyPyGit2.remote_keypair()))
+                refspec = f'refs/heads/{self.local_branch(branch)}:refs/heads/{branch}'
+                remote.push([refspec], callbacks=MyPyGit2.MyRemoteCallbacks(credentials=MyPyGit2.remote_keypair()))
 
+    @timed('git', GIT_SECONDS.labels('pull'))
     def pull(self, remote_name='origin', branch='master'):
         #  type: (str, str) -> None
         for remote in self._repo.remotes:
@@ -110,11 +411,12 @@ class MyPyGit2(object):
                     return
                 elif merge_result & pygit2.GIT_MERGE_ANALYSIS_FASTFORWARD:
                     self._repo.checkout_tree(self._repo.get(remote_master_id))
+                    local = self.local_branch(branch)
                     try:
-                        master_ref = self._repo.lookup_reference('refs/heads/%s' % branch)
+                        master_ref = self._repo.lookup_reference('refs/heads/%s' % local)
                         master_ref.set_target(remote_master_id)
                     except KeyError:
-                        self._repo.create_branch(branch, self._repo.get(remote_master_id))
+                        self._repo.create_branch(local, self._repo.get(remote_master_id))
                     self._repo.head.set_target(remote_master_id)
                 elif merge_result & pygit2.GIT_MERGE_ANALYSIS_NORMAL:
                     self._repo.merge(remote_master_id)
@@ -0,0 +1,189 @@
+import hmac
+import logging
+import os
+import pickle
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+from doorstop import Tree
+# Not deferred: importing the doorstop package already imports doorstop.core.builder
+from doorstop.core.builder import build
+
+from requirements.metrics import ITEM_CACHE
+
+_log = logging.getLogger(__name__)
+
+
+class TreeSnapshot(object):
+    """Parsed YAML data of the item and document files of a working directory, persisted with pickle.
+
+    Entries are keyed by the path of the file relative to the working directory and are
+    used only while the size and modification time of the file match the recorded ones,
+    so after a restart only the files changed since the snapshot was written are parsed.
+    The entries are held in memory only while a tree is being built.
+
+    The cache directory may be writable by others: the file is signed with an HMAC keyed
+    on SECRET_KEY and nothing is unpickled unless the signature matches.
+    """
+
+    VERSION = 2
+    MAGIC = b'DSSNAP2\n'
+    # Files modified this recently may change again within the mtime granularity
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, root, filename):
+        #  type: (str, str) -> None
+        self._root = os.path.abspath(root)
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._entries = None  # type: Optional[Dict[str, Tuple[int, int, bytes]]]
+        self._seen = set()  # type: Set[str]
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def root(self):
+        return self._root
+
+    def _read(self):
+        self._entries = {}
+        self._seen = set()
+        self._dirty = False
+        try:
+            with open(self._filename, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return
+        header = len(TreeSnapshot.MAGIC) + len(TreeSnapshot._sign(b''))
+        payload = blob[header:]
+        if blob[:len(TreeSnapshot.MAGIC)] != TreeSnapshot.MAGIC or \
+                not hmac.compare_digest(blob[len(TreeSnapshot.MAGIC):header], TreeSnapshot._sign(payload)):
+            _log.warning('discarding tree snapshot %s: bad signature', self._filename)
+            return
+        try:
+            data = pickle.loads(payload)
+        except Exception as ex:
+            _log.warning('discarding tree snapshot %s: %s', self._filename, ex)
+            return
+        if not isinstance(data, dict) or data.get('version') != TreeSnapshot.VERSION or data.get('root') != self._root:
+            return
+        self._entries = data['entries']
+
+    @staticmethod
+    def _sign(payload):
+        #  type: (bytes) -> bytes
+        return salted_hmac('requirements.snapshot', payload, algorithm='sha256').digest()
+
+    def _key(self, path):
+        #  type: (str) -> str
+        return os.path.relpath(path, self._root)
+
+    def lookup(self, path):
+        #  type: (str) -> Optional[Dict]
+        """Parsed data of a file, None when the file changed since it was stored."""
+        key = self._key(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if self._entries is None:
+                return None
+            self._seen.add(key)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+                self.misses += 1
+                ITEM_CACHE.labels('miss').inc()
+                return None
+            self.hits += 1
+        ITEM_CACHE.labels('hit').inc()
+        # Every lookup gets its own copy, the items are free to change it
+        return pickle.loads(entry[2])
+
+    def store(self, path, data):
+        #  type: (str, Dict) -> None
+        key = self._key(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._entries is None:
+                return
+            self._seen.add(key)
+            if time.time_ns() - stat.st_mtime_ns < TreeSnapshot.RACY_NS:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = (stat.st_size, stat.st_mtime_ns, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+            self._dirty = True
+
+    def save(self, prune=True):
+        #  type: (bool) -> None
+        """Write the snapshot, with `prune` dropping the files not looked up since it was loaded."""
+        from requirements.djdoorstop import write_atomic
+        with self._lock:
+            if self._entries is None:
+                return
+            if prune:
+                stale = [k for k in self._entries if k not in self._seen]
+                for key in stale:
+                    del self._entries[key]
+                self._dirty = self._dirty or bool(stale)
+            if not self._dirty:
+                return
+            data = {'version': TreeSnapshot.VERSION, 'root': self._root, 'entries': self._entries}
+            os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+            payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            write_atomic(TreeSnapshot.MAGIC + TreeSnapshot._sign(payload) + payload, self._filename)
+            self._dirty = False
+        _log.info('saved tree snapshot of %s (%d files, %d parsed)', self._root, len(self._entries), self.misses)
+
+    def hydrate(self, root):
+        #  type: (str) -> Tree
+        """Build the tree of the working directory loading every document and item, then persist the snapshot."""
+        with self._lock:
+            self._read()
+        try:
+            tree = build(root=root)
+            for document in tree:
+                for item in document:
+                    item.load()
+            self.save()
+        finally:
+            with self._lock:
+                self._entries = None
+        return tree
+
+
+_snapshots = {}  # type: Dict[str, TreeSnapshot]
+_snapshots_lock = threading.Lock()
+
+
+def use_snapshots():
+    #  type: () -> bool
+    return getattr(settings, 'DOORSTOP_TREE_SNAPSHOT', True)
+
+
+def open_snapshot(root, filename):
+    #  type: (str, str) -> TreeSnapshot
+    root = os.path.abspath(root)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(root)
+        if snapshot is None:
+            snapshot = _snapshots[root] = TreeSnapshot(root, filename)
+        return snapshot
+
+
+def snapshot_for(path):
+    #  type: (str) -> Optional[TreeSnapshot]
+    """Snapshot of the working directory containing `path`, if one was opened."""
+    if not _snapshots:
+        return None
+    path = os.path.abspath(path)
+    with _snapshots_lock:
+        roots = [root for root in _snapshots if path.startswith(root + os.sep)]
+        return _snapshots[max(roots, key=len)] if roots else None
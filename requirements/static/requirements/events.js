@@ -0,0 +1,21 @@
+// Live change notifications from the server-sent events endpoint
+function watchRepository(url, onChange) {
+    if (!window.EventSource) {
+        return;
+    }
+    var source = new EventSource(url);
+    source.addEventListener('change', function (message) {
+        onChange(JSON.parse(message.data).events);
+    });
+    source.addEventListener('reset', function () {
+        showRepositoryNotice('The repository changed, reload the page to see the changes.');
+    });
+}
+
+function showRepositoryNotice(text) {
+    var notice = document.getElementById('repository-notice');
+    if (notice) {
+        notice.querySelector('span').textContent = text || 'The repository changed.';
+        notice.style.display = '';
+    }
+}
@@ -0,0 +1,178 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from doorstop import Tree
+
+from requirements.timing import phase
+from requirements.watcher import watcher_for
+
+
+def _percent(count, total):
+    #  type: (float, float) -> float
+    return round(100.0 * float(count) / float(total), 1) if total else 0.0
+
+
+class ItemColumns(object):
+    """Columnar snapshot of the item attributes of a tree, one NumPy array per attribute.
+
+    Rows are the active items of every document in tree order. Links are two arrays of
+    row numbers (child and parent, -1 when the parent is not in the tree) and the values
+    of the foreign fields are stored as category codes of the rows of their document.
+    The statistics are then computed for all the documents at once.
+    """
+
+    FLAGS = ('reviewed', 'normative', 'derived', 'pending', 'deleted')
+    MAX_VALUES = 20
+
+    def __init__(self, tree):
+        #  type: (Tree) -> None
+        import numpy
+        self._np = numpy
+        self.prefixes = [str(document.prefix) for document in tree]
+        self.parents = {str(document.prefix): str(document.parent or '') for document in tree}
+        rows = {}  # type: Dict[str, int]
+        documents = []  # type: List[int]
+        flags = {name: [] for name in ItemColumns.FLAGS}  # type: Dict[str, List[bool]]
+        comments = []  # type: List[int]
+        links = []  # type: List[Tuple[int, str]]
+        self.fields = {}  # type: Dict[Tuple[str, str], Tuple[List[str], numpy.ndarray]]
+        for number, document in enumerate(tree):
+            values = {name: ({}, []) for name in document.foreign_fields2}  # type: Dict[str, Tuple[Dict[str, int], List[int]]]
+            for item in document.items:
+                row = len(documents)
+                rows[str(item.uid)] = row
+                documents.append(number)
+                for name in ItemColumns.FLAGS:
+                    flags[name].append(bool(getattr(item, name)))
+                comments.append(len([c for c in item.get('comments') or [] if not c.get('closed')]))
+                links.extend((row, str(uid)) for uid in item.links)
+                for name, field in document.foreign_fields2.items():
+                    categories, codes = values[name]
+                    value = str(field.value(item) or '')
+                    codes.append(categories.setdefault(value, len(categories)))
+            for name, (categories, codes) in values.items():
+                self.fields[(str(document.prefix), name)] = (list(categories), numpy.array(codes, dtype=numpy.int64))
+        self.documents = numpy.array(documents, dtype=numpy.int64)
+        self.flags = {name: numpy.array(values, dtype=bool) for name, values in flags.items()}
+        self.comments = numpy.array(comments, dtype=numpy.int64)
+        self.children = numpy.array([row for row, _ in links], dtype=numpy.int64)
+        self.targets = numpy.array([rows.get(uid, -1) for _, uid in links], dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _documents(self):
+        #  type: () -> List[Dict]
+        np = self._np
+        count = len(self.prefixes)
+        totals = np.bincount(self.documents, minlength=count)
+        flags = {name: np.bincount(self.documents, weights=values, minlength=count) for name, values in self.flags.items()}
+        comments = np.bincount(self.documents, weights=self.comments, minlength=count)
+        result = []
+        for number, prefix in enumerate(self.prefixes):
+            total = int(totals[number])
+            stats = {'prefix': prefix, 'items': total, 'open_comments': int(comments[number]), 'fields': self._fields(prefix)}
+            for name in ('reviewed', 'normative', 'pending', 'deleted'):
+                stats[name] = int(flags[name][number])
+                stats[name + '_percent'] = _percent(flags[name][number], total)
+            result.append(stats)
+        return result
+
+    def _fields(self, prefix):
+        #  type: (str) -> List[Dict]
+        result = []
+        for (_prefix, name), (categories, codes) in sorted(self.fields.items()):
+            if _prefix != prefix:
+                continue
+            counts = self._np.bincount(codes, minlength=len(categories))
+            order = self._np.argsort(-counts, kind='stable')
+            values = [{'value': categories[i] or '(empty)', 'count': int(counts[i]), 'percent': _percent(counts[i], len(codes))}
+                      for i in order[:ItemColumns.MAX_VALUES]]
+            other = int(counts[order[ItemColumns.MAX_VALUES:]].sum())
+            if other:
+                values.append({'value': '(other)', 'count': other, 'percent': _percent(other, len(codes))})
+            result.append({'name': name, 'values': values})
+        return result
+
+    def _coverage(self):
+        #  type: () -> List[Dict]
+        """Items of a document linking to a parent document and items of the parent with children there."""
+        np = self._np
+        count, rows = len(self.prefixes), max(len(self), 1)
+        deleted = self.flags['deleted']
+        parent_ok = self.flags['normative'] & ~deleted
+        child_ok = parent_ok & ~self.flags['derived']
+        valid = self.targets >= 0
+        children, parents = self.children[valid], self.targets[valid]
+        alive = ~deleted[children] & ~deleted[parents]
+        children, parents = children[alive], parents[alive]
+        pairs = self.documents[children] * count + self.documents[parents]
+        linked = np.unique(pairs * rows + children)
+        linked = linked[child_ok[linked % rows]]
+        linked = np.bincount(linked // rows, minlength=count * count)
+        covered = np.unique(pairs * rows + parents)
+        covered = covered[parent_ok[covered % rows]]
+        covered = np.bincount(covered // rows, minlength=count * count)
+        child_items = np.bincount(self.documents, weights=child_ok, minlength=count)
+        parent_items = np.bincount(self.documents, weights=parent_ok, minlength=count)
+        numbers = {prefix: number for number, prefix in enumerate(self.prefixes)}
+        keys = set(int(k) for k in np.unique(pairs))
+        keys.update(numbers[c] * count + numbers[p] for c, p in self.parents.items() if p in numbers)
+        result = []
+        for key in sorted(keys):
+            child, parent = divmod(key, count)
+            result.append({
+                'child': self.prefixes[child], 'parent': self.prefixes[parent],
+                'child_items': int(child_items[child]), 'linked_children': int(linked[key]),
+                'child_coverage': _percent(linked[key], child_items[child]),
+                'parent_items': int(parent_items[parent]), 'covered_parents': int(covered[key]),
+                'parent_coverage': _percent(covered[key], parent_items[parent]),
+            })
+        return result
+
+    def summary(self):
+        #  type: () -> Dict
+        documents = self._documents()
+        total = {'items': len(self), 'open_comments': int(self.comments.sum())}
+        for name in ('reviewed', 'normative', 'pending', 'deleted'):
+            total[name] = int(self.flags[name].sum())
+            total[name + '_percent'] = _percent(total[name], len(self))
+        return {'total': total, 'documents': documents, 'coverage': self._coverage()}
+
+
+class StatisticsCache(object):
+    """Statistics of a working directory, computed again only when its watcher generation changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # type: Dict[str, Tuple[int, Dict]]
+
+    def get(self, root, tree):
+        #  type: (str, Tree) -> Dict
+        generation = watcher_for(root).poll()
+        with self._lock:
+            entry = self._entries.get(root)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+        with phase('statistics'):
+            summary = ItemColumns(tree).summary()
+        summary['generation'] = generation
+        with self._lock:
+            self._entries[root] = (generation, summary)
+        return summary
+
+    @staticmethod
+    def select(summary, prefix=None):
+        #  type: (Dict, Optional[str]) -> Dict
+        """The statistics of one document and of the document pairs it belongs to."""
+        if prefix is None:
+            return summary
+        return {
+            'generation': summary['generation'],
+            'total': next(d for d in summary['documents'] if d['prefix'] == prefix),
+            'documents': [d for d in summary['documents'] if d['prefix'] == prefix],
+            'coverage': [c for c in summary['coverage'] if prefix in (c['child'], c['parent'])],
+        }
+
+
+statistics_cache = StatisticsCache()
@@ -0,0 +1,156 @@
+import os
+import random
+from typing import Any, Dict, List
+
+from doorstop.core.types import Text
+
+from requirements.codec import dump_yaml
+
+WORDS = ['system', 'shall', 'provide', 'signal', 'value', 'user', 'interface', 'timeout', 'message', 'sensor', 'power',
+         'status', 'report', 'within', 'each', 'cycle', 'mode', 'fault', 'data', 'record', 'configuration', 'channel']
+
+SUBSYSTEMS = {'core': 'Core', 'ui': 'User interface', 'io': 'Input/Output', 'net': 'Network', 'pwr': 'Power'}
+
+
+class SyntheticRepository(object):
+    """Reproducible doorstop tree written to disk for benchmarks.
+
+    Documents form a chain, every document is the parent of the next one. The first
+    two documents are named RADN and RADN-SRS so that the spreadsheet export can run
+    on the generated tree. All the randomness comes from `seed`.
+    """
+
+    def __init__(self, root, documents=3, items=100, link_density=1.0, foreign_fields=2, comments=0.2, attachments=0.05,
+                 seed=0):
+        #  type: (str, int, int, float, int, float, float, int) -> None
+        self.root = root
+        self.documents = documents
+        self.items = items
+        self.link_density = link_density
+        self.foreign_fields = foreign_fields
+        self.comments = comments
+        self.attachments = attachments
+        self.seed = seed
+        self._random = random.Random(seed)
+
+    @property
+    def prefixes(self):
+        #  type: () -> List[str]
+        names = ['RADN', 'RADN-SRS']
+        return (names + ['DOC{}'.format(i) for i in range(len(names), self.documents)])[:self.documents]
+
+    def _sentence(self, low=6, high=16):
+        #  type: (int, int) -> str
+        words = [self._random.choice(WORDS) for _ in range(self._random.randint(low, high))]
+        return ' '.join(words).capitalize() + '.'
+
+    def _text(self):
+        #  type: () -> str
+        paragraphs = []
+        for _ in range(self._random.randint(1, 4)):
+            paragraphs.append(' '.join(self._sentence() for _ in range(self._random.randint(1, 3))))
+        if self._random.random() < 0.1:
+            paragraphs.append('\n'.join('- ' + self._sentence(3, 6) for _ in range(3)))
+        return '\n\n'.join(paragraphs)
+
+    def _foreign_fields(self, index):
+        #  type: (int) -> Dict[str, Dict]
+        fields = {}
+        if index == 1:
+            fields['subsystem'] = {'type': 'single', 'description': 'Subsystem', 'choices': dict(SUBSYSTEMS)}
+        for n in range(self.foreign_fields):
+            kind = ['single', 'multi', 'string'][n % 3]
+            field = {'type': kind, 'description': 'Field {}'.format(n)}
+            if kind != 'string':
+                field['choices'] = {'c{}'.format(c): 'Choice {}'.format(c) for c in range(5)}
+            fields['field{}'.format(n)] = field
+        return fields
+
+    def _config(self, index):
+        #  type: (int) -> Dict
+        settings = {'digits': max(3, len(str(self.items))), 'prefix': self.prefixes[index], 'sep': ''}
+        if index > 0:
+            settings['parent'] = self.prefixes[index - 1]
+        config = {'settings': settings}
+        fields = self._foreign_fields(index)
+        if fields:
+            config['attributes'] = {'foreign-fields': fields}
+        return config
+
+    def _item(self, index, number, parents, fields):
+        #  type: (int, int, List[str], Dict[str, Dict]) -> Dict
+        data = {
+            'active': True,
+            'derived': False,
+            'header': self._sentence(2, 5).rstrip('.'),
+            'level': '{}.{}'.format(number // 20 + 1, number % 20 + 1),
+            'links': [],
+            'normative': True,
+            'ref': '',
+            'reviewed': None,
+            'text': Text(self._text()).yaml,
+        }
+        if parents:
+            count = int(self.link_density) + (1 if self._random.random() < self.link_density % 1 else 0)
+            data['links'] = [{uid: None} for uid in sorted(set(self._random.choice(parents) for _ in range(count)))]
+        if index == 0:
+            data['orig_ref'] = 'R-{:05d}'.format(number)
+        for name, field in fields.items():
+            if field['type'] == 'single':
+                data[name] = self._random.choice(sorted(field['choices']))
+            elif field['type'] == 'multi':
+                data[name] = sorted(set(self._random.choice(sorted(field['choices'])) for _ in range(2)))
+            else:
+                data[name] = self._sentence(1, 3)
+        if self._random.random() < self.comments:
+            data['comments'] = [{'date': '2021-0{}-1{}'.format(self._random.randint(1, 9), c), 'author': 'user{}'.format(c),
+                                 'text': self._sentence(), 'closed': self._random.random() < 0.5}
+                                for c in range(self._random.randint(1, 3))]
+        return data
+
+    def _write(self, path, data):
+        #  type: (str, Dict) -> None
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(dump_yaml(data))
+
+    def generate(self, commit=True):
+        #  type: (bool) -> str
+        """Write the tree, with `commit` in a new git repository with a single commit."""
+        os.makedirs(self.root, exist_ok=True)
+        parents = []  # type: List[str]
+        for index, prefix in enumerate(self.prefixes):
+            path = os.path.join(self.root, prefix.lower())
+            os.makedirs(path, exist_ok=True)
+            config = self._config(index)
+            self._write(os.path.join(path, '.doorstop.yml'), config)
+            fields = config.get('attributes', {}).get('foreign-fields', {})
+            digits = config['settings']['digits']
+            uids = []
+            for number in range(1, self.items + 1):
+                uid = '{}{}'.format(prefix, str(number).zfill(digits))
+                data = self._item(index, number, parents, fields)
+                if self._random.random() < self.attachments:
+                    asset = os.path.join('assets', '{}.txt'.format(uid))
+                    os.makedirs(os.path.join(path, 'assets'), exist_ok=True)
+                    with open(os.path.join(path, asset), 'w') as f:
+                        f.write(self._text())
+                    data['references'] = [{'path': asset, 'type': 'file'}]
+                self._write(os.path.join(path, uid + '.yml'), data)
+                uids.append(uid)
+            parents = uids
+        if commit:
+            self._commit()
+        return self.root
+
+    def _commit(self):
+        import pygit2
+        repo = pygit2.init_repository(self.root)
+        repo.index.add_all()
+        repo.index.write()
+        signature = pygit2.Signature('Synthetic', 'synthetic@example.com', 1600000000 + self.seed, 0)
+        repo.create_commit('HEAD', signature, signature, 'Synthetic tree (seed {})'.format(self.seed), repo.index.write_tree(), [])
+
+
+def generate_repository(root, seed=0, commit=True, **kwargs):
+    #  type: (str, int, bool, Any) -> str
+    return SyntheticRepository(root, seed=seed, **kwargs).generate(commit=commit)
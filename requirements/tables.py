@@ -1,16 +1,26 @@
-import markdown2
-
+import datetime
+import hashlib
+import os
+from typing import Optional, Any, List, TYPE_CHECKING
+
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
 from django.utils.html import format_html
+from django.utils.http import urlencode
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from django_markdown2.templatetags.md2 import force_unicode
-from django_tables2 import Table, Column, BooleanColumn, CheckBoxColumn
-from doorstop import Item
+from django_tables2 import Table, Column, BooleanColumn, CheckBoxColumn, DateTimeColumn
+from doorstop import DoorstopError, Item
 
 from doorstop.core.validators.item_validator import ItemValidator
-from pygit2 import GIT_STATUS_WT_MODIFIED, GIT_STATUS_INDEX_MODIFIED, GIT_STATUS_WT_NEW
 
-from requirements.djdoorstop import DjItem
+from requirements.djdoorstop import DjItem, SuspectLinks
+from requirements.metrics import VALIDATIONS
+from requirements.timing import count, phase
+
+if TYPE_CHECKING:
+    from requirements.history import HistoryIndex
 
 
 class GitFileStatus(Table):
@@ -39,6 +49,31 @@ class GitFileStatus(Table):
         return html
 
 
+class GitDiffTable(Table):
+    name = Column(verbose_name='File name', orderable=False)
+    status_text = Column(verbose_name='Status', orderable=False)
+    additions = Column(verbose_name='+', orderable=False, default='')
+    deletions = Column(verbose_name='-', orderable=False, default='')
+
+    class Meta:
+        template_name = "django_tables2/bootstrap4.html"
+
+    def __init__(self, data=None):
+        super().__init__(data, attrs={'class': 'table table-sm'})
+
+    @staticmethod
+    def render_name(value, record):
+        return format_html('<a class="vcs-diff-file" href="?{}" data-path="{}">{}</a>', urlencode({'p': record.name}), record.name, value)
+
+    @staticmethod
+    def render_additions(value):
+        return format_html('<span class="text-success">+{}</span>', value)
+
+    @staticmethod
+    def render_deletions(value):
+        return format_html('<span class="text-danger">-{}</span>', value)
+
+
 class ParentRequirementTable(Table):
     document = Column(verbose_name='Doc.')
     uid = Column(verbose_name='Parent req')
@@ -89,27 +124,101 @@ class ExtendedFields(Column):
             return value
 
 
+def row_cache():
+    return caches[getattr(settings, 'DOORSTOP_ROW_CACHE', 'default')]
+
+
 class RequirementsTable(Table):
+    selection = CheckBoxColumn(accessor='uid', orderable=False, attrs={'th__input': {'onclick': 'toggleSelection(this)'}})
     uid = Column()
     header = Column()
     text = Column()
     level = Column()
     reviewed = BooleanColumn(verbose_name='R.', orderable=False)
     normative = BooleanColumn(verbose_name='N.', orderable=False)
+    last_change = Column(verbose_name='Last change', empty_values=(), orderable=False)
     actions = Column(empty_values=())
 
+    # Bump when the rendering of the rows changes
+    ROW_CACHE_VERSION = 1
+
     class Meta:
-        template_name = "django_tables2/bootstrap4.html"
+        template_name = "requirements/requirements_table.html"
         row_attrs = {
+            "data-uid": lambda record: record.uid,
             "data-heading": lambda record: record.heading,
             "style": lambda record: row_style(record)
 
         }
         order_by = 'level'
 
-    def __init__(self, **kwargs):
+    def __init__(self, history=None, **kwargs):
+        #  type: (Optional[HistoryIndex], Any) -> None
         super().__init__(**kwargs)
         self._validator = ItemValidator()
+        self._history = history
+
+    @staticmethod
+    def links_key(record):
+        #  type: (DjItem) -> tuple
+        """State of the items linked to and from an item, which its validation issues depend on.
+
+        A parent is known by its stamp and flags (None when unknown), the children by UID.
+        """
+        parents = []
+        for uid in record.links:
+            try:
+                parent = record.tree.find_item(uid)
+            except DoorstopError:
+                parents.append((str(uid), None))
+            else:
+                parents.append((str(uid), str(parent.stamp()), parent.active, parent.normative, parent.deleted))
+        children = sorted(str(child.uid) for child in SuspectLinks.of(record.tree).children(record))
+        return tuple(parents), tuple(children)
+
+    def row_key(self, row):
+        """Cache key of the rendered row, changing when the item file is saved.
+
+        It also covers what the row shows of the rest of the tree (the cleared state of
+        the links, the linked items and the last commit) and the viewer (permission class,
+        row parity).
+        """
+        record = row.record  # type: DjItem
+        try:
+            stat = os.stat(record.path)
+            stat = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stat = None
+        change = self._history.last_change(record.path) if self._history else None
+        request = getattr(self, 'request', None)
+        internal = request is not None and request.user.has_perm('requirements.internal')
+        links = RequirementsTable.links_key(record) if record.tree is not None else None
+        parts = (RequirementsTable.ROW_CACHE_VERSION, record.path, stat, record.cleared, links, change.commit_id if change else None,
+                 internal, row.get_even_odd_css_class(), tuple(c.name for c in self.columns))
+        return 'requirements-row:' + hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    @property
+    def cached_rows(self):
+        #  type: () -> List[str]
+        """HTML of the rows of the current page; only the rows missing from the cache are rendered."""
+        rows = list(self.paginated_rows)
+        keys = [self.row_key(row) for row in rows]
+        cache = row_cache()
+        cached = cache.get_many(keys)
+        rendered = {}
+        html = []
+        for key, row in zip(keys, rows):
+            fragment = cached.get(key)
+            if fragment is None:
+                fragment = render_to_string('requirements/table_row.html', {'table': self, 'row': row})
+                # Validation may have reformatted the file while rendering
+                rendered[self.row_key(row)] = fragment
+            html.append(mark_safe(fragment))
+        if rendered:
+            cache.set_many(rendered, getattr(settings, 'DOORSTOP_ROW_CACHE_TIMEOUT', 600))
+        count('row-cache-hit', len(cached))
+        count('row-cache-miss', len(rows) - len(cached))
+        return html
 
     @staticmethod
     def all_comments_closed(record):
@@ -139,7 +248,18 @@ class RequirementsTable(Table):
             pos = value.find('\n')
             if pos > 0:
                 value = value[0:pos]
-        return mark_safe(markdown2.markdown(force_unicode(value), safe_mode=True, extras=['tables']))
+        # markdown2 is loaded with the first table rendered
+        import markdown2
+        from django_markdown2.templatetags.md2 import force_unicode
+        with phase('markdown'):
+            return mark_safe(markdown2.markdown(force_unicode(value), safe_mode=True, extras=['tables']))
+
+    def render_last_change(self, record):
+        # type: (DjItem) -> str
+        change = self._history.last_change(record.path) if self._history else None
+        if change is None:
+            return ''
+        return format_html('<span title="{}">{}<br><small>{}</small></span>', change.summary, change.author, change.date.strftime('%Y-%m-%d %H:%M'))
 
     def render_actions(self, record):
         # type: (DjItem) -> str
@@ -170,7 +290,8 @@ class RequirementsTable(Table):
                 html += format_html('<a href="{}" class="btn btn-outline-warning btn-sm" title="There are open comments"><i class="fa fa-comments"></i></a>',
                                     reverse('item-details', args=[record.document.prefix, record.uid.value]))
 
-            issues = [str(x) for x in self._validator.get_issues(record)]
+            with phase('validate', VALIDATIONS):
+                issues = [str(x) for x in self._validator.get_issues(record)]
             if len(issues) > 0:
                 html += format_html('<a href="{}" class="btn btn-outline-danger btn-sm" title="There are open issues"><i class="fa fa-exclamation-triangle"></i></a>',
                                     reverse('item-details', args=[record.document.prefix, record.uid.value]))
@@ -181,17 +302,21 @@ class RequirementsTable(Table):
 
 
 class TrashcanItem(object):
-    def __init__(self, _doc, _uid):
+    def __init__(self, _doc, _uid, header='', text='', deleted=0.0, size=0):
         self.uid = _uid
         self.document = _doc
-        self.header = ''
-        self.text = ''
+        self.header = header
+        self.text = text
+        self.deleted = datetime.datetime.fromtimestamp(deleted) if deleted else None
+        self.size = size
 
 
 class TrashcanRequirementsTable(Table):
     uid = Column()
     header = Column()
     text = Column()
+    deleted = DateTimeColumn(format='Y-m-d H:i')
+    size = Column()
     actions = Column(empty_values=())
 
     class Meta:
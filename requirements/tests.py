@@ -1,3 +1,593 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Permission, User
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from doorstop import DoorstopError
+from doorstop.core.builder import build
+
+from requirements.djdoorstop import WriteBatch
+from requirements.forms import ForeignFieldSet, ItemUpdateForm
+from requirements.linkindex import LinkIndexCache
+from requirements.reorder import ReorderPlan
+from requirements.snapshot import TreeSnapshot
+from requirements.tables import RequirementsTable
+from requirements.trashcan import TrashcanIndex
+from requirements.treecache import TreeLock, tree_cache
+from requirements.utils import repository_path, worktree_name
+from requirements.watcher import RepositoryWatcher
+from requirements.worklist import Worklist, WorkEntry
+
+
+class TreeMixin(object):
+    """Fixture tree in a temporary git repository: document A with items A001-A003 and
+    document B (child of A) with B001 linked to A001 and B002 linked to A002.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        subprocess.run(['git', 'init', '-q', self.root], check=True)
+        tree = build(cwd=self.root, root=self.root)
+        tree.create_document(os.path.join(self.root, 'a'), 'A')
+        tree.create_document(os.path.join(self.root, 'b'), 'B', parent='A')
+        for _ in range(3):
+            tree.add_item('A')
+        for _ in range(2):
+            tree.add_item('B')
+        tree.link_items('B001', 'A001')
+        tree.link_items('B002', 'A002')
+        for uid in ('B001', 'B002'):
+            tree.find_item(uid).clear()
+        self.tree = self.build()
+
+    def build(self):
+        return build(cwd=self.root, root=self.root)
+
+    def read(self, uid):
+        with open(self.tree.find_item(uid).path) as f:
+            return f.read()
+
+
+class TreeTestCase(TreeMixin, TestCase):
+    pass
+
+
+class WriteBatchTest(TreeTestCase):
+    def test_flush_writes_once(self):
+        item = self.tree.find_item('A001')
+        generation = item.generation
+        with WriteBatch():
+            item.text = 'first'
+            item.header = 'second'
+            self.assertEqual(item.generation, generation)
+        self.assertEqual(item.generation, generation + 1)
+        self.assertIn('second', self.read('A001'))
+        self.assertEqual(self.build().find_item('A001').text, 'first')
+
+    def test_block_error_reloads_items(self):
+        item = self.tree.find_item('A001')
+        with self.assertRaises(ValueError):
+            with WriteBatch():
+                item.text = 'lost'
+                raise ValueError()
+        self.assertNotEqual(item.text, 'lost')
+        self.assertNotIn('lost', self.read('A001'))
+
+    def test_failed_write_reloads_the_rest(self):
+        items = [self.tree.find_item(uid) for uid in ('A001', 'A002', 'A003')]
+        failing = items[1].path
+        write_atomic = 'requirements.djdoorstop.write_atomic'
+
+        def write(text, path):
+            if path == failing:
+                raise OSError('disk full')
+            with open(path, 'w') as f:
+                f.write(text)
+
+        batch = WriteBatch()
+        with mock.patch(write_atomic, side_effect=write):
+            with self.assertRaises(OSError):
+                with batch:
+                    for item in items:
+                        item.text = 'new ' + str(item.uid)
+        self.assertEqual(batch.items, [])
+        self.assertIn('new A001', self.read('A001'))
+        self.assertNotEqual(items[1].text, 'new A002')
+        self.assertNotEqual(items[2].text, 'new A003')
+        self.assertNotIn('new A003', self.read('A003'))
+
+    def test_parallel_flush_updates_the_children(self):
+        parent = self.tree.find_item('A001')
+        child = self.tree.find_item('B001')
+        self.assertTrue(child.cleared)
+        with WriteBatch(workers=4):
+            parent.text = 'changed'
+            self.tree.find_item('A002').text = 'changed'
+        self.assertFalse(child.cleared)
+        self.assertFalse(self.tree.find_item('B002').cleared)
+
+
+    def test_staged_changes_are_seen_before_the_flush(self):
+        parent = self.tree.find_item('A001')
+        child = self.tree.find_item('B001')
+        self.assertTrue(child.cleared)
+        with WriteBatch():
+            parent.text = 'changed'
+            self.assertFalse(child.cleared)
+            child.link('A003')
+            child.clear()
+            self.assertTrue(child.cleared)
+        self.assertTrue(child.cleared)
+
+
+class TrashcanIndexTest(TreeTestCase):
+    def test_concurrent_adds_keep_every_entry(self):
+        document = self.tree.find_document('A')
+        trash = os.path.join(document.path, 'trash')
+        os.mkdir(trash)
+        filename = os.path.join(self.root, '.cache', 'trashcan-A.json')
+        os.mkdir(os.path.dirname(filename))
+        paths = []
+        for n in range(8):
+            paths.append(os.path.join(trash, 'A1{:02}.yml'.format(n)))
+            shutil.copy2(self.tree.find_item('A001').path, paths[-1])
+
+        def add(path):
+            TrashcanIndex(document, filename).add(path)
+
+        threads = [threading.Thread(target=add, args=(path,)) for path in paths]
+        with mock.patch.object(TrashcanIndex, '_stale', return_value=False):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(TrashcanIndex(document, filename).entries()), 8)
+
+
+class ItemGenerationTest(TreeTestCase):
+    def test_stamp_is_memoized_per_generation(self):
+        item = self.tree.find_item('A001')
+        stamp = item.stamp()
+        with mock.patch('doorstop.Item.stamp', side_effect=AssertionError('stamp computed again')):
+            self.assertEqual(item.stamp(), stamp)
+        item.text = 'changed'
+        self.assertNotEqual(item.stamp(), stamp)
+
+    def test_unchanged_save_keeps_the_generation(self):
+        item = self.tree.find_item('A001')
+        item.save()
+        generation, mtime = item.generation, os.stat(item.path).st_mtime_ns
+        item.save()
+        self.assertEqual(item.generation, generation)
+        self.assertEqual(os.stat(item.path).st_mtime_ns, mtime)
+        item.text = 'changed'
+        self.assertEqual(item.generation, generation + 1)
+
+    def test_parent_change_makes_children_suspect(self):
+        child = self.tree.find_item('B001')
+        other = self.tree.find_item('B002')
+        self.assertTrue(child.cleared)
+        self.tree.find_item('A001').text = 'changed'
+        self.assertFalse(child.cleared)
+        self.assertTrue(other.cleared)
+        child.clear()
+        self.assertTrue(child.cleared)
+
+    def test_relinked_child_follows_its_new_parent(self):
+        child = self.tree.find_item('B001')
+        child.unlink('A001')
+        child.link('A003')
+        child.clear()
+        self.tree.find_item('A001').text = 'changed'
+        self.assertTrue(child.cleared)
+        self.tree.find_item('A003').text = 'changed'
+        self.assertFalse(child.cleared)
+
+
+class ReorderPlanTest(TreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.tree.find_document('A')
+
+    def index(self, heading, *uids):
+        # The fixture items are 1.0 (A001), 1.1 and 1.2
+        return 'initial: 1.0\noutline:\n- {}: # Heading\n'.format(heading) + ''.join('    - {}:\n'.format(uid) for uid in uids)
+
+    def test_only_moved_items_are_written(self):
+        mtime = os.stat(self.tree.find_item('A001').path).st_mtime_ns
+        plan = ReorderPlan(self.document, self.index('A001', 'A003', 'A002'))
+        self.assertEqual([(c.uid, str(c.new)) for c in plan.changes], [('A002', '1.2'), ('A003', '1.1')])
+        self.assertEqual(plan.apply(), 2)
+        self.assertEqual(os.stat(self.tree.find_item('A001').path).st_mtime_ns, mtime)
+        levels = {str(i.uid): str(i.level) for i in self.build().find_document('A').items}
+        self.assertEqual(levels, {'A001': '1.0', 'A002': '1.2', 'A003': '1.1'})
+
+    def test_current_index_changes_nothing(self):
+        self.assertEqual(ReorderPlan(self.document, ReorderPlan.index_of(self.document)).changes, [])
+
+    def test_missing_items_are_rejected(self):
+        with self.assertRaises(DoorstopError):
+            ReorderPlan(self.document, self.index('A001', 'A003'))
+        self.assertEqual(len(self.build().find_document('A').items), 3)
+
+    def test_unknown_items_are_rejected(self):
+        with self.assertRaises(DoorstopError):
+            ReorderPlan(self.document, self.index('A001', 'A002', 'A003', 'A004'))
+        with self.assertRaises(DoorstopError):
+            ReorderPlan(self.document, self.index('A001', 'A002', 'A002', 'A003'))
+
+
+class ApiMixin(TreeMixin):
+    """Fixture tree served as the repository of the application."""
+
+    def setUp(self):
+        super().setUp()
+        settings = override_settings(DOORSTOP_REPO=self.root, DOORSTOP_USER_WORKTREES=False, DOORSTOP_CACHE_DIR=None,
+                                     DOORSTOP_API_TOKENS={'secret': 'api'})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(tree_cache.invalidate, self.root)
+        self.user = User.objects.create_user('api', password='api')
+        self.client.force_login(self.user)
+        self.tree = tree_cache.get(self.root)
+
+
+class ApiTestCase(ApiMixin, TestCase):
+    pass
+
+
+class ItemsApiTest(ApiTestCase):
+    def patch(self, entries, client=None, **extra):
+        return (client or self.client).patch(reverse('api-items'), json.dumps({'items': entries}),
+                                             content_type='application/json', **extra)
+
+    def test_get_items(self):
+        response = self.client.get(reverse('api-items'), {'uids': 'A001,B001,X001', 'fields': 'links,children'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['missing'], ['X001'])
+        self.assertEqual(data['items'][0], {'uid': 'A001', 'links': [], 'children': ['B001']})
+        self.assertEqual(data['items'][1]['links'], ['A001'])
+
+    def test_patch_updates_items_and_links(self):
+        response = self.patch([{'uid': 'A001', 'attributes': {'text': 'new text', 'normative': False}},
+                               {'uid': 'B001', 'links': {'add': ['A003'], 'remove': ['A001']}}])
+        self.assertEqual(response.status_code, 200)
+        tree = self.build()
+        self.assertEqual(tree.find_item('A001').text, 'new text')
+        self.assertFalse(tree.find_item('A001').normative)
+        self.assertEqual([str(uid) for uid in tree.find_item('B001').links], ['A003'])
+
+    def test_invalid_entries_change_nothing(self):
+        before = self.read('A001')
+        for attributes in ({'level': 'abc'}, {'level': True}, {'normative': 'no'}, {'text': 3}, {'uid': 'A002'}):
+            response = self.patch([{'uid': 'A001', 'attributes': {'text': 'lost'}}, {'uid': 'A002', 'attributes': attributes}])
+            self.assertEqual(response.status_code, 400, attributes)
+        self.assertEqual(self.patch([{'uid': 'A001', 'links': {'add': ['X001']}}]).status_code, 400)
+        self.assertEqual(self.patch([{'uid': 'X001'}]).status_code, 400)
+        self.assertEqual(self.read('A001'), before)
+
+    def test_batch_errors_are_bad_requests(self):
+        with mock.patch('requirements.djdoorstop.DjItem.link', side_effect=DoorstopError('link failed')):
+            response = self.patch([{'uid': 'A001', 'attributes': {'text': 'lost'}, 'links': {'add': ['A002']}}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'], 'link failed')
+        self.assertNotEqual(self.tree.find_item('A001').text, 'lost')
+
+    def test_token_authentication(self):
+        client = Client(enforce_csrf_checks=True)
+        entry = [{'uid': 'A001', 'attributes': {'text': 'by token'}}]
+        self.assertEqual(self.patch(entry, client).status_code, 403)
+        self.assertEqual(self.patch(entry, client, HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.patch(entry, client, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        self.assertEqual(self.build().find_item('A001').text, 'by token')
+
+    def test_session_needs_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        self.assertEqual(self.patch([{'uid': 'A001', 'attributes': {'text': 'forged'}}], client).status_code, 403)
+
+
+class MetricsTest(TestCase):
+    @override_settings(DOORSTOP_METRICS_TOKEN='scraper')
+    def test_metrics_need_a_token_or_staff(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer scraper').status_code, 200)
+        user = User.objects.create_user('metrics')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with override_settings(DOORSTOP_METRICS_ALLOWED=['10.0.0.1']):
+            self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class RepositoryWatcherTest(TestCase):
+    def test_changes_are_scanned_in_the_background(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        watcher = RepositoryWatcher(root, interval=0.02)
+        generation = watcher.poll()
+        with mock.patch.object(watcher, '_scan', wraps=watcher._scan) as scan:  # pylint: disable=protected-access
+            watcher.poll()
+            self.assertEqual(scan.call_count, 0)
+            with open(os.path.join(root, 'new.yml'), 'w') as f:
+                f.write('text: new\n')
+            for _ in range(250):
+                if watcher.poll() != generation:
+                    break
+                time.sleep(0.02)
+            self.assertNotEqual(watcher.poll(), generation)
+            self.assertIsNone(watcher.changes_since(generation))
+
+    def test_writes_of_the_application_are_logged(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        watcher = RepositoryWatcher(root, interval=0.02)
+        generation = watcher.poll()
+        path = os.path.join(root, 'new.yml')
+        with open(path, 'w') as f:
+            f.write('text: new\n')
+        watcher.touch(path)
+        time.sleep(0.1)
+        self.assertEqual(watcher.changes_since(generation), {path})
+
+
+class WorktreeTest(TestCase):
+    def test_names_are_unique(self):
+        names = {worktree_name(User(username=name)) for name in ('a b', 'a_b', 'a/b')}
+        self.assertEqual(len(names), 3)
+
+    def test_login_before_the_first_commit(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        subprocess.run(['git', 'init', '-q', os.path.join(root, 'repo')], check=True)
+        repo = os.path.join(root, 'repo')
+        with override_settings(DOORSTOP_REPO=repo, DOORSTOP_USER_WORKTREES=True,
+                               DOORSTOP_WORKTREES_ROOT=os.path.join(root, 'worktrees')):
+            user = User.objects.create_user('unborn')
+            self.client.force_login(user)
+            self.assertEqual(repository_path(user), repo)
+            subprocess.run(['git', '-C', repo, '-c', 'user.name=t', '-c', 'user.email=t@t',
+                            'commit', '-q', '--allow-empty', '-m', 'first'], check=True)
+            self.assertEqual(repository_path(user), os.path.join(root, 'worktrees', worktree_name(user)))
+
+
+@override_settings(DOORSTOP_EVENTS_WAIT=1.0, DOORSTOP_WATCH_INTERVAL=0.05)
+class RepositoryEventsTest(ApiMixin, TransactionTestCase):
+    # The view reads the session in a thread of the events pool
+    def test_changes_are_streamed(self):
+        url = reverse('events')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn(': watching', text)
+        watermark = text.split('id: ')[1].split('\n')[0]
+        self.tree.find_item('A001').text = 'changed'
+        text = self.client.get(url, HTTP_LAST_EVENT_ID=watermark).content.decode()
+        self.assertIn('event: change', text)
+        self.assertIn('A001', text)
+
+    def test_wsgi_answers_without_waiting(self):
+        url = reverse('events')
+        watermark = self.client.get(url).content.decode().split('id: ')[1].split('\n')[0]
+        start = time.monotonic()
+        with override_settings(DOORSTOP_EVENTS_WAIT=30.0):
+            text = self.client.get(url, HTTP_LAST_EVENT_ID=watermark).content.decode()
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertIn('retry: 30000', text)
+        self.assertNotIn('event:', text)
+
+    def test_anonymous_requests_are_forbidden(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('events')).status_code, 403)
+
+
+class RowKeyTest(TreeTestCase):
+    def key(self, uid):
+        table = RequirementsTable(data=list(self.tree.find_document('B').items))
+        return {row.record.uid.value: table.row_key(row) for row in table.rows}[uid]
+
+    def test_parent_changes_invalidate_the_child_row(self):
+        key = self.key('B001')
+        self.assertEqual(self.key('B001'), key)
+        parent = self.tree.find_item('A001')
+        parent.normative = False
+        self.assertNotEqual(self.key('B001'), key)
+        key = self.key('B001')
+        parent.deleted = True
+        self.assertNotEqual(self.key('B001'), key)
+        key = self.key('B002')
+        self.tree.find_item('B001').link('A002')
+        self.assertEqual(self.key('B002'), key)
+
+    def test_unknown_parent_changes_the_key(self):
+        key = self.key('B001')
+        parent = self.tree.find_item('A001')
+        parent.delete()
+        self.assertNotEqual(self.key('B001'), key)
+
+
+class ForeignFieldSetTest(TreeTestCase):
+    FIELDS = {'status': {'type': 'single', 'choices': {'b': 'Beta', 'a': 'Alpha'}}, 'owner': {'type': 'string'}}
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch.object(type(self.tree.find_document('A')), 'forgein_fields', new_callable=mock.PropertyMock,
+                                  return_value=self.FIELDS)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_forms_get_their_own_fields(self):
+        item = self.tree.find_item('A001')
+        item.set('status', 'b')
+        first, second = ItemUpdateForm(item=item), ItemUpdateForm(item=item)
+        self.assertEqual(list(first.fields['status'].choices), [('a', 'Alpha'), ('b', 'Beta')])
+        self.assertEqual(first.initial['status'], 'b')
+        self.assertIsNot(first.fields['status'], second.fields['status'])
+        self.assertIs(first.fields['status'].choices, second.fields['status'].choices)
+        first.fields['status'].choices = [('c', 'Gamma')]
+        first.fields['owner'].widget.attrs['readonly'] = True
+        self.assertEqual(list(second.fields['status'].choices), [('a', 'Alpha'), ('b', 'Beta')])
+        self.assertNotIn('readonly', second.fields['owner'].widget.attrs)
+        self.assertNotIn('readonly', ItemUpdateForm(item=item).fields['owner'].widget.attrs)
+
+    def test_field_set_is_built_once_per_configuration(self):
+        document = self.tree.find_document('A')
+        ForeignFieldSet.invalidate(document)
+        foreign = ForeignFieldSet.for_document(document)
+        self.assertIs(ForeignFieldSet.for_document(document), foreign)
+        ForeignFieldSet.invalidate(document)
+        self.assertIsNot(ForeignFieldSet.for_document(document), foreign)
+
+
+class LinkIndexTest(TreeTestCase):
+    def test_children_follow_the_links(self):
+        with override_settings(DOORSTOP_CACHE_DIR=os.path.join(self.root, '.cache')):
+            cache = LinkIndexCache()
+            index = cache.get(self.root, self.tree)
+            self.assertEqual([r.uid for r in index.children('A001')], ['B001'])
+            self.tree.find_item('B002').link('A001')
+            index = cache.get(self.root, self.tree)
+            self.assertEqual([r.uid for r in index.children('A001')], ['B001', 'B002'])
+            self.assertEqual([r.uid for r in index.parents('B002')], ['A001', 'A002'])
+
+
+class TreeSnapshotTest(TreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.filename = os.path.join(tempfile.mkdtemp(), 'snapshot.pickle')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.filename), True)
+        # Files modified within RACY_NS are not stored
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                os.utime(os.path.join(dirpath, name), ns=(10 ** 18, 10 ** 18))
+
+    def hydrate(self):
+        snapshot = TreeSnapshot(self.root, self.filename)
+        with mock.patch('requirements.djdoorstop.snapshot_for', return_value=snapshot):
+            snapshot.hydrate(self.root)
+        return snapshot
+
+    def test_unchanged_files_are_not_parsed_again(self):
+        self.assertGreaterEqual(self.hydrate().misses, 5)
+        self.assertEqual(self.hydrate().misses, 0)
+
+    def test_tampered_snapshot_is_not_unpickled(self):
+        self.hydrate()
+        with open(self.filename, 'rb') as f:
+            blob = bytearray(f.read())
+        blob[-2] ^= 0xff
+        with open(self.filename, 'wb') as f:
+            f.write(blob)
+        with mock.patch('requirements.snapshot.pickle.loads', side_effect=AssertionError('unpickled')):
+            with self.assertLogs('requirements.snapshot', 'WARNING'):
+                snapshot = TreeSnapshot(self.root, self.filename)
+                snapshot._read()  # pylint: disable=protected-access
+        self.assertEqual(snapshot._entries, {})  # pylint: disable=protected-access
+
+    def test_snapshot_signed_with_another_key_is_discarded(self):
+        misses = self.hydrate().misses
+        with override_settings(SECRET_KEY='another key'):
+            self.assertEqual(self.hydrate().misses, misses)
+
+
+class TreeLockTest(TestCase):
+    def test_readers_share_and_writers_exclude(self):
+        lock = TreeLock()
+        entered = threading.Event()
+
+        def read():
+            with lock.reading():
+                entered.set()
+
+        def write():
+            with lock.writing():
+                entered.set()
+
+        with lock.reading():
+            thread = threading.Thread(target=read)
+            thread.start()
+            self.assertTrue(entered.wait(5))
+            thread.join()
+            entered.clear()
+            thread = threading.Thread(target=write)
+            thread.start()
+            self.assertFalse(entered.wait(0.1))
+        self.assertTrue(entered.wait(5))
+        thread.join()
+
+    def test_writer_reenters_and_reads(self):
+        lock = TreeLock()
+        with lock.writing():
+            with lock.writing():
+                with lock.reading():
+                    pass
+        with lock.writing():
+            pass
+
+
+class WorklistTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        for uid in ('A001', 'A002', 'A003', 'B002'):
+            self.tree.find_item(uid).review()
+
+    def work(self, **query):
+        response = self.client.get(reverse('api-worklist'), query)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_entries_follow_the_items(self):
+        worklist = Worklist.of(self.tree)
+        self.assertEqual([(e.uid, e.kinds) for e in worklist.entries(self.tree)], [('B001', (WorkEntry.UNREVIEWED,))])
+        self.tree.find_item('A001').text = 'changed'
+        self.tree.find_item('A002').pending = True
+        entries = {e.uid: e for e in worklist.entries(self.tree)}
+        self.assertEqual(sorted(entries), ['A001', 'A002', 'B001'])
+        self.assertEqual(entries['A001'].kinds, (WorkEntry.UNREVIEWED,))
+        self.assertEqual(entries['B001'].kinds, (WorkEntry.UNREVIEWED, WorkEntry.SUSPECT))
+        self.assertEqual(entries['B001'].suspects, ['A001'])
+        self.assertIn(WorkEntry.PENDING, entries['A002'].kinds)
+        self.tree.find_item('B001').clear()
+        self.assertNotIn(WorkEntry.SUSPECT, {e.uid: e for e in worklist.entries(self.tree)}['B001'].kinds)
+
+    def test_api_filters_and_pages(self):
+        for uid in ('A001', 'A002', 'A003'):
+            self.tree.find_item(uid).text = 'changed'
+        data = self.work(kind='unreviewed', limit=2)
+        self.assertEqual([e['uid'] for e in data['items']], ['A001', 'A002'])
+        self.assertEqual(data['counts'][WorkEntry.SUSPECT], 2)
+        data = self.work(kind='unreviewed', limit=2, cursor=data['next'])
+        self.assertEqual([e['uid'] for e in data['items']], ['A003', 'B001'])
+        self.assertIsNone(data['next'])
+        data = self.work(kind='suspect', doc='B')
+        self.assertEqual([(e['uid'], e['kinds'], e['suspect_parents']) for e in data['items']],
+                         [('B001', ['suspect'], ['A001']), ('B002', ['suspect'], ['A002'])])
+
+    def test_comments_are_listed_to_internal_users(self):
+        item = self.tree.find_item('A003')
+        item.set('comments', [{'text': 'open'}, {'text': 'done', 'closed': True}])
+        self.assertEqual(self.client.get(reverse('api-worklist'), {'kind': 'comments'}).status_code, 400)
+        self.assertEqual(self.work()['counts'][WorkEntry.COMMENTS], 0)
+        self.user.user_permissions.add(Permission.objects.get(codename='internal'))
+        self.client.force_login(User.objects.get(pk=self.user.pk))
+        data = self.work(kind='comments')
+        self.assertEqual([(e['uid'], e['open_comments']) for e in data['items']], [('A003', 1)])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(reverse('api-worklist'), {'kind': 'nothing'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api-worklist'), {'cursor': 'bad'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api-worklist'), {'doc': 'X'}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('worklist')).status_code, 200)
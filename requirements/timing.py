@@ -0,0 +1,139 @@
+import contextvars
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional
+
+
+class RequestTimings(object):
+    """Time spent in each phase of a request and the number of times the phase was entered.
+
+    Nested phases with the same name are timed once, by the outermost one. Phases with
+    different names may overlap (the tree build includes YAML parsing).
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.total = None  # type: Optional[float]
+        self.phases = {}  # type: Dict[str, List]
+        self.counters = {}  # type: Dict[str, int]
+        self._depth = {}  # type: Dict[str, int]
+
+    def enter(self, name):
+        #  type: (str) -> Optional[float]
+        depth = self._depth.get(name, 0)
+        self._depth[name] = depth + 1
+        return time.perf_counter() if depth == 0 else None
+
+    def exit(self, name, start):
+        #  type: (str, Optional[float]) -> None
+        self._depth[name] -= 1
+        if start is not None:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        #  type: (str, float) -> None
+        entry = self.phases.get(name)
+        if entry is None:
+            self.phases[name] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def count(self, name, value=1):
+        #  type: (str, int) -> None
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self):
+        #  type: () -> float
+        self.total = time.perf_counter() - self.start
+        return self.total
+
+    def header(self):
+        #  type: () -> str
+        """Value of the Server-Timing header."""
+        metrics = ['{};dur={:.1f};desc="{} calls"'.format(name, seconds * 1000, count)
+                   for name, (seconds, count) in self.phases.items()]
+        metrics.extend('{};desc="{}"'.format(name, value) for name, value in self.counters.items())
+        if self.total is not None:
+            metrics.append('total;dur={:.1f}'.format(self.total * 1000))
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        #  type: () -> Dict
+        return {
+            'total_ms': round((self.total or 0.0) * 1000, 2),
+            'phases': {name: {'ms': round(seconds * 1000, 2), 'count': count} for name, (seconds, count) in self.phases.items()},
+            'counters': dict(self.counters),
+        }
+
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+def current_timings():
+    #  type: () -> Optional[RequestTimings]
+    return _current.get()
+
+
+def start_timings():
+    #  type: () -> contextvars.Token
+    return _current.set(RequestTimings())
+
+
+def stop_timings(token):
+    #  type: (contextvars.Token) -> RequestTimings
+    timings = _current.get()
+    _current.reset(token)
+    timings.finish()
+    return timings
+
+
+class phase(object):
+    """Context manager timing a phase of the current request.
+
+    With a `metric` (anything with an `observe(seconds)` method) the duration is
+    observed also outside requests; otherwise nothing is done outside requests.
+    """
+
+    __slots__ = ('_name', '_metric', '_timings', '_start', '_begin')
+
+    def __init__(self, name, metric=None):
+        #  type: (str, Any) -> None
+        self._name = name
+        self._metric = metric
+        self._timings = None
+        self._start = None
+        self._begin = None
+
+    def __enter__(self):
+        self._timings = _current.get()
+        if self._timings is not None:
+            self._start = self._timings.enter(self._name)
+        if self._metric is not None:
+            self._begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._timings is not None:
+            self._timings.exit(self._name, self._start)
+        if self._metric is not None:
+            self._metric.observe(time.perf_counter() - self._begin)
+
+
+def timed(name, metric=None):
+    #  type: (str, Any) -> Callable
+    """Decorator timing every call of a function as a phase."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name, metric):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    #  type: (str, int) -> None
+    timings = _current.get()
+    if timings is not None:
+        timings.count(name, value)
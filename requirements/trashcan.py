@@ -0,0 +1,147 @@
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from doorstop import DoorstopError
+from doorstop.core import Document
+
+from requirements.codec import load_yaml
+from requirements.djdoorstop import write_atomic
+
+_log = logging.getLogger(__name__)
+
+
+class TrashcanEntry(object):
+    def __init__(self, uid, header='', text='', deleted=0.0, size=0):
+        #  type: (str, str, str, float, int) -> None
+        self.uid = uid
+        self.header = header
+        self.text = text
+        self.deleted = deleted
+        self.size = size
+
+    def to_list(self):
+        return [self.uid, self.header, self.text, self.deleted, self.size]
+
+    @staticmethod
+    def from_file(path, deleted=None):
+        #  type: (str, Optional[float]) -> TrashcanEntry
+        stat = os.stat(path)
+        with open(path, 'r') as f:
+            data = load_yaml(f.read(), path)
+        text = data.get('text') or ''
+        return TrashcanEntry(os.path.splitext(os.path.basename(path))[0], data.get('header') or '', text.partition('\n')[0],
+                             stat.st_ctime if deleted is None else deleted, stat.st_size)
+
+
+class TrashcanIndex(object):
+    """Summary of the items in the trash folder of a document, persisted as JSON.
+
+    The index is maintained when items are deleted or restored. When the trash folder
+    was changed by someone else (its mtime differs from the recorded one) only the
+    files missing from the index are parsed. An index is opened per request: its
+    updates read the file again and write it under a lock on a sidecar file, so the
+    threads and the processes do not lose each other's entries.
+    """
+
+    VERSION = 1
+
+    def __init__(self, doc, filename):
+        #  type: (Document, str) -> None
+        self._path = os.path.join(doc.path, 'trash')
+        self._filename = filename
+        self._entries = {}  # type: Dict[str, TrashcanEntry]
+        self._mtime = None
+        self._read()
+
+    def _read(self):
+        try:
+            with open(self._filename, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get('version') != TrashcanIndex.VERSION:
+            return
+        self._mtime = data['mtime']
+        self._entries = {e[0]: TrashcanEntry(*e) for e in data['entries']}
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+        with open(self._filename + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._read()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write(self):
+        self._mtime = self._trash_mtime()
+        data = {'version': TrashcanIndex.VERSION, 'mtime': self._mtime, 'entries': [e.to_list() for e in self._entries.values()]}
+        write_atomic(json.dumps(data, separators=(',', ':')), self._filename)
+
+    def _trash_mtime(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _filenames(self):
+        #  type: () -> Dict[str, str]
+        if not os.path.exists(self._path):
+            return {}
+        return {os.path.splitext(f)[0]: f for f in os.listdir(self._path) if f.endswith('.yml')}
+
+    def _stale(self):
+        return self._mtime is None or self._mtime != self._trash_mtime()
+
+    def _reconcile(self):
+        filenames = self._filenames()
+        for uid in [u for u in self._entries if u not in filenames]:
+            del self._entries[uid]
+        for uid, filename in filenames.items():
+            if uid not in self._entries:
+                try:
+                    self._entries[uid] = TrashcanEntry.from_file(os.path.join(self._path, filename))
+                except (OSError, DoorstopError) as ex:
+                    _log.warning('unable to index trash file %s: %s', filename, ex)
+
+    def refresh(self, rebuild=False):
+        #  type: (bool) -> None
+        if not rebuild and not self._stale():
+            return
+        with self._locked():
+            if rebuild:
+                self._entries = {}
+            elif not self._stale():
+                return
+            self._reconcile()
+            self._write()
+
+    def add(self, path):
+        #  type: (str) -> None
+        with self._locked():
+            entry = TrashcanEntry.from_file(path, time.time())
+            self._entries[entry.uid] = entry
+            if self._stale():
+                self._reconcile()
+            self._write()
+
+    def remove(self, uid):
+        #  type: (str) -> None
+        with self._locked():
+            self._entries.pop(str(uid), None)
+            if self._stale():
+                self._reconcile()
+            self._write()
+
+    def entries(self):
+        #  type: () -> List[TrashcanEntry]
+        """Entries of the trash folder, most recently deleted first."""
+        self.refresh()
+        return sorted(self._entries.values(), key=lambda e: e.deleted, reverse=True)
@@ -0,0 +1,182 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from django.conf import settings
+from doorstop import Tree
+# Not deferred: importing the doorstop package already imports doorstop.core.builder
+from doorstop.core.builder import build
+
+from requirements.metrics import TREE_BUILDS, TREE_CACHE_HITS
+from requirements.snapshot import open_snapshot, use_snapshots
+from requirements.timing import count, timed
+from requirements.utils import cache_root
+from requirements.watcher import watcher_for
+
+_log = logging.getLogger(__name__)
+
+
+class TreeCacheEntry(object):
+    def __init__(self, tree, generation):
+        #  type: (Tree, int) -> None
+        self.tree = tree
+        self.generation = generation
+        self.used = time.monotonic()
+
+
+class TreeLock(object):
+    """Read/write lock of a cached tree.
+
+    Any number of threads read the tree at the same time; a writer waits for them and
+    has the tree to itself. Both sides are reentrant and the thread holding the write
+    lock may read too, but a reader cannot upgrade to writing.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None  # type: Optional[int]
+        self._writes = 0
+
+    @contextmanager
+    def reading(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                while self._writer is not None:
+                    self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._writer = me
+            self._writes += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writes -= 1
+                if not self._writes:
+                    self._writer = None
+                self._cond.notify_all()
+
+
+class TreeCache(object):
+    """Doorstop trees built per working directory and reused while the directory does not change.
+
+    Writes made through the cached tree keep it up to date, so they do not invalidate it;
+    any other change seen by the repository watcher forces a rebuild. Trees are built
+    from the on-disk snapshot of the directory, when enabled, and only the changed files
+    are parsed again. The least recently used trees are evicted when there are more than
+    DOORSTOP_TREE_CACHE_SIZE of them or when they have been idle for
+    DOORSTOP_TREE_CACHE_IDLE seconds.
+
+    A cached tree is shared by the threads serving its directory: hold
+    `tree_lock(tree).reading()` while reading it and `tree_lock(tree).writing()` while
+    changing it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # type: Dict[str, TreeCacheEntry]
+
+    @staticmethod
+    def size():
+        return getattr(settings, 'DOORSTOP_TREE_CACHE_SIZE', 8)
+
+    @staticmethod
+    def idle():
+        return getattr(settings, 'DOORSTOP_TREE_CACHE_IDLE', 3600)
+
+    def _evict(self):
+        now = time.monotonic()
+        for root in [r for r, e in self._entries.items() if now - e.used > TreeCache.idle()]:
+            _log.debug('evicting idle tree %s', root)
+            del self._entries[root]
+        while len(self._entries) > TreeCache.size():
+            root, _entry = self._entries.popitem(last=False)
+            _log.debug('evicting tree %s', root)
+
+    def _lookup(self, root, generation):
+        #  type: (str, int) -> Optional[Tree]
+        with self._lock:
+            entry = self._entries.get(root)
+            if entry is None:
+                return None
+            if entry.generation != generation:
+                if watcher_for(root).changes_since(entry.generation) is None:
+                    del self._entries[root]
+                    return None
+                entry.generation = generation
+            entry.used = time.monotonic()
+            self._entries.move_to_end(root)
+            return entry.tree
+
+    @staticmethod
+    @timed('tree')
+    def _build(root):
+        #  type: (str) -> Tree
+        _log.info('building tree of %s', root)
+        if not use_snapshots():
+            return build(root=root)
+        name = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+        snapshot = open_snapshot(root, os.path.join(cache_root(), 'snapshots', name + '.pickle'))
+        return snapshot.hydrate(root)
+
+    def get(self, root):
+        #  type: (str) -> Tree
+        generation = watcher_for(root).poll()
+        with self._lock:
+            cached = root in self._entries
+        tree = self._lookup(root, generation)
+        count('tree-cache-hit' if tree is not None else 'tree-cache-miss')
+        if tree is not None:
+            TREE_CACHE_HITS.inc()
+        else:
+            TREE_BUILDS.labels('reload' if cached else 'load').inc()
+            tree = self._build(root)
+            tree._lock = TreeLock()  # pylint: disable=protected-access
+            with self._lock:
+                self._entries[root] = TreeCacheEntry(tree, generation)
+                self._entries.move_to_end(root)
+                self._evict()
+        return tree
+
+    def invalidate(self, root=None):
+        #  type: (Optional[str]) -> None
+        with self._lock:
+            if root is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(root, None)
+
+
+tree_cache = TreeCache()
+
+
+def tree_lock(tree):
+    #  type: (Tree) -> TreeLock
+    """Lock guarding the loads and writes of a tree shared through the cache."""
+    lock = getattr(tree, '_lock', None)
+    if lock is None:
+        with tree_cache._lock:  # pylint: disable=protected-access
+            lock = getattr(tree, '_lock', None)
+            if lock is None:
+                lock = tree._lock = TreeLock()  # pylint: disable=protected-access
+    return lock
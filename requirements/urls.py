@@ -1,7 +1,9 @@
 from django.urls import path
 from .views import IndexView, ItemDetailView, ItemUpdateView, DocumentUpdateView, ItemActionView, ItemRawFileView, DocumentExportView, \
     VersionControlView, FullGraphView, GrpahDataView, DocumentActionView, DocumentSourceView, DocumentTrashcanView, FileDownloadView, \
-    DocumentIssesView, ItemAssetView
+    DocumentIssesView, ItemAssetView, VersionControlDiffView, MetricsView, \
+    ItemsApiView, DocumentItemsApiView, DocumentBulkActionView, RepositoryEventsView, ItemRowView, WorklistView, WorklistApiView, \
+    StatisticsView, StatisticsApiView
 
 urlpatterns = [
     path('', IndexView.as_view(), name='index'),
@@ -10,12 +12,15 @@ urlpatterns = [
     path('graph/<slug:doc>', FullGraphView.as_view(), name='graph'),
     path('graph/data/<slug:doc>', GrpahDataView.as_view(), name='graph-data'),
     path('issues/', DocumentIssesView.as_view(), name='issues'),
+    path('worklist/', WorklistView.as_view(), name='worklist'),
+    path('statistics/', StatisticsView.as_view(), name='statistics'),
     path('item/details/<slug:doc>/<slug:item>', ItemDetailView.as_view(), name='item-details'),
     path('item/details/<slug:doc>/media/<path:file>', FileDownloadView.as_view(), name='doc-media'),
     path('item/details/<slug:doc>/media2/<path:file>', FileDownloadView.as_view(), name='doc-media2'),
     path('item/update/<slug:doc>/<slug:item>', ItemUpdateView.as_view(), name='item-update'),
     path('item/update/<slug:doc>/media2/<path:file>', FileDownloadView.as_view(), name='item-update-media2'),
     path('item/update/<slug:doc>/<slug:item>/<slug:from>', ItemUpdateView.as_view(), name='item-update-from'),
+    path('item/row/<slug:doc>/<slug:item>', ItemRowView.as_view(), name='item-row'),
     path('item/rawfile/<slug:doc>/<slug:item>', ItemRawFileView.as_view(), name='item-rawfile'),
     path('item/delete/<slug:doc>/<slug:item>', ItemDetailView.as_view(), name='item-delete'),
     path('item/review/<slug:doc>/<slug:item>/<slug:action>', ItemActionView.as_view(), name='item-action'),
@@ -25,10 +30,18 @@ urlpatterns = [
     path('item/update/<slug:doc>', DocumentUpdateView.as_view(), name='document-update'),
     path('item/export/<slug:doc>', DocumentExportView.as_view(), name='document-export'),
     path('item/asset/<slug:doc>/<slug:item>/<int:index>', ItemAssetView.as_view(), name='item-asset'),
-    path('doc/statistics/<slug:doc>', DocumentSourceView.as_view(), name='document-statistics'),
+    path('doc/statistics/<slug:doc>', StatisticsView.as_view(), name='document-statistics'),
     path('doc/action/<slug:doc>/<slug:action>', DocumentActionView.as_view(), name='document-action'),
     path('doc/source/<slug:doc>', DocumentSourceView.as_view(), name='document-source'),
+    path('doc/bulk/<slug:doc>', DocumentBulkActionView.as_view(), name='document-bulk-action'),
     path('doc/trashcan/<slug:doc>', DocumentTrashcanView.as_view(), name='document-trashcan'),
     path('vcs/', VersionControlView.as_view(), name='vcs-show'),
     path('vcs/action/<slug:action>', VersionControlView.as_view(), name='vcs-action'),
+    path('vcs/diff/', VersionControlDiffView.as_view(), name='vcs-diff'),
+    path('events/', RepositoryEventsView.as_view(), name='events'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('api/items/', ItemsApiView.as_view(), name='api-items'),
+    path('api/items/<slug:doc>', DocumentItemsApiView.as_view(), name='api-document-items'),
+    path('api/worklist/', WorklistApiView.as_view(), name='api-worklist'),
+    path('api/statistics/', StatisticsApiView.as_view(), name='api-statistics'),
 ]
@@ -1,10 +1,81 @@
+import hashlib
+import hmac
+import logging
 import os
+import re
+from typing import Optional
 
 from django.conf import settings
 from django.contrib.auth.models import User
 
+_log = logging.getLogger(__name__)
+
+
+def user_worktrees():
+    #  type: () -> bool
+    return getattr(settings, 'DOORSTOP_USER_WORKTREES', False)
+
+
+def worktrees_root():
+    #  type: () -> str
+    return getattr(settings, 'DOORSTOP_WORKTREES_ROOT', None) or settings.DOORSTOP_REPO.rstrip(os.sep) + '-worktrees'
+
+
+def worktree_name(user):
+    #  type: (User) -> str
+    """Name of the user's worktree and branch: the sanitized username, made unique by a
+    hash of the username itself ("a b" and "a_b" sanitize alike)."""
+    username = user.get_username()
+    digest = hashlib.sha1(username.encode()).hexdigest()[:8]
+    return '{}-{}'.format(re.sub(r'[^A-Za-z0-9_.-]', '_', username), digest)
+
 
 def repository_path(user):
     #  type: (User) -> str
-    return settings.DOORSTOP_REPO
-    # return os.path.join(settings.DOORSTOP_REPO, user.get_username())
+    if not user_worktrees() or user is None or not user.is_authenticated:
+        return settings.DOORSTOP_REPO
+    path = os.path.join(worktrees_root(), worktree_name(user))
+    if not os.path.isdir(path):
+        from requirements.repo import add_user_worktree
+        if not add_user_worktree(user, path):
+            return settings.DOORSTOP_REPO
+    return path
+
+
+def bearer_token(request):
+    #  type: (...) -> Optional[str]
+    """Token of an `Authorization: Bearer <token>` header, None without one."""
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    token = token.strip()
+    return token if scheme.lower() == 'bearer' and token else None
+
+
+def token_user(token):
+    #  type: (str) -> Optional[User]
+    """Active user of an API token of DOORSTOP_API_TOKENS (token -> username)."""
+    for key, username in getattr(settings, 'DOORSTOP_API_TOKENS', {}).items():
+        if hmac.compare_digest(key.encode(), token.encode()):
+            return User.objects.filter(username=username, is_active=True).first()
+    return None
+
+
+def cache_root():
+    #  type: () -> str
+    return getattr(settings, 'DOORSTOP_CACHE_DIR', None) or os.path.join(settings.DOORSTOP_REPO, '.git', 'django_doorstop')
+
+
+def cache_path(user, name):
+    #  type: (User, str) -> str
+    root = cache_root()
+    if repository_path(user) != settings.DOORSTOP_REPO:
+        root = os.path.join(root, 'users', worktree_name(user))
+    os.makedirs(root, exist_ok=True)
+    return os.path.join(root, name)
+
+
+def on_user_logged_in(sender, request, user, **kwargs):
+    # Create the user's working directory on first login, without failing the login
+    try:
+        repository_path(user)
+    except Exception:  # pylint: disable=broad-except
+        _log.exception('cannot create the working directory of %s', user.get_username())
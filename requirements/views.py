@@ -1,45 +1,106 @@
+import asyncio
+import base64
+import hmac
+import json
 import os
 import shutil
 import time
 from typing import Optional, List, Any
 
-import yaml
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.handlers.asgi import ASGIRequest
 from django.contrib.auth.models import User
 from django.core.files.base import File
 from django.core.files.uploadedfile import UploadedFile
-from django.http import HttpResponseRedirect, FileResponse
+from django.http import HttpResponseRedirect, FileResponse, HttpResponse, HttpResponseForbidden, Http404, JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
 from django.urls import reverse, resolve
-from django.views.generic import ListView, TemplateView, DetailView
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import ListView, TemplateView, DetailView, View
 from django.conf import settings
 from django_downloadview import VirtualDownloadView, PathDownloadView
 from django_tables2 import SingleTableMixin
 
+from jsonview.exceptions import BadRequest
 from jsonview.views import JsonView
 from doorstop.core.item import UnknownItem
 from doorstop.core.validators.item_validator import ItemValidator
-from doorstop.core.types import UID
+from doorstop.core.types import UID, Level
 from doorstop import Tree, Item, DoorstopError, DoorstopInfo, DoorstopWarning
 from doorstop.core import Document
-from doorstop.core.builder import build
 
-from requirements.djdoorstop import DjItem
-from requirements.export import export_full_xslx, import_from_xslx
+from requirements.events import ChangeFeed, change_feed
+from requirements.djdoorstop import DjItem, DjDocument, WriteBatch
+from requirements.executors import AsyncViewMixin, markcoroutinefunction, run_in
 from requirements.forms import ItemUpdateForm, DocumentUpdateForm, ItemCommentForm, ItemRawEditForm, VirtualItem, DocumentSourceForm
 from requirements.tables import RequirementsTable, ParentRequirementTable, GitFileStatus, ExtendedFields, \
-    TrashcanRequirementsTable, TrashcanItem
-from requirements.repo import MyPyGit2
-from requirements.utils import repository_path
+    TrashcanRequirementsTable, TrashcanItem, GitDiffTable
+from requirements.linkindex import link_index_cache, use_link_index
+from requirements.metrics import VALIDATIONS, registry
+from requirements.reorder import ReorderPlan
+from requirements.stats import StatisticsCache, statistics_cache
+from requirements.timing import phase
+from requirements.trashcan import TrashcanIndex
+from requirements.treecache import tree_cache, tree_lock
+from requirements.watcher import notify_write
+from requirements.worklist import Worklist, WorkEntry
+from requirements.utils import repository_path, cache_path, bearer_token, token_user
+
+
+def version_control(user):
+    #  type: (User) -> MyPyGit2
+    # pygit2 and openpyxl are loaded by the views that use them
+    from requirements.repo import MyPyGit2
+    return MyPyGit2(user)
+
+
+def trashcan_index(doc, user):
+    #  type: (Document, User) -> TrashcanIndex
+    return TrashcanIndex(doc, cache_path(user, f'trashcan-{doc.prefix}.json'))
+
+
+def move_to_trash(doc, item, user):
+    #  type: (Document, Item, User) -> None
+    item.deleted = False
+    if not os.path.exists(os.path.join(doc.path, 'trash')):
+        os.mkdir(os.path.join(doc.path, 'trash'))
+    dstpath = os.path.join(doc.path, 'trash', os.path.basename(item.path))
+    shutil.copy2(item.path, dstpath)
+    notify_write(dstpath)
+    trashcan_index(doc, user).add(dstpath)
+    if item.references:
+        for ref in item.references:
+            dstpath = os.path.join(doc.path, 'trash', os.path.basename(ref['path']))
+            shutil.move(ref['path'], dstpath)
+            notify_write(ref['path'])
+            notify_write(dstpath)
+    item.delete()
 
 
 class RequirementMixin(LoginRequiredMixin):
+    # Set on the views whose GET requests change the tree too
+    writes_tree = False
+
     def __init__(self):
         self._user = None  # type: Optional[User]
-        self._tree = build(root=settings.DOORSTOP_REPO)  # type: Tree
+        self._tree = None  # type: Optional[Tree]
         self._doc = None  # type: Optional[Document]
         self._item = None  # type: Optional[DjItem]
         self._form = None
 
+    def dispatch(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            self._user = request.user
+            self._tree = tree_cache.get(repository_path(request.user))
+            lock = tree_lock(self._tree)
+            writes = self.writes_tree or request.method not in ('GET', 'HEAD', 'OPTIONS')
+            # Templates render after the lock is released: they only read items the
+            # handler already loaded and at worst show the tree just before a write.
+            with lock.writing() if writes else lock.reading():
+                return super().dispatch(request, *args, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
+
     @staticmethod
     def find_neighbours(doc, value):
         #  type: (Document, str) -> (Optional[Item], Optional[Item], Optional[Item])
@@ -74,10 +135,17 @@ class RequirementMixin(LoginRequiredMixin):
                 childs.append(_d)
         return childs
 
+    def find_child_items(self, item):
+        #  type: (Item) -> List[Item]
+        if not use_link_index():
+            return item.find_child_items()
+        index = link_index_cache.get(repository_path(self._user), self._tree)
+        return [self._tree.find_item(r.uid) if r.active else UnknownItem(r.uid) for r in index.children(item.uid.value)]
+
     @staticmethod
-    def get_doc(prefix):
-        # type: (str) -> Document
-        tree = build(root=settings.DOORSTOP_REPO)
+    def get_doc(prefix, user=None):
+        # type: (str, Optional[User]) -> Document
+        tree = tree_cache.get(repository_path(user))
         doc = None
         for _doc in tree.documents:
             if _doc.prefix == prefix:
@@ -95,14 +163,13 @@ class RequirementMixin(LoginRequiredMixin):
             return None
 
 
-class FileDownloadView(RequirementMixin, DetailView):
+class FileDownloadView(AsyncViewMixin, RequirementMixin, DetailView):
     def get(self, request, *args, **kwargs):
         current_url = resolve(request.path_info).url_name
         if current_url == 'doc-media2' or current_url == 'item-update-media2':
             relpath = 'media2'
         else:
             relpath = 'media'
-        print(current_url)
         self._doc = self._tree.find_document(kwargs['doc'])
         filename = kwargs['file']
         if filename is None:
@@ -113,14 +180,17 @@ class FileDownloadView(RequirementMixin, DetailView):
         return response
 
 
-class VersionControlView(TemplateView):
+class VersionControlView(AsyncViewMixin, TemplateView):
     template_name = 'requirements/version_control.html'
+    executor = 'git'
 
     def __init__(self, **kwargs):
         self._curr_file = None
         self._action = None
         self._user = None
         self._curr_file = None  # type: Optional[str]
+        self._curr_path = None  # type: Optional[str]
+        self._page = 1
         self._vcs = None  # type: Optional[MyPyGit2]
         super().__init__(**kwargs)
 
@@ -139,22 +209,44 @@ class VersionControlView(TemplateView):
             self._action = kwargs['action']
         if 'f' in request.GET:
             self._curr_file = request.GET['f']
+        if 'p' in request.GET:
+            self._curr_path = request.GET['p']
+        self._page = request.GET.get('page', 1)
         return super().get(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        self._vcs = MyPyGit2(self._user)
+        self._vcs = version_control(self._user)
         self.action(self._action)
         if self._curr_file:
-            tree = build(root=settings.DOORSTOP_REPO)
-            context['item'] = tree.find_item(self._curr_file)
+            tree = tree_cache.get(repository_path(self._user))
+            with tree_lock(tree).reading():
+                context['item'] = tree.find_item(self._curr_file)
+            self._curr_path = os.path.relpath(context['item'].path, repository_path(self._user))
         else:
             context['item'] = None
-        context['patch'] = self._vcs.diff_patch()
+        diff = GitDiffTable(data=self._vcs.diff_files())
+        diff.paginate(page=self._page, per_page=settings.DOORSTOP_ITEMS_PAGINATE)
+        context['diff'] = diff
+        context['curr_path'] = self._curr_path
+        if self._curr_path:
+            context['patch'], context['truncated'] = self._vcs.diff_file_patch(self._curr_path)
         context['table'] = GitFileStatus(data=self._vcs.modified_files())
         return context
 
 
+class VersionControlDiffView(AsyncViewMixin, LoginRequiredMixin, TemplateView):
+    template_name = 'requirements/version_control_diff.html'
+    executor = 'git'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        vcs = version_control(self.request.user)
+        context['curr_path'] = self.request.GET.get('path', '')
+        context['patch'], context['truncated'] = vcs.diff_file_patch(context['curr_path'])
+        return context
+
+
 class DocumentIssesView(RequirementMixin, TemplateView):
     template_name = 'requirements/issues.html'
 
@@ -167,7 +259,9 @@ class DocumentIssesView(RequirementMixin, TemplateView):
         context['docs'] = self._tree.documents
         issues = []
         index = 1
-        for issue in self._tree.get_issues():
+        with phase('validate', VALIDATIONS):
+            tree_issues = list(self._tree.get_issues())
+        for issue in tree_issues:
             if isinstance(issue, DoorstopInfo):
                 cls = 'primary'
             elif isinstance(issue, DoorstopWarning):
@@ -201,7 +295,7 @@ class IndexView(RequirementMixin, SingleTableMixin, ListView):
         dynamic = []
         for _r in self._doc.extended_reviewed:
             dynamic.append((_r, ExtendedFields(accessor='uid')))
-        return {'extra_columns': dynamic}
+        return {'extra_columns': dynamic, 'history': version_control(self._user).history()}
 
     def get_queryset(self):
         return sorted(i for i in self._doc._iter() if i.active and (not i.deleted or self._user.has_perm('requirements.internal')))
@@ -241,20 +335,22 @@ class ItemDetailView(RequirementMixin, TemplateView):
         context['items'] = [str(x.uid) for x in self._doc.items]
         context['prev'] = self._prev
         context['next'] = self._next
-        context['childs'] = self._item.find_child_items()
+        context['childs'] = self.find_child_items(self._item)
         context['parents'] = [x for x in self._item.parent_items if not isinstance(x, UnknownItem)]
         if self._item.deleted:
             issues = []
         else:
             validator = ItemValidator()
-            issues = validator.get_issues(self._item)
+            with phase('validate', VALIDATIONS):
+                issues = list(validator.get_issues(self._item))
         context['issues'] = [str(x) for x in issues]
         context['comments'] = self._item.get('comments')
         context['form'] = self._form
+        context['history'] = version_control(self.request.user).history().history(self._item.path)
         return context
 
 
-class ItemAssetView(RequirementMixin, PathDownloadView):
+class ItemAssetView(AsyncViewMixin, RequirementMixin, PathDownloadView):
     def __init__(self, **kwargs):
         self._index = 0
         super().__init__(**kwargs)
@@ -302,13 +398,15 @@ class DocumentUpdateView(RequirementMixin, TemplateView):
         return self.render_to_response(self.get_context_data(form=self._form))
 
 
-class DocumentExportView(RequirementMixin, VirtualDownloadView):
+class DocumentExportView(AsyncViewMixin, RequirementMixin, VirtualDownloadView):
+    executor = 'export'
+
     def get(self, request, *args, **kwargs):
         self._doc = self._tree.find_document(kwargs['doc'])
-        print(self._doc.prefix)
         return super().get(request, *args, **kwargs)
 
     def get_file(self):
+        from requirements.export import export_full_xslx
         path = export_full_xslx(self._tree)
         file = open(path, 'rb')
         return File(file, name='exported.xlsx')
@@ -347,8 +445,44 @@ class DocumentSourceView(RequirementMixin, TemplateView):
         return self.render_to_response(self.get_context_data(form=self._form))
 
 
-class DocumentActionView(RequirementMixin, TemplateView):
+class StatisticsMixin(RequirementMixin):
+    def statistics(self, prefix=None):
+        #  type: (Optional[str]) -> dict
+        if prefix is not None:
+            try:
+                self._doc = self._tree.find_document(prefix)
+            except DoorstopError:
+                raise Http404('unknown document {}'.format(prefix))
+        summary = statistics_cache.get(repository_path(self._user), self._tree)
+        return StatisticsCache.select(summary, prefix)
+
+
+class StatisticsView(StatisticsMixin, TemplateView):
+    """Review progress, link coverage and foreign field values of the tree or of a document."""
+
+    template_name = 'requirements/statistics.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['stats'] = self.statistics(kwargs.get('doc'))
+        context['doc'] = self._doc
+        context['docs'] = self._tree.documents
+        return context
+
+
+class StatisticsApiView(StatisticsMixin, JsonView):
+    """The statistics as JSON, `doc` restricts them to a document."""
+
+    raise_exception = True
+
+    def get_context_data(self, **kwargs):
+        return self.statistics(self.request.GET.get('doc') or None)
+
+
+class DocumentActionView(AsyncViewMixin, RequirementMixin, TemplateView):
     template_name = 'requirements/document_action.html'
+    executor = 'export'
+    writes_tree = True
 
     ACTION_NAMES = {'import': 'Import', 'clean': 'Clean', 'reorder': 'Reorder'}
 
@@ -357,6 +491,8 @@ class DocumentActionView(RequirementMixin, TemplateView):
         self._action = ''  # type: str
         self._error = None  # type: Optional[str]
         self._confirm = 0  # type: int
+        self._index = None  # type: Optional[str]
+        self._changes = None  # type: Optional[List]
 
     def get(self, request, *args, **kwargs):
         self._doc = self._tree.find_document(kwargs['doc'])
@@ -365,13 +501,12 @@ class DocumentActionView(RequirementMixin, TemplateView):
 
         if self._confirm == 1:
             if self._action == 'clean':
-                for _i in self._doc.items:  # type: Item
-                    _i.review()
-                    _i.clear()
+                with self._doc.batch():
+                    for _i in self._doc.items:  # type: Item
+                        _i.review()
+                        _i.clear()
                 return HttpResponseRedirect(reverse('index-doc', args=[self._doc.prefix]))
         else:
-            if self._action == 'reorder':
-                self._doc.index = True
             context = self.get_context_data()
             return self.render_to_response(context)
 
@@ -385,13 +520,22 @@ class DocumentActionView(RequirementMixin, TemplateView):
                 file = request.FILES['file_to_import']  # type: UploadedFile
                 with open('/tmp/import.xlsx', 'wb') as f:
                     f.write(file.read())
-                import_from_xslx(self._doc)
+                with self._doc.batch():
+                    from requirements.export import import_from_xslx
+                    import_from_xslx(self._doc)
                 return HttpResponseRedirect(reverse('index-doc', args=[self._doc.prefix]))
-            elif self._action == 'reorder':
-                with open(self._doc.index, 'w') as f:
-                    f.write(request.POST['itemIndex'])
-                self._doc.reorder()
+        if self._action == 'reorder':
+            self._index = request.POST.get('itemIndex', '')
+            try:
+                plan = ReorderPlan(self._doc, self._index)
+            except DoorstopError as ex:
+                self._error = str(ex)
+                return self.render_to_response(self.get_context_data())
+            if self._confirm == 1:
+                plan.apply()
                 return HttpResponseRedirect(reverse('index-doc', args=[self._doc.prefix]))
+            self._changes = plan.changes
+            return self.render_to_response(self.get_context_data())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -400,10 +544,8 @@ class DocumentActionView(RequirementMixin, TemplateView):
         context['error'] = self._error
         context['action_name'] = DocumentActionView.ACTION_NAMES[self._action]
         if self._action == 'reorder':
-            context['index'] = ''
-            if os.path.exists(self._doc.index):
-                with open(self._doc.index, 'r') as f:
-                    context['index'] = f.read()
+            context['index'] = self._index if self._index is not None else ReorderPlan.index_of(self._doc)
+            context['changes'] = self._changes
         return context
 
 
@@ -425,20 +567,9 @@ class DocumentTrashcanView(RequirementMixin, SingleTableMixin, ListView):
         return context
 
     def get_queryset(self):
-        # return self._doc.items
-        items = []
-        path = os.path.join(self._doc.path, 'trash')
-        if not os.path.exists(path):
-            os.mkdir(path)
-        for filename in os.listdir(path):
-            basename, extens = os.path.splitext(filename)
-            tcitem = TrashcanItem(self._doc.prefix, basename)
-            with open(os.path.join(path, filename), 'r') as f:
-                item = yaml.load(f)
-                tcitem.header = item.get('header')
-                tcitem.text = item.get('text')
-            items.append(tcitem)
-        return items
+        index = trashcan_index(self._doc, self._user)
+        index.refresh(rebuild='rebuild' in self.request.GET)
+        return [TrashcanItem(self._doc.prefix, e.uid, e.header, e.text, e.deleted, e.size) for e in index.entries()]
 
 
 class ItemRawFileView(RequirementMixin, TemplateView):
@@ -523,9 +654,10 @@ class ItemUpdateView(RequirementMixin, TemplateView):
 
     def form_valid(self, from_item):
         #  type: (Optional[Item]) -> HttpResponseRedirect
-        item = self._form.save()
-        if from_item is not None:
-            self._tree.link_items(item.uid, from_item)
+        with WriteBatch():
+            item = self._form.save()
+            if from_item is not None:
+                self._tree.link_items(item.uid, from_item)
         return HttpResponseRedirect(reverse('item-details', args=[self._doc.prefix, item.uid]))
 
     def form_invalid(self):
@@ -534,6 +666,7 @@ class ItemUpdateView(RequirementMixin, TemplateView):
 
 class ItemActionView(RequirementMixin, TemplateView):
     template_name = 'requirements/item_action.html'
+    writes_tree = True
 
     ACTION_REVIEW = 'review'
     ACTION_NAMES = {'review': 'Review', 'disactivate': 'Mark inactive', 'delete': 'Delete',
@@ -552,25 +685,21 @@ class ItemActionView(RequirementMixin, TemplateView):
         self._vcs = None  # type: Optional[MyPyGit2]
 
     def action_delete_item(self):
-        self._item.deleted = False
-        if not os.path.exists(os.path.join(self._doc.path, 'trash')):
-            os.mkdir(os.path.join(self._doc.path, 'trash'))
-        dstpath = os.path.join(self._doc.path, 'trash', os.path.basename(self._item.path))
-        shutil.copy2(self._item.path, dstpath)
-        if self._item.references:
-            for ref in self._item.references:
-                dstpath = os.path.join(self._doc.path, 'trash', os.path.basename(ref['path']))
-                shutil.move(ref['path'], dstpath)
-        self._item.delete()
+        move_to_trash(self._doc, self._item, self._user)
 
     def action_restore_item(self):
         dstpath = os.path.join(self._doc.path, os.path.basename(self._item.path))
         shutil.copy2(self._item.path, dstpath)
+        # The restored item is not in the cached tree, which has to be loaded again
+        notify_write(dstpath, reload=True)
         if self._item.references:
             for ref in self._item.references:
                 dstpath = os.path.join(self._doc.path, os.path.basename(ref['path']))
                 shutil.move(ref['path'], dstpath)
+                notify_write(ref['path'])
+                notify_write(dstpath)
         self._item.delete()
+        trashcan_index(self._doc, self._user).remove(self._item.uid)
 
     def get(self, request, *args, **kwargs):
         self._doc = self._tree.find_document(kwargs['doc'])
@@ -580,7 +709,7 @@ class ItemActionView(RequirementMixin, TemplateView):
             self._item = Item(self._doc, os.path.join(self._doc.path, 'trash', kwargs['item']+'.yml'))
         self._action = kwargs['action']
         self._user = request.user
-        self._vcs = MyPyGit2(self._user)
+        self._vcs = version_control(self._user)
 
         if 'where' in kwargs:
             self._where = kwargs['where']
@@ -590,8 +719,6 @@ class ItemActionView(RequirementMixin, TemplateView):
             self._index = kwargs['index']
         self._confirm = int(request.GET.get('confirm', '0'))
 
-        self._vcs.test()
-
         if not self._confirm:
             if self._action == 'link':
                 if 'parentuid' in request.GET:
@@ -599,11 +726,11 @@ class ItemActionView(RequirementMixin, TemplateView):
                         self._target = self._tree.find_item(request.GET.get('parentuid'))
                     except DoorstopError as ex:
                         self._error = str(ex)
-                        print(self._error)
             elif self._action == 'closecomm':
-                comments = self._item.get('comments')
-                comments[self._index]['closed'] = True
-                self._item.set('comments', comments)
+                with self._item.deferred():
+                    comments = self._item.get('comments')
+                    comments[self._index]['closed'] = True
+                    self._item.set('comments', comments)
                 return HttpResponseRedirect("%s" % (reverse('item-details', args=[self._doc.prefix, self._item.uid])))
 
         if self._confirm == 1:
@@ -648,6 +775,89 @@ class ItemActionView(RequirementMixin, TemplateView):
             return HttpResponseRedirect(reverse('item-details', args=[self._doc.prefix, self._item.uid]))
 
 
+class DocumentBulkActionView(RequirementMixin, TemplateView):
+    """Apply an item action to the items selected in the requirements table.
+
+    Item changes are staged in a document batch, so stamps are computed once and
+    every file is written once; items moved to the trash are handled after it.
+    """
+
+    template_name = 'requirements/document_bulk_action.html'
+
+    ACTION_NAMES = {'review': 'Review', 'clear': 'Clear', 'link': 'Link', 'unlink': 'Unlink',
+                    'delete': 'Delete', 'pending': 'Mark pending', 'ready': 'Mark not pending'}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._action = ''  # type: str
+        self._target = None  # type: Optional[Item]
+        self._results = []  # type: List[tuple]
+
+    def _apply(self, item):
+        #  type: (Item) -> None
+        if self._action == 'review':
+            item.review()
+        elif self._action == 'clear':
+            item.clear()
+        elif self._action == 'link':
+            item.link(self._target.uid)
+        elif self._action == 'unlink':
+            if self._target.uid not in item.links:
+                raise DoorstopError('{} is not linked to {}'.format(item.uid, self._target.uid))
+            item.unlink(self._target.uid)
+        elif self._action == 'pending':
+            item.pending = True
+        elif self._action == 'ready':
+            item.pending = False
+
+    def post(self, request, *args, **kwargs):
+        self._doc = self._tree.find_document(kwargs['doc'])
+        self._action = request.POST.get('action', '')
+        if self._action not in DocumentBulkActionView.ACTION_NAMES:
+            return HttpResponseRedirect(reverse('index-doc', args=[self._doc.prefix]))
+        error = None
+        if self._action in ('link', 'unlink'):
+            try:
+                self._target = self._tree.find_item(request.POST.get('target', ''))
+            except DoorstopError as ex:
+                error = str(ex)
+
+        items = []
+        for uid in request.POST.getlist('selection'):
+            try:
+                items.append(self._doc.find_item(uid))
+            except DoorstopError as ex:
+                self._results.append((uid, False, str(ex)))
+        if error is not None:
+            self._results.extend((str(item.uid), False, error) for item in items)
+        elif self._action == 'delete':
+            for item in items:
+                try:
+                    move_to_trash(self._doc, item, request.user)
+                    self._results.append((str(item.uid), True, ''))
+                except (DoorstopError, OSError) as ex:
+                    self._results.append((str(item.uid), False, str(ex)))
+        else:
+            with self._doc.batch():
+                for item in items:
+                    try:
+                        self._apply(item)
+                        self._results.append((str(item.uid), True, ''))
+                    except DoorstopError as ex:
+                        self._results.append((str(item.uid), False, str(ex)))
+        return self.render_to_response(self.get_context_data())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['doc'] = self._doc
+        context['action'] = self._action
+        context['action_name'] = DocumentBulkActionView.ACTION_NAMES[self._action]
+        context['target'] = self._target
+        context['results'] = self._results
+        context['done'] = len([r for r in self._results if r[1]])
+        return context
+
+
 class FullGraphView(RequirementMixin, TemplateView):
     template_name = 'requirements/full_graph.html'
 
@@ -704,3 +914,376 @@ class GrpahDataView(RequirementMixin, JsonView):
 
         return context
 
+
+class RepositoryEventsView(View):
+    """Server-sent events with the changes of the working directory of the user.
+
+    The answer holds at most DOORSTOP_EVENTS_WAIT seconds waiting for changes, then the
+    browser reconnects sending the id of the last message, which is the watermark of
+    the change feed. A `reset` event asks the page to reload, the changes are unknown.
+    The view is a coroutine: only the reads of the feed take a thread of the `events`
+    pool, the wait between them is spent on the event loop.
+
+    Waiting only pays off with ASGI. Under WSGI each waiting answer would keep a sync
+    worker busy for every open tab, so the view answers at once and the browser polls
+    again after DOORSTOP_EVENTS_WAIT seconds; the same happens past
+    DOORSTOP_EVENTS_MAX_CONNECTIONS waiting answers of the process.
+    """
+
+    waiting = 0
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return markcoroutinefunction(super().as_view(**initkwargs))
+
+    @staticmethod
+    def _feed(request):
+        #  type: (Any) -> Optional[ChangeFeed]
+        if not request.user.is_authenticated:
+            return None
+        return change_feed(repository_path(request.user))
+
+    async def get(self, request, *args, **kwargs):
+        feed = await run_in('events', self._feed, request)
+        if feed is None:
+            return HttpResponseForbidden()
+        wait = getattr(settings, 'DOORSTOP_EVENTS_WAIT', 15.0)
+        interval = getattr(settings, 'DOORSTOP_WATCH_INTERVAL', 2.0)
+        try:
+            last = int(request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('since') or -1)
+        except ValueError:
+            last = -1
+        events, watermark = await run_in('events', feed.since, max(last, 0))
+        hold = isinstance(request, ASGIRequest) and \
+            RepositoryEventsView.waiting < getattr(settings, 'DOORSTOP_EVENTS_MAX_CONNECTIONS', 100)
+        retry = 1000 if hold else int(wait * 1000)
+        if hold and last >= 0 and events == []:
+            # Only touched from the event loop thread
+            RepositoryEventsView.waiting += 1
+            try:
+                deadline = time.monotonic() + wait
+                while events == [] and time.monotonic() < deadline:
+                    await asyncio.sleep(interval)
+                    events, watermark = await run_in('events', feed.since, last)
+            finally:
+                RepositoryEventsView.waiting -= 1
+        lines = ['retry: {}'.format(retry), 'id: {}'.format(watermark)]
+        if last < 0:
+            lines.append(': watching')
+        elif events is None:
+            lines.extend(['event: reset', 'data: {}'])
+        elif events:
+            lines.extend(['event: change', 'data: ' + json.dumps({'events': events}, separators=(',', ':'))])
+        response = HttpResponse('\n'.join(lines) + '\n\n', content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+class ItemRowView(IndexView):
+    """Row of an item in the requirements table, to refresh a changed item in place."""
+
+    template_name = 'requirements/item_row.html'
+
+    def get_queryset(self):
+        return [self._doc.find_item(self.kwargs['item'])]
+
+
+class ItemApiMixin(RequirementMixin):
+    """JSON access to the items of the cached tree.
+
+    The `fields` query parameter (comma separated) projects the items on the listed
+    attributes; `uid` is always present, `children` is computed from the link index.
+    """
+
+    raise_exception = True
+    EDITABLE = ('level', 'header', 'text', 'active', 'normative', 'derived', 'pending')
+
+    @staticmethod
+    def max_items():
+        #  type: () -> int
+        return getattr(settings, 'DOORSTOP_API_MAX_ITEMS', 1000)
+
+    def fields(self):
+        #  type: () -> Optional[List[str]]
+        value = self.request.GET.get('fields')
+        return [f.strip() for f in value.split(',') if f.strip()] if value else None
+
+    def item_json(self, item, fields=None):
+        #  type: (Item, Optional[List[str]]) -> dict
+        data = item.data
+        data['links'] = [str(uid) for uid in item.links]
+        data['document'] = item.document.prefix
+        result = {'uid': str(item.uid)}
+        if fields is None:
+            result.update(data)
+            return result
+        for name in fields:
+            if name == 'children':
+                result[name] = [str(child.uid) for child in self.find_child_items(item)]
+            elif name in data:
+                result[name] = data[name]
+        return result
+
+    @staticmethod
+    def encode_cursor(uid):
+        #  type: (str) -> str
+        return base64.urlsafe_b64encode(uid.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        #  type: (str) -> str
+        try:
+            return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        except ValueError:
+            raise BadRequest('invalid cursor')
+
+    def page_range(self, uids):
+        #  type: (List[str]) -> (int, int)
+        """Start and size of the requested page of a list of UIDs, from `cursor` and `limit`."""
+        try:
+            limit = min(int(self.request.GET.get('limit', 100)), self.max_items())
+        except ValueError:
+            raise BadRequest('invalid limit')
+        if limit < 1:
+            raise BadRequest('invalid limit')
+        start = 0
+        cursor = self.request.GET.get('cursor')
+        if cursor:
+            last = self.decode_cursor(cursor)
+            if last not in uids:
+                raise BadRequest('invalid cursor')
+            start = uids.index(last) + 1
+        return start, limit
+
+    def find_items(self, uids):
+        #  type: (List[str]) -> (List[Item], List[str])
+        found, missing = [], []
+        for uid in uids:
+            try:
+                found.append(self._tree.find_item(uid))
+            except DoorstopError:
+                missing.append(uid)
+        return found, missing
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ItemsApiView(ItemApiMixin, JsonView):
+    """Batch read and update of items given by UID.
+
+    GET ?uids=A,B,C returns the items found and the UIDs missing. PATCH takes
+    {"items": [{"uid": ..., "attributes": {...}, "links": {"add": [...], "remove": [...]}}]}
+    and writes every changed item once; nothing is changed when any entry is invalid.
+
+    Clients authenticate with a token of DOORSTOP_API_TOKENS (`Authorization: Bearer
+    <token>`); requests authenticated by the session cookie still need the CSRF token.
+    """
+
+    FLAGS = ('active', 'normative', 'derived', 'pending')
+
+    def dispatch(self, request, *args, **kwargs):
+        token = bearer_token(request)
+        if token is not None:
+            user = token_user(token)
+            if user is None:
+                return JsonResponse({'error': 401, 'message': 'invalid token'}, status=401)
+            request.user = user
+        else:
+            reason = CsrfViewMiddleware(lambda r: None).process_view(request, None, (), {})
+            if reason is not None:
+                return reason
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        uids = [u.strip() for u in self.request.GET.get('uids', '').split(',') if u.strip()]
+        if len(uids) > self.max_items():
+            raise BadRequest('at most {} items per request'.format(self.max_items()))
+        items, missing = self.find_items(uids)
+        fields = self.fields()
+        return {'items': [self.item_json(item, fields) for item in items], 'missing': missing}
+
+    def _check(self, entry):
+        #  type: (dict) -> Item
+        if not isinstance(entry, dict) or 'uid' not in entry:
+            raise BadRequest('every entry needs an uid')
+        items, missing = self.find_items([str(entry['uid'])])
+        if missing:
+            raise BadRequest('unknown item {}'.format(missing[0]))
+        item = items[0]
+        foreign = item.document.forgein_fields
+        attributes = entry.get('attributes', {})
+        if not isinstance(attributes, dict):
+            raise BadRequest('attributes of {} must be an object'.format(item.uid))
+        for name, value in attributes.items():
+            if name not in self.EDITABLE and name not in foreign:
+                raise BadRequest('{} is not editable'.format(name))
+            self._check_value(name, value)
+        links = entry.get('links', {})
+        if not isinstance(links, dict) or not all(isinstance(links.get(k, []), list) for k in ('add', 'remove')):
+            raise BadRequest('links of {} must be an object of UID lists'.format(item.uid))
+        _, missing = self.find_items([str(uid) for uid in links.get('add', [])])
+        if missing:
+            raise BadRequest('unknown link target {}'.format(missing[0]))
+        return item
+
+    @staticmethod
+    def _check_value(name, value):
+        #  type: (str, Any) -> None
+        if name == 'level':
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise BadRequest('level must be a string or a number')
+            try:
+                Level(value)
+            except ValueError:
+                raise BadRequest('invalid level {}'.format(value))
+        elif name in ItemsApiView.FLAGS:
+            if not isinstance(value, bool):
+                raise BadRequest('{} must be true or false'.format(name))
+        elif not isinstance(value, str):
+            raise BadRequest('{} must be a string'.format(name))
+
+    def patch(self, request, *args, **kwargs):
+        try:
+            entries = json.loads(request.body.decode('utf-8')).get('items', [])
+        except (ValueError, AttributeError):
+            raise BadRequest('invalid JSON body')
+        if not isinstance(entries, list):
+            raise BadRequest('items must be a list')
+        if len(entries) > self.max_items():
+            raise BadRequest('at most {} items per request'.format(self.max_items()))
+        items = [self._check(entry) for entry in entries]
+        try:
+            with DjDocument.batch():
+                for item, entry in zip(items, entries):
+                    for name, value in entry.get('attributes', {}).items():
+                        if name in self.EDITABLE:
+                            setattr(item, name, value)
+                        else:
+                            item.set(name, value)
+                    for uid in entry.get('links', {}).get('add', []):
+                        item.link(uid)
+                    for uid in entry.get('links', {}).get('remove', []):
+                        item.unlink(uid)
+        except (DoorstopError, ValueError, TypeError) as ex:
+            # The batch reloaded the items, nothing was written
+            raise BadRequest(str(ex))
+        fields = self.fields()
+        return {'items': [self.item_json(item, fields) for item in items]}
+
+
+class DocumentItemsApiView(ItemApiMixin, JsonView):
+    """Items of a document in level order, a page at a time.
+
+    `limit` sets the page size, `cursor` is the `next` value of the previous page.
+    """
+
+    def get_context_data(self, **kwargs):
+        try:
+            self._doc = self._tree.find_document(kwargs['doc'])
+        except DoorstopError:
+            raise Http404('unknown document {}'.format(kwargs['doc']))
+        items = self._doc.items
+        start, limit = self.page_range([str(item.uid) for item in items])
+        page = items[start:start + limit]
+        fields = self.fields()
+        more = start + limit < len(items)
+        return {
+            'items': [self.item_json(item, fields) for item in page],
+            'next': self.encode_cursor(str(page[-1].uid)) if more else None,
+        }
+
+
+class WorklistMixin(RequirementMixin):
+    """Review work left in the tree, see `Worklist`.
+
+    `doc` restricts it to a document, `kind` (comma separated) to some kinds of work.
+    Open comments are only listed to internal users, like in the item details.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._kinds = []  # type: List[str]
+        self._counts = {}
+
+    def allowed_kinds(self):
+        #  type: () -> List[str]
+        internal = self._user.has_perm('requirements.internal')
+        return [k for k in WorkEntry.KINDS if internal or k != WorkEntry.COMMENTS]
+
+    def worklist(self):
+        #  type: () -> List[WorkEntry]
+        prefix = self.request.GET.get('doc') or None
+        self._doc = None
+        if prefix is not None:
+            try:
+                self._doc = self._tree.find_document(prefix)
+            except DoorstopError:
+                raise Http404('unknown document {}'.format(prefix))
+        allowed = self.allowed_kinds()
+        kinds = [k.strip() for k in self.request.GET.get('kind', '').split(',') if k.strip()]
+        self._kinds = [k for k in kinds if k in allowed] or allowed
+        with phase('worklist'):
+            entries = Worklist.select(Worklist.of(self._tree).entries(self._tree, prefix), allowed)
+        self._counts = Worklist.counts(entries)
+        return Worklist.select(entries, self._kinds)
+
+
+class WorklistView(WorklistMixin, ListView):
+    template_name = 'requirements/worklist.html'
+    paginate_by = settings.DOORSTOP_ITEMS_PAGINATE
+
+    def get_queryset(self):
+        return self.worklist()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['doc'] = self._doc
+        context['docs'] = self._tree.documents
+        context['kinds'] = self._kinds
+        context['counts'] = [(kind, self._counts[kind], kind in self._kinds) for kind in self.allowed_kinds()]
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context['query'] = query.urlencode()
+        return context
+
+
+class WorklistApiView(WorklistMixin, ItemApiMixin, JsonView):
+    """The worklist as JSON, a page at a time like the items of a document."""
+
+    def get_context_data(self, **kwargs):
+        allowed = self.allowed_kinds()
+        for kind in self.request.GET.get('kind', '').split(','):
+            if kind.strip() and kind.strip() not in allowed:
+                raise BadRequest('unknown kind {}'.format(kind.strip()))
+        entries = self.worklist()
+        start, limit = self.page_range([entry.uid for entry in entries])
+        page = entries[start:start + limit]
+        more = start + limit < len(entries)
+        return {
+            'counts': self._counts,
+            'items': [entry.as_dict() for entry in page],
+            'next': self.encode_cursor(page[-1].uid) if more else None,
+        }
+
+
+class MetricsView(View):
+    """Counters and latency histograms of all the workers in the Prometheus text format.
+
+    Served to staff users and to scrapers sending DOORSTOP_METRICS_TOKEN as a bearer token,
+    from the addresses of DOORSTOP_METRICS_ALLOWED only.
+    """
+
+    @staticmethod
+    def authorized(request):
+        #  type: (Any) -> bool
+        if request.user.is_authenticated and request.user.is_staff:
+            return True
+        token, expected = bearer_token(request), getattr(settings, 'DOORSTOP_METRICS_TOKEN', None)
+        return token is not None and bool(expected) and hmac.compare_digest(token.encode(), expected.encode())
+
+    def get(self, request, *args, **kwargs):
+        allowed = getattr(settings, 'DOORSTOP_METRICS_ALLOWED', ['127.0.0.1', '::1'])
+        if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+            return HttpResponseForbidden()
+        if not self.authorized(request):
+            return HttpResponseForbidden()
+        return HttpResponse(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,206 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+
+_log = logging.getLogger(__name__)
+
+
+class RepositoryWatcher(object):
+    """Watches a repository working directory and counts its generations.
+
+    The generation is bumped every time a directory or a file of the working tree changes
+    on disk (its mtime or its size) and every time a file is written through the application. Writes made by the
+    application are logged so that consumers can update only the files that changed.
+
+    The working tree is rescanned every DOORSTOP_WATCH_INTERVAL seconds by a background
+    thread, so `poll()` only reads the generation; the thread stops when nobody polled
+    for IDLE seconds (or the directory is gone) and the next poll rescans before starting
+    it again.
+    """
+
+    EXCLUDE_DIRS = {'.git', '.venv', 'venv', '__pycache__'}
+    MAX_LOG = 1024
+    IDLE = 600
+
+    def __init__(self, root, interval=None):
+        #  type: (str, Optional[float]) -> None
+        self._root = os.path.abspath(root)
+        self._interval = interval if interval is not None else getattr(settings, 'DOORSTOP_WATCH_INTERVAL', 2.0)
+        self._lock = threading.RLock()
+        self._scan_lock = threading.Lock()
+        self._generation = 0
+        self._polled = 0.0
+        self._scanned_ns = 0
+        self._signature = None  # type: Optional[Dict[str, Tuple[int, int]]]
+        self._touched = None  # type: Optional[Set[str]]
+        self._thread = None  # type: Optional[threading.Thread]
+        self._log = []  # type: List[Tuple[int, Optional[str]]]
+
+    @property
+    def root(self):
+        return self._root
+
+    @property
+    def generation(self):
+        #  type: () -> int
+        return self.poll()
+
+    @property
+    def scanned_ns(self):
+        #  type: () -> int
+        """Wall clock time (ns) of the last scan: every change made before it is counted."""
+        return self._scanned_ns
+
+    @staticmethod
+    def _stat(path):
+        #  type: (str) -> Optional[Tuple[int, int]]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _scan(self):
+        #  type: () -> Dict[str, Tuple[int, int]]
+        # Files are stated too: editing a file in place does not change its directory mtime
+        signature = {}
+        for dirpath, dirnames, filenames in os.walk(self._root, topdown=True):
+            dirnames[:] = [d for d in dirnames if d not in RepositoryWatcher.EXCLUDE_DIRS]
+            for path in [dirpath] + [os.path.join(dirpath, name) for name in filenames]:
+                stat = RepositoryWatcher._stat(path)
+                if stat is not None:
+                    signature[path] = stat
+        return signature
+
+    def _bump(self, path):
+        #  type: (Optional[str]) -> int
+        self._generation += 1
+        self._log.append((self._generation, path))
+        if len(self._log) > RepositoryWatcher.MAX_LOG:
+            del self._log[:len(self._log) - RepositoryWatcher.MAX_LOG]
+        return self._generation
+
+    def _rescan(self):
+        # The walk runs without the lock: files written meanwhile keep the stat `touch` took
+        with self._scan_lock:
+            with self._lock:
+                self._touched = set()
+                scanned_ns = time.time_ns()
+            signature = self._scan()
+            self._merge(signature, scanned_ns)
+
+    def _merge(self, signature, scanned_ns):
+        #  type: (Dict[str, Tuple[int, int]], int) -> None
+        with self._lock:
+            for path in self._touched:
+                stat = self._signature.get(path) if self._signature is not None else None
+                if stat is None:
+                    signature.pop(path, None)
+                else:
+                    signature[path] = stat
+            self._touched = None
+            if self._signature is not None and signature != self._signature:
+                _log.debug('repository %s changed on disk', self._root)
+                self._bump(None)
+            self._signature = signature
+            self._scanned_ns = scanned_ns
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                if time.monotonic() - self._polled > RepositoryWatcher.IDLE or not os.path.isdir(self._root):
+                    self._thread = None
+                    return
+            try:
+                self._rescan()
+            except Exception:  # pylint: disable=broad-except
+                _log.exception('unable to scan %s', self._root)
+
+    def poll(self, force=False):
+        #  type: (bool) -> int
+        """Return the current generation.
+
+        The working tree is scanned in the calling thread only the first time, when the
+        background thread was stopped and with `force`.
+        """
+        with self._lock:
+            self._polled = time.monotonic()
+            if not force and self._thread is not None and self._signature is not None:
+                return self._generation
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='watcher', daemon=True)
+                self._thread.start()
+        self._rescan()
+        return self._generation
+
+    def signature(self):
+        #  type: () -> Tuple[int, int, Dict[str, Tuple[int, int]]]
+        """Generation, scan time and (mtime, size) of every path of the last scan."""
+        self.poll()
+        with self._lock:
+            return self._generation, self._scanned_ns, dict(self._signature)
+
+    def touch(self, path, reload=False):
+        #  type: (str, bool) -> int
+        """Record a file written by the application.
+
+        With `reload` the write is logged as a change that in-memory copies cannot follow.
+        """
+        with self._lock:
+            path = os.path.abspath(path)
+            if self._touched is not None:
+                self._touched.update((path, os.path.dirname(path)))
+            if self._signature is not None:
+                for _path in (path, os.path.dirname(path)):
+                    stat = RepositoryWatcher._stat(_path)
+                    if stat is None:
+                        self._signature.pop(_path, None)
+                    else:
+                        self._signature[_path] = stat
+            return self._bump(None if reload else path)
+
+    def changes_since(self, generation):
+        #  type: (int) -> Optional[Set[str]]
+        """Files written by the application after `generation`, None if the change set is unknown."""
+        with self._lock:
+            if generation == self._generation:
+                return set()
+            if not self._log or self._log[0][0] > generation + 1:
+                return None
+            changed = set()
+            for _generation, path in self._log:
+                if _generation <= generation:
+                    continue
+                if path is None:
+                    return None
+                changed.add(path)
+            return changed
+
+
+_watchers = {}  # type: Dict[str, RepositoryWatcher]
+_watchers_lock = threading.Lock()
+
+
+def watcher_for(root):
+    #  type: (str) -> RepositoryWatcher
+    root = os.path.abspath(root)
+    with _watchers_lock:
+        watcher = _watchers.get(root)
+        if watcher is None:
+            watcher = _watchers[root] = RepositoryWatcher(root)
+        return watcher
+
+
+def notify_write(path, reload=False):
+    #  type: (str, bool) -> None
+    path = os.path.abspath(path)
+    with _watchers_lock:
+        watchers = list(_watchers.values())
+    for watcher in watchers:
+        if path.startswith(watcher.root + os.sep):
+            watcher.touch(path, reload)
@@ -0,0 +1,134 @@
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from doorstop import DoorstopError, Item, Tree
+from doorstop.core.item import UnknownItem
+
+_log = logging.getLogger(__name__)
+
+
+class WorkEntry(object):
+    UNREVIEWED = 'unreviewed'
+    SUSPECT = 'suspect'
+    COMMENTS = 'comments'
+    PENDING = 'pending'
+    KINDS = (UNREVIEWED, SUSPECT, COMMENTS, PENDING)
+
+    def __init__(self, uid, prefix, level, header, kinds, suspects, comments):
+        #  type: (str, str, str, str, Tuple[str, ...], List[str], int) -> None
+        self.uid = uid
+        self.prefix = prefix
+        self.level = level
+        self.header = header
+        self.kinds = kinds
+        self.suspects = suspects
+        self.comments = comments
+
+    def as_dict(self):
+        #  type: () -> Dict
+        return {'uid': self.uid, 'document': self.prefix, 'level': self.level, 'header': self.header,
+                'kinds': list(self.kinds), 'suspect_parents': self.suspects, 'open_comments': self.comments}
+
+
+class Worklist(object):
+    """Review work left in a tree: unreviewed items, suspect links, open comments and pending items.
+
+    Kept on the tree and refreshed at every request, but an item is looked at again
+    only when its content generation or its cleared state changed: both are lookups
+    (stamps are memoized and suspect links are propagated when an item changes), so no
+    validation of the tree is run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # type: Dict[str, Tuple[Tuple[int, bool], str, Optional[WorkEntry]]]
+
+    @staticmethod
+    def of(tree):
+        #  type: (Tree) -> Worklist
+        worklist = getattr(tree, '_worklist', None)
+        if worklist is None:
+            worklist = tree._worklist = Worklist()  # pylint: disable=protected-access
+        return worklist
+
+    @staticmethod
+    def _suspects(tree, item):
+        #  type: (Tree, Item) -> List[str]
+        suspects = []
+        for uid in item.links:
+            try:
+                parent = tree.find_item(uid)
+            except DoorstopError:
+                parent = UnknownItem(uid)
+            if uid.stamp != parent.stamp():
+                suspects.append(str(uid))
+        return suspects
+
+    @staticmethod
+    def _entry(tree, item, cleared):
+        #  type: (Tree, Item, bool) -> Optional[WorkEntry]
+        kinds = []
+        if not item.reviewed:
+            kinds.append(WorkEntry.UNREVIEWED)
+        suspects = [] if cleared else Worklist._suspects(tree, item)
+        if suspects:
+            kinds.append(WorkEntry.SUSPECT)
+        comments = len([c for c in item.get('comments') or [] if not c.get('closed')])
+        if comments:
+            kinds.append(WorkEntry.COMMENTS)
+        if item.pending:
+            kinds.append(WorkEntry.PENDING)
+        if not kinds:
+            return None
+        return WorkEntry(str(item.uid), item.document.prefix, str(item.level), item.header, tuple(kinds), suspects, comments)
+
+    def entries(self, tree, prefix=None):
+        #  type: (Tree, Optional[str]) -> List[WorkEntry]
+        """Entries of the active items of the tree or of a document, in document and level order."""
+        documents = list(tree) if prefix is None else [tree.find_document(prefix)]
+        entries = []
+        with self._lock:
+            for document in documents:
+                seen = set()
+                for item in document.items:
+                    if item.deleted:
+                        continue
+                    uid = str(item.uid)
+                    seen.add(uid)
+                    key = (item.generation, item.cleared)
+                    cached = self._entries.get(uid)
+                    if cached is not None and cached[0] == key and key[1]:
+                        entry = cached[2]
+                    else:
+                        # The suspect parents of an uncleared item change with its parents
+                        entry = Worklist._entry(tree, item, key[1])
+                        self._entries[uid] = (key, document.prefix, entry)
+                    if entry is not None:
+                        entries.append(entry)
+                for uid in [u for u, cached in self._entries.items() if cached[1] == document.prefix and u not in seen]:
+                    del self._entries[uid]
+        return entries
+
+    @staticmethod
+    def select(entries, kinds):
+        #  type: (List[WorkEntry], Iterable[str]) -> List[WorkEntry]
+        """Entries with at least one of the kinds, restricted to them."""
+        kinds = set(kinds)
+        result = []
+        for entry in entries:
+            matched = tuple(k for k in entry.kinds if k in kinds)
+            if matched == entry.kinds:
+                result.append(entry)
+            elif matched:
+                result.append(WorkEntry(entry.uid, entry.prefix, entry.level, entry.header, matched, entry.suspects, entry.comments))
+        return result
+
+    @staticmethod
+    def counts(entries):
+        #  type: (List[WorkEntry]) -> Dict[str, int]
+        counts = {kind: 0 for kind in WorkEntry.KINDS}
+        for entry in entries:
+            for kind in entry.kinds:
+                counts[kind] += 1
+        return counts